@@ -0,0 +1,120 @@
+"""
+Сравнение режимов текста для шагов анализа (STEP_CONTEXT_MODE): full и retrieval.
+
+Запуск (провайдеры из .env или локальный mock-сервер, см. mock_llm_server.py):
+    python -m app.bench_step_context --url https://example.com
+    python -m app.bench_step_context --text-file page.txt --runs 3 --posts
+
+Оба режима получают один и тот же текст и один и тот же список шагов.
+Для каждого режима печатаются входные токены и задержка шагов (run_step),
+а как проверка качества:
+- term_coverage - доля слов формулировки шага, встречающихся в тексте шага;
+- fact_recall - доля строк с цифрами (цены, сроки, годы) из полного текста,
+  попавших хотя бы в один текст шага;
+- с --posts - итоговые посты каждого режима для сравнения вручную.
+"""
+import argparse
+import asyncio
+import re
+import statistics
+import time
+from typing import Any, Dict, List
+
+from app.services.analyzer import SiteAnalyzer
+from app.services.llm_client import get_shared_llm_client
+from app.services.llm_metrics import llm_metrics
+from app.services.retrieval import tokenize
+
+_DIGIT_RE = re.compile(r"\d")
+
+
+def _term_coverage(step: str, context: str) -> float:
+    terms = set(tokenize(step))
+    if not terms:
+        return 1.0
+    return len(terms & set(tokenize(context))) / len(terms)
+
+
+def _fact_recall(full_text: str, contexts: List[str]) -> float:
+    facts = {line for line in full_text.split("\n") if _DIGIT_RE.search(line)}
+    if not facts:
+        return 1.0
+    joined = "\n".join(contexts)
+    return sum(1 for fact in facts if fact in joined) / len(facts)
+
+
+async def _run_mode(
+    analyzer: SiteAnalyzer, mode: str, cleaned_text: str, steps: List[str], with_posts: bool
+) -> Dict[str, Any]:
+    analyzer.step_context_mode = mode
+    contexts = [analyzer._step_context(cleaned_text, step) for step in steps]
+    full = analyzer._stage_text(cleaned_text, "run_step")
+
+    with llm_metrics.collect() as calls:
+        started = time.perf_counter()
+        results = await asyncio.gather(*[analyzer.run_step_safe(step, cleaned_text) for step in steps])
+        wall = time.perf_counter() - started
+    step_calls = [call for call in calls if call["call_site"].startswith("run_step")]
+    usage = llm_metrics.summarize(step_calls)
+
+    report: Dict[str, Any] = {
+        "mode": mode,
+        "prompt_tokens": usage["prompt_tokens"],
+        "cost_usd": usage["cost_usd"],
+        "steps_wall_s": round(wall, 2),
+        "step_latency_p50_s": round(statistics.median(c["latency"] for c in step_calls), 2) if step_calls else 0.0,
+        "step_errors": sum(1 for res in results if "error" in res),
+        "context_chars": sum(len(context) for context in contexts),
+        "term_coverage": round(statistics.mean(_term_coverage(s, c) for s, c in zip(steps, contexts)), 3),
+        "fact_recall": round(_fact_recall(full, contexts), 3),
+    }
+    if with_posts:
+        intermediate = analyzer._collect_intermediate(steps, results)
+        final = await analyzer.finalize(intermediate, cleaned_text, "убедительно-позитивном", "")
+        report["posts"] = final.get("posts", [])
+    return report
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--url", help="Страница сайта")
+    source.add_argument("--text-file", help="Очищенный текст сайта (UTF-8)")
+    parser.add_argument("--modes", default="full,retrieval", help="Режимы через запятую")
+    parser.add_argument("--runs", type=int, default=1, help="Повторов каждого режима")
+    parser.add_argument("--posts", action="store_true", help="Сгенерировать и напечатать посты")
+    args = parser.parse_args()
+
+    analyzer = SiteAnalyzer(get_shared_llm_client())
+    if args.url:
+        cleaned_text, _, _ = await analyzer._load_cleaned_text(args.url, use_cached=False)
+    else:
+        with open(args.text_file, encoding="utf-8") as f:
+            cleaned_text, _, _ = analyzer._fit_to_budgets(f.read())
+    steps = await analyzer.get_steps(cleaned_text)
+    print(f"Text: {len(cleaned_text)} chars, steps: {len(steps)}")
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    reports = []
+    for run in range(args.runs):
+        # Чередуем порядок режимов, чтобы прогрев кэша провайдера не давал преимущества одному
+        for mode in (modes if run % 2 == 0 else list(reversed(modes))):
+            reports.append(await _run_mode(analyzer, mode, cleaned_text, steps, args.posts))
+
+    columns = ["prompt_tokens", "cost_usd", "steps_wall_s", "step_latency_p50_s", "step_errors",
+               "context_chars", "term_coverage", "fact_recall"]
+    print("\n" + "mode".ljust(10) + "".join(column.rjust(20) for column in columns))
+    for mode in modes:
+        mode_reports = [report for report in reports if report["mode"] == mode]
+        averages = [statistics.mean(report[column] for report in mode_reports) for column in columns]
+        print(mode.ljust(10) + "".join(f"{value:20.3f}".rstrip("0").rstrip(".").rjust(20) for value in averages))
+
+    if args.posts:
+        for report in reports[: len(modes)]:
+            print(f"\n=== {report['mode']} ===")
+            for i, post in enumerate(report["posts"], 1):
+                print(f"[{i}] {post}\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -14,6 +16,12 @@ except ImportError:
 from app.services.task_queue import start_task_processor
 from app.models.database import init_db
 from app.services.params_service import params_service
+from app.services.llm_client import get_shared_llm_client
+from app.services.html_cleaner import html_cleaner
+from app.services.http_fetch import page_fetcher
+from app.services.llm_pool import llm_pool
+from app.services.style_prefetcher import style_prefetcher
+from app.services.token_budget import token_budget
 
 
 def create_app() -> FastAPI:
@@ -56,6 +64,30 @@ async def startup_event():
     await params_service.initialize_from_env()
     # Запуск обработчика задач
     await start_task_processor()
+    # Общий HTTP-клиент для загрузки страниц сайтов
+    page_fetcher.get_client()
+    # Процессы разбора HTML (запускаются заранее, чтобы первый анализ их не ждал)
+    try:
+        await html_cleaner.start()
+    except Exception as e:
+        print(f"[startup] Warning: HTML parser pool failed to start: {e}")
+    # Прогрев соединений к LLM-провайдерам (TCP + TLS до первого запроса)
+    try:
+        llm_client = get_shared_llm_client()
+        await llm_client.warmup()
+        # Словари tiktoken для подсчёта токенов (могут скачиваться - не в event loop)
+        await asyncio.to_thread(token_budget.preload, [llm_client.model, llm_client.alt_model])
+    except Exception as e:
+        print(f"[startup] Warning: LLM warm-up failed: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Закрытие общих соединений при остановке воркера."""
+    await style_prefetcher.close()
+    await llm_pool.close()
+    await page_fetcher.close()
+    html_cleaner.close()
 
 
 
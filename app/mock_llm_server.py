@@ -0,0 +1,306 @@
+"""
+Локальный mock-сервер, совместимый с OpenAI API, для нагрузочных тестов без ключей.
+
+Запуск:
+    uvicorn app.mock_llm_server:app --port 8090
+
+и в .env:
+    BASE_URL=http://localhost:8090/v1
+    OPENAI_BASE_URL=http://localhost:8090/v1
+
+Отвечает валидным JSON той структуры, которую ждёт SiteAnalyzer
+(steps - для планирования, posts - для финализации, объект - для шагов),
+с настраиваемыми задержками, скоростью генерации, ошибками и сериями 429.
+Параметры задаются профилем (MOCK_LLM_PROFILE) и переопределяются через MOCK_LLM_*.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+# ttft - время до первого токена (сек), tps - токенов в секунду,
+# error_rate - доля ответов 500/503, rate_limit_rate - вероятность начала серии 429,
+# rate_limit_burst - длина серии 429 (запросов подряд)
+PROFILES: Dict[str, Dict[str, float]] = {
+    "instant": {"ttft": 0.0, "tps": 0, "error_rate": 0.0, "rate_limit_rate": 0.0, "rate_limit_burst": 0},
+    "fast": {"ttft": 0.2, "tps": 200, "error_rate": 0.0, "rate_limit_rate": 0.0, "rate_limit_burst": 0},
+    "realistic": {"ttft": 0.8, "tps": 60, "error_rate": 0.01, "rate_limit_rate": 0.01, "rate_limit_burst": 3},
+    "slow": {"ttft": 3.0, "tps": 20, "error_rate": 0.02, "rate_limit_rate": 0.02, "rate_limit_burst": 5},
+    "flaky": {"ttft": 0.8, "tps": 60, "error_rate": 0.15, "rate_limit_rate": 0.1, "rate_limit_burst": 5},
+}
+
+
+def _load_config() -> Dict[str, float]:
+    profile = os.getenv("MOCK_LLM_PROFILE", "fast")
+    config = dict(PROFILES.get(profile, PROFILES["fast"]))
+    overrides = {
+        "ttft": "MOCK_LLM_TTFT",
+        "tps": "MOCK_LLM_TPS",
+        "error_rate": "MOCK_LLM_ERROR_RATE",
+        "rate_limit_rate": "MOCK_LLM_429_RATE",
+        "rate_limit_burst": "MOCK_LLM_429_BURST",
+    }
+    for key, env_name in overrides.items():
+        if os.getenv(env_name):
+            config[key] = float(os.getenv(env_name))
+    # Сколько символов считать за один токен при оценке usage
+    config["chars_per_token"] = float(os.getenv("MOCK_LLM_CHARS_PER_TOKEN", "3"))
+    config["seed"] = os.getenv("MOCK_LLM_SEED")
+    print(f"[MockLLM] profile={profile} config={config}")
+    return config
+
+
+CONFIG = _load_config()
+_random = random.Random(CONFIG["seed"])
+# Сколько ещё запросов подряд отвечать 429 (текущая серия)
+_rate_limit_left = 0
+# Хэши уже виденных системных сообщений - имитация кэша контекста провайдера
+_seen_prefixes: Dict[str, int] = {}
+_stats: Dict[str, int] = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0, "truncated": 0}
+
+app = FastAPI(title="Mock LLM")
+
+
+# --- Содержимое ответов ---
+_STEPS = [
+    "Изучите основные предложения и услуги, которые предлагает сайт",
+    "Определите целевую аудиторию сайта и её потребности",
+    "Выявите уникальные особенности и преимущества компании",
+    "Найдите конкретные цифры, факты и кейсы на сайте",
+    "Составьте список возможных вопросов и возражений клиентов",
+    "Предложите идеи для постов на основе найденного",
+]
+
+
+def _post_text(index: int, style: str) -> str:
+    """Пост 400-800 знаков, как требует промпт финализации."""
+    base = (
+        f"✨ Пост №{index + 1} в {style} стиле. Компания помогает клиентам решать их задачи быстро и "
+        "качественно: понятные условия, внимательная поддержка и результат, который видно сразу. "
+        "Мы собрали главное из анализа сайта - преимущества, цифры и реальные истории клиентов. "
+    )
+    text = base
+    while len(text) < 450:
+        text += "Попробуйте сами и убедитесь, что это работает! 🚀 "
+    return text[:780]
+
+
+def _response_kind(body: Dict[str, Any]) -> str:
+    """Что ожидает клиент: steps, posts, repair/continue или объект результата шага."""
+    messages = body.get("messages") or []
+    last = (messages[-1].get("content") or "") if messages else ""
+    system = (messages[0].get("content") or "") if messages else ""
+    if "Ответ оборвался" in last:
+        return "continue"
+    if system.startswith("Исправь синтаксис JSON"):
+        return "repair"
+    response_format = body.get("response_format") or {}
+    schema_name = (response_format.get("json_schema") or {}).get("name", "")
+    all_text = "\n".join(m.get("content") or "" for m in messages)
+    if schema_name == "analysis_steps" or "'steps'" in all_text:
+        return "steps"
+    if schema_name == "social_posts" or '"posts"' in all_text:
+        return "posts"
+    return "step_result"
+
+
+def _response_content(body: Dict[str, Any], kind: str) -> str:
+    if kind == "steps":
+        return json.dumps({"steps": _STEPS}, ensure_ascii=False)
+    if kind == "posts":
+        user = (body["messages"][-1].get("content") or "")
+        style = user.split(" стиле")[0].rsplit(" в ", 1)[-1] if " стиле" in user else "выбранном"
+        # FINALIZE_MODE=parallel: запрос одного варианта ("вариант N из 3") - один пост
+        variant = re.search(r"вариант (\d+) из", user)
+        indexes = [int(variant.group(1)) - 1] if variant else range(3)
+        return json.dumps({"posts": [_post_text(i, style) for i in indexes]}, ensure_ascii=False)
+    if kind == "repair":
+        # Возвращаем исправленный вариант того, что прислал клиент (или пустой объект)
+        broken = body["messages"][-1].get("content") or ""
+        start, end = broken.find("{"), broken.rfind("}")
+        try:
+            return json.dumps(json.loads(broken[start:end + 1]), ensure_ascii=False)
+        except ValueError:
+            return "{}"
+    if kind == "continue":
+        return ""
+    return json.dumps({
+        "результат": "Сайт описывает услуги компании и её преимущества для клиентов",
+        "ключевые_факты": ["Работают более 10 лет", "Более 1000 клиентов", "Поддержка 24/7"],
+        "идеи_для_постов": ["История успеха клиента", "Сравнение до и после", "Ответы на частые вопросы"],
+    }, ensure_ascii=False)
+
+
+def _continuation(body: Dict[str, Any]) -> str:
+    """Продолжение оборванного ответа: полный ответ минус уже выданная часть."""
+    messages = body["messages"]
+    partial = messages[-2].get("content") or ""
+    original = dict(body, messages=messages[:-2])
+    full = _response_content(original, _response_kind(original))
+    return full[len(partial):] if full.startswith(partial) else full
+
+
+# --- Учёт токенов ---
+def _tokens(text: str) -> int:
+    return max(1, int(len(text) / CONFIG["chars_per_token"]))
+
+
+def _usage(body: Dict[str, Any], completion_tokens: int) -> Dict[str, Any]:
+    messages = body.get("messages") or []
+    prompt_tokens = sum(_tokens(m.get("content") or "") for m in messages)
+    # Кэш контекста: первое сообщение уже встречалось - его токены "из кэша"
+    cached = 0
+    if messages:
+        first = messages[0].get("content") or ""
+        digest = hashlib.sha256(first.encode("utf-8")).hexdigest()
+        if digest in _seen_prefixes:
+            cached = _seen_prefixes[digest]
+        else:
+            _seen_prefixes[digest] = _tokens(first)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        # Формат DeepSeek и формат OpenAI
+        "prompt_cache_hit_tokens": cached,
+        "prompt_cache_miss_tokens": prompt_tokens - cached,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _fit_max_tokens(content: str, max_tokens: Optional[int]) -> Tuple[str, str]:
+    """Обрезать ответ по max_tokens, как настоящий провайдер (finish_reason=length)."""
+    if max_tokens and _tokens(content) > max_tokens:
+        _stats["truncated"] += 1
+        return content[:int(max_tokens * CONFIG["chars_per_token"])], "length"
+    return content, "stop"
+
+
+def _failure() -> Optional[JSONResponse]:
+    """Случайная ошибка или очередной ответ из серии 429."""
+    global _rate_limit_left
+    if _rate_limit_left <= 0 and _random.random() < CONFIG["rate_limit_rate"]:
+        _rate_limit_left = int(CONFIG["rate_limit_burst"]) or 1
+    if _rate_limit_left > 0:
+        _rate_limit_left -= 1
+        _stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error", "code": "rate_limit"}},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+    if _random.random() < CONFIG["error_rate"]:
+        _stats["errors"] += 1
+        status = _random.choice([500, 503])
+        return JSONResponse(
+            {"error": {"message": f"Mock upstream error {status}", "type": "server_error"}},
+            status_code=status,
+        )
+    return None
+
+
+async def _generation_delay(completion_tokens: int) -> None:
+    delay = CONFIG["ttft"] + (completion_tokens / CONFIG["tps"] if CONFIG["tps"] else 0)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+# --- Эндпоинты ---
+@app.get("/v1/models")
+async def list_models() -> Dict[str, Any]:
+    return {
+        "object": "list",
+        "data": [
+            {"id": model, "object": "model", "created": 0, "owned_by": "mock"}
+            for model in ("deepseek-chat", "gpt-4o")
+        ],
+    }
+
+
+@app.get("/stats")
+async def stats() -> Dict[str, Any]:
+    return {**_stats, "config": CONFIG}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    _stats["requests"] += 1
+    failure = _failure()
+    if failure is not None:
+        # Ошибка приходит после небольшой паузы, как у настоящего провайдера
+        await asyncio.sleep(min(CONFIG["ttft"], 0.2))
+        return failure
+
+    kind = _response_kind(body)
+    content = _continuation(body) if kind == "continue" else _response_content(body, kind)
+    content, finish_reason = _fit_max_tokens(content, body.get("max_tokens"))
+    completion_tokens = _tokens(content)
+    usage = _usage(body, completion_tokens)
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    model = body.get("model", "mock")
+
+    if body.get("stream"):
+        _stats["streams"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(
+            _stream(completion_id, model, content, finish_reason, usage if include_usage else None),
+            media_type="text/event-stream",
+        )
+
+    await _generation_delay(completion_tokens)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+        }],
+        "usage": usage,
+    }
+
+
+async def _stream(
+    completion_id: str,
+    model: str,
+    content: str,
+    finish_reason: str,
+    usage: Optional[Dict[str, Any]],
+) -> AsyncIterator[str]:
+    """SSE в формате OpenAI: фрагменты по ~4 токена со скоростью tps."""
+    def chunk(choices: List[Dict[str, Any]], **extra: Any) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            **extra,
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    if CONFIG["ttft"]:
+        await asyncio.sleep(CONFIG["ttft"])
+    piece_chars = max(1, int(4 * CONFIG["chars_per_token"]))
+    piece_delay = 4 / CONFIG["tps"] if CONFIG["tps"] else 0
+    yield chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+    for pos in range(0, len(content), piece_chars):
+        yield chunk([{"index": 0, "delta": {"content": content[pos:pos + piece_chars]}, "finish_reason": None}])
+        if piece_delay:
+            await asyncio.sleep(piece_delay)
+    yield chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+    if usage is not None:
+        yield chunk([], usage=usage)
+    yield "data: [DONE]\n\n"
@@ -1,13 +1,22 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+import json
 import httpx
 
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.orm import Session
 
-from app.services.llm_client import LLMClient
+from app.services.llm_client import get_shared_llm_client
+from app.services.circuit_breaker import circuit_breakers
+from app.services.html_cleaner import html_cleaner
+from app.services.llm_cache import llm_cache
+from app.services.llm_metrics import llm_metrics
+from app.services.provider_health import provider_health
+from app.services.singleflight import singleflight
+from app.services.style_prefetcher import style_prefetcher
 from app.services.analyzer import SiteAnalyzer
-from app.models.database import get_db
+from app.models.database import ClientSession, SessionLocal, get_db
 from app.services.session_service import session_service
 
 
@@ -17,12 +26,9 @@ router = APIRouter()
 # Инициализируем LLM клиент в ГИБРИДНОМ РЕЖИМЕ:
 # - Основной: DeepSeek (экономичный для анализа)
 # - Альтернативный: GPT-4o (быстрый для chat/JSON)
-llm_client = LLMClient(
-    # DeepSeek как основной (для анализа больших текстов)
-    # Параметры берутся из .env: BASE_URL, API_KEY
-    # Альтернативный GPT-4o (для быстрых JSON)
-    # Параметры берутся из .env: OPENAI_BASE_URL, OPENAI_API_KEY
-)
+# Параметры берутся из .env: BASE_URL, API_KEY, OPENAI_BASE_URL, OPENAI_API_KEY
+# Клиент общий для процесса: его же использует обработчик фоновых задач
+llm_client = get_shared_llm_client()
 site_analyzer = SiteAnalyzer(llm_client)
 
 
@@ -51,9 +57,9 @@ class ChatJsonRequest(BaseModel):
 
 
 @router.post("/chat")
-def chat(req: ChatRequest) -> Dict[str, Any]:
+async def chat(req: ChatRequest) -> Dict[str, Any]:
     try:
-        text = llm_client.chat(
+        text = await llm_client.chat(
             prompt=req.prompt,
             model=req.model,
             max_tokens=req.max_tokens,
@@ -65,9 +71,9 @@ def chat(req: ChatRequest) -> Dict[str, Any]:
 
 
 @router.post("/chat-with-system")
-def chat_with_system(req: ChatWithSystemRequest) -> Dict[str, Any]:
+async def chat_with_system(req: ChatWithSystemRequest) -> Dict[str, Any]:
     try:
-        text = llm_client.chat_with_system(
+        text = await llm_client.chat_with_system(
             system_prompt=req.system_prompt,
             user_prompt=req.user_prompt,
             model=req.model,
@@ -80,13 +86,13 @@ def chat_with_system(req: ChatWithSystemRequest) -> Dict[str, Any]:
 
 
 @router.post("/chat-json")
-def chat_json(req: ChatJsonRequest) -> Dict[str, Any]:
+async def chat_json(req: ChatJsonRequest) -> Dict[str, Any]:
     try:
         system_prompt = req.system_prompt
         if req.jsonStandard:
             system_prompt = f"{req.system_prompt}\nСтрого соблюдай стандарт JSON: {req.jsonStandard}"
 
-        data = llm_client.chat_json(
+        data = await llm_client.chat_json(
             system_prompt=system_prompt,
             user_prompt=req.user_prompt,
             model=req.model,
@@ -98,6 +104,46 @@ def chat_json(req: ChatJsonRequest) -> Dict[str, Any]:
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
 
+@router.get("/cache-stats")
+async def cache_stats() -> Dict[str, Any]:
+    """Счётчики кэша ответов LLM (попадания, промахи, размер)."""
+    return llm_cache.get_stats()
+
+
+@router.get("/coalescing-stats")
+async def coalescing_stats() -> Dict[str, Any]:
+    """Счётчики объединения одинаковых одновременных запросов к LLM (singleflight)."""
+    return singleflight.get_stats()
+
+
+@router.get("/providers")
+async def providers_health() -> Dict[str, Any]:
+    """Состояние LLM-провайдеров воркера (ошибки подряд, последняя ошибка, circuit breaker)."""
+    providers = provider_health.snapshot()
+    for name, circuit in circuit_breakers.snapshot().items():
+        providers.setdefault(name, {})["circuit"] = circuit
+    return providers
+
+
+@router.get("/routing")
+async def llm_routing() -> Dict[str, Any]:
+    """Политика маршрутизации между провайдерами и статистика (p95, ошибки) по этапам."""
+    return llm_client.routing_snapshot()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def llm_metrics_export() -> PlainTextResponse:
+    """Метрики LLM-вызовов воркера в формате Prometheus (задержки, токены, стоимость)."""
+    return PlainTextResponse(
+        llm_metrics.render_prometheus()
+        + circuit_breakers.render_prometheus()
+        + singleflight.render_prometheus()
+        + html_cleaner.render_prometheus()
+        + style_prefetcher.render_prometheus(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 class AnalyzeRequest(BaseModel):
     url: str
     email: EmailStr  # Email клиента для проверки сеанса
@@ -105,6 +151,47 @@ class AnalyzeRequest(BaseModel):
     occasion: Optional[str] = ""
     use_cached: Optional[bool] = False
     cached_intermediate: Optional[List[Dict[str, Any]]] = None
+    crawl: Optional[bool] = False  # Анализировать несколько страниц сайта (sitemap и ссылки)
+
+
+def _remaining_styles(session: ClientSession) -> Tuple[List[str], int]:
+    """Неиспользованные стили сеанса и сколько секунд осталось до его окончания."""
+    styles = [style for style, available in session_service.get_available_styles(session).items() if available == 1]
+    return styles, session_service.remaining_seconds(session)
+
+
+async def _consume_prefetched(request: AnalyzeRequest, result: Dict[str, Any]) -> None:
+    """Удалить заранее сгенерированные посты, выданные клиенту (стиль уже списан)."""
+    if result.get("prefetched"):
+        await style_prefetcher.consume(
+            request.email,
+            SiteAnalyzer._cache_url(request.url, bool(request.crawl)),
+            request.style,
+            request.occasion,
+        )
+
+
+def _prefetch_remaining_styles(
+    request: AnalyzeRequest,
+    intermediate: Optional[List[Dict[str, Any]]],
+    remaining: Tuple[List[str], int]
+) -> None:
+    """
+    Запустить фоновую генерацию постов для ещё не использованных стилей сеанса
+    (PREFETCH_ENABLED). Стили не списываются - только при выдаче клиенту.
+    """
+    styles, ttl = remaining
+    if not style_prefetcher.enabled or not intermediate or not styles:
+        return
+    style_prefetcher.schedule(
+        site_analyzer,
+        request.email,
+        SiteAnalyzer._cache_url(request.url, bool(request.crawl)),
+        request.occasion,
+        intermediate,
+        styles,
+        ttl,
+    )
 
 
 @router.post("/analyze-site")
@@ -144,12 +231,14 @@ async def analyze_site(
             occasion=request.occasion,
             use_cached=request.use_cached,
             cached_intermediate=request.cached_intermediate,
-            email=request.email  # Передаем email для привязки кэша к сеансу
+            email=request.email,  # Передаем email для привязки кэша к сеансу
+            crawl=bool(request.crawl)
         )
         
         # ПОСЛЕ генерации результата выполняем проверки окончания сеанса (блоки 17 и 18)
         # Помечаем стиль как использованный
         session_service.mark_style_as_used(db, session, request.style)
+        await _consume_prefetched(request, result)
         
         # Проверяем время сеанса ПОСЛЕ генерации (блок 18)
         if not is_time_valid:
@@ -168,6 +257,8 @@ async def analyze_site(
             session_service.delete_session(db, request.email)
             result['session_ended'] = True
             result['message'] = 'Все стили использованы. Сеанс завершен.'
+        else:
+            _prefetch_remaining_styles(request, result.get("intermediate_results"), _remaining_styles(session))
         
         return result
         
@@ -179,14 +270,10 @@ async def analyze_site(
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
 
-@router.post("/analyze-site-sync")
-async def analyze_site_sync(
-    request: AnalyzeRequest,
-    db: Session = Depends(get_db)
-) -> Dict[str, Any]:
+def _prepare_sync_session(db: Session, request: AnalyzeRequest) -> Tuple[ClientSession, bool, bool]:
     """
-    Синхронный анализ сайта - используется frontend для прямого получения результатов.
-    Включает проверку сеанса и доступности стиля.
+    Проверки сеанса перед генерацией для /analyze-site-sync и /analyze-site-stream.
+    Возвращает (session, is_time_valid, can_use_cache).
     """
     # Проверяем сеанс клиента
     session = session_service.get_session_by_email(db, request.email)
@@ -267,6 +354,20 @@ async def analyze_site_sync(
         request.use_cached  # Клиент явно запросил кэш
     )
     
+    return session, is_time_valid, can_use_cache
+
+
+@router.post("/analyze-site-sync")
+async def analyze_site_sync(
+    request: AnalyzeRequest,
+    db: Session = Depends(get_db)
+) -> Dict[str, Any]:
+    """
+    Синхронный анализ сайта - используется frontend для прямого получения результатов.
+    Включает проверку сеанса и доступности стиля.
+    """
+    session, is_time_valid, can_use_cache = _prepare_sync_session(db, request)
+    
     try:
         # Выполняем анализ (используем кэш только если разрешено)
         # ВАЖНО: Генерация выполняется независимо от статуса времени сеанса
@@ -277,11 +378,14 @@ async def analyze_site_sync(
             occasion=request.occasion,
             use_cached=can_use_cache,
             cached_intermediate=request.cached_intermediate if can_use_cache else None,
-            email=request.email  # Передаем email для привязки кэша к сеансу
+            email=request.email,  # Передаем email для привязки кэша к сеансу
+            crawl=bool(request.crawl)
         )
         
         # БЛОК 16: Обновление записи в базе (помечаем стиль как использованный)
         session_service.mark_style_as_used(db, session, request.style)
+        await _consume_prefetched(request, result)
+        _prefetch_remaining_styles(request, result.get("intermediate_results"), _remaining_styles(session))
         
         # БЛОК 17: ВЫВОД ПУБЛИКАЦИЙ - результат возвращается пользователю
         # Пользователь может сохранить результат по кнопке сохранения
@@ -301,3 +405,68 @@ async def analyze_site_sync(
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
 
+
+
+def _sse(event: str, data: Any) -> str:
+    """Кадр Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/analyze-site-stream")
+async def analyze_site_stream(
+    request: AnalyzeRequest,
+    db: Session = Depends(get_db)
+) -> StreamingResponse:
+    """
+    Потоковый вариант /analyze-site-sync (Server-Sent Events).
+    События: fetched, step_planned, steps_planned, step_done, delta, post, result, error.
+    Проверки сеанса те же, что у /analyze-site-sync, и выполняются до начала стрима,
+    поэтому ошибки доступа возвращаются обычными HTTP-кодами.
+    """
+    _, _, can_use_cache = _prepare_sync_session(db, request)
+
+    async def event_stream():
+        # (промежуточные результаты, оставшиеся стили) - для фоновой генерации после стрима
+        delivered = None
+        try:
+            async for event in site_analyzer.analyze_stream(
+                request.url,
+                style=request.style,
+                occasion=request.occasion,
+                use_cached=can_use_cache,
+                cached_intermediate=request.cached_intermediate if can_use_cache else None,
+                email=request.email,
+                crawl=bool(request.crawl)
+            ):
+                if event["event"] == "result":
+                    # БЛОК 16: стиль помечается использованным только после полной генерации.
+                    # Сессия БД из Depends к этому моменту может быть уже закрыта - открываем свою.
+                    stream_db = SessionLocal()
+                    try:
+                        session = session_service.get_session_by_email(stream_db, request.email)
+                        if session:
+                            session_service.mark_style_as_used(stream_db, session, request.style)
+                            delivered = event["data"].get("intermediate_results"), _remaining_styles(session)
+                    finally:
+                        stream_db.close()
+                    if delivered:
+                        await _consume_prefetched(request, event["data"])
+                yield _sse(event["event"], event["data"])
+            if delivered:
+                # После стрима: фоновые вызовы не должны попасть в сводку llm_usage анализа
+                _prefetch_remaining_styles(request, *delivered)
+        except httpx.HTTPError as exc:
+            yield _sse("error", {"status_code": 400, "detail": f"Ошибка скачивания: {exc}"})
+        except ValueError as exc:
+            yield _sse("error", {"status_code": 400, "detail": str(exc)})
+        except Exception as exc:
+            yield _sse("error", {"status_code": 500, "detail": str(exc)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # отключаем буферизацию nginx
+        },
+    )
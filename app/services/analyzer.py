@@ -1,14 +1,22 @@
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 import re
 import asyncio
 import json
 import os
 
 import httpx
-from bs4 import BeautifulSoup
-from starlette.concurrency import run_in_threadpool
 
-from app.services.llm_client import LLMClient
+from app.services.html_cleaner import html_cleaner
+from app.services.http_fetch import page_fetcher
+from app.services.llm_client import AsyncLLMClient
+from app.services.json_stream import extract_string_items
+from app.services.llm_metrics import llm_metrics
+from app.services.llm_schemas import POSTS_SCHEMA, STEPS_SCHEMA
+from app.services.map_reduce import map_reduce
+from app.services.retrieval import step_retriever
+from app.services.site_crawler import site_crawler
+from app.services.style_prefetcher import style_prefetcher
+from app.services.token_budget import token_budget
 try:
     from app.services.cache import cache_service
     CACHE_AVAILABLE = True
@@ -19,51 +27,305 @@ except ImportError:
 # ВРЕМЕННО ОТКЛЮЧЕНО: для работы с реальными LLM моделями
 TEST_MODE = False  # os.getenv("TEST_MODE", "false").lower() == "true"  # Обходы отключены, но код оставлен для тестирования
 
+# Хранить разобранные страницы с ETag / Last-Modified и проверять их условным запросом
+PAGE_CACHE_ENABLED = os.getenv("PAGE_CACHE_ENABLED", "true").lower() == "true"
+
+# Текст сайта для шага анализа: full - весь (в бюджете run_step), retrieval - только
+# относящиеся к шагу фрагменты, auto - фрагменты, если текст длиннее RETRIEVAL_AUTO_MIN_TOKENS.
+# По умолчанию full: общее начало запросов шагов берётся из кэша контекста провайдера,
+# и в пределах бюджета run_step это дешевле своих фрагментов у каждого шага
+STEP_CONTEXT_MODE = os.getenv("STEP_CONTEXT_MODE", "full").lower()
+
+# Запускать шаги анализа по мере того, как get_steps их дописывает (поток), а не после всего плана
+STEP_PIPELINE_ENABLED = os.getenv("STEP_PIPELINE_ENABLED", "true").lower() == "true"
+
+# Лимит ответа финализации: три поста по 400-800 знаков на русском не влезают в 1024 токена
+FINALIZE_MAX_TOKENS = int(os.getenv("LLM_FINALIZE_MAX_TOKENS", "2048"))
+
+# Бюджет сводки результатов шагов для финализации (токены модели finalize);
+# сводка - общее начало запросов всех постов и стилей
+FINALIZE_BRIEF_TOKENS = int(os.getenv("LLM_FINALIZE_BRIEF_TOKENS", "6000"))
+
+# Финализация: single - три поста одним запросом, parallel - каждый пост отдельным
+# одновременным запросом (время этапа - как у одного поста, входные токены - втрое)
+FINALIZE_MODE = os.getenv("FINALIZE_MODE", "single").lower()
+# Лимит ответа одного поста в режиме parallel
+FINALIZE_POST_MAX_TOKENS = int(os.getenv("LLM_FINALIZE_POST_MAX_TOKENS", "1024"))
+
+# Акценты вариантов в режиме parallel: запросы не видят друг друга, и без
+# разных акцентов три поста получаются почти одинаковыми
+FINALIZE_POST_ANGLES = [
+    "Акцент: главное предложение компании и выгода для клиента.",
+    "Акцент: конкретные факты, цифры, примеры и кейсы из анализа.",
+    "Акцент: ситуация или проблема читателя и то, как компания её решает.",
+]
+
 
 class SiteAnalyzer:
-    def __init__(self, llm_client: LLMClient) -> None:
+    # Намерение этапа; провайдера выбирает политика маршрутизации LLM-клиента
+    # (по умолчанию fast_json - GPT-4o, long_context - DeepSeek)
+    STAGE_INTENTS = {
+        "get_steps": "fast_json",
+        "map_chunk": "long_context",
+        "run_step": "long_context",
+        "finalize": "fast_json",
+    }
+
+    def __init__(self, llm_client: AsyncLLMClient) -> None:
         self.llm = llm_client
+        self.step_context_mode = STEP_CONTEXT_MODE
 
     async def fetch_html(self, url: str) -> str:
-        timeout = httpx.Timeout(20.0)
-        async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            return resp.text
-
-    def html_to_text(self, html: str) -> Tuple[str, bool, Optional[str]]:
-        soup = BeautifulSoup(html, "html.parser")
-        for tag in soup(["script", "style", "noscript"]):
-            tag.decompose()
-        text = soup.get_text(separator="\n")
-        lines = [line.strip() for line in text.splitlines()]
-        chunks = [chunk for line in lines for chunk in line.split("  ")]
-        cleaned = "\n".join(chunk for chunk in chunks if chunk)
-
-        # Умное усечение - если сайт слишком большой, берём первые 40 000 символов
-        max_len = 40000
-        truncated = False
-        truncation_message: Optional[str] = None
-        if len(cleaned) > max_len:
-            cleaned = cleaned[:max_len] + "..."
-            truncated = True
-            truncation_message = "Объем сайта слишком велик. Для анализа взято 40 000 символов текста."
+        # Общий клиент воркера: соединения к сайту переиспользуются между запросами
+        return await page_fetcher.fetch_html(url)
 
-        return cleaned, truncated, truncation_message
+    async def html_to_text(self, html: str) -> Tuple[str, bool, Optional[str]]:
+        page = await self._clean_page(html)
+        return await self._prepare_text(page["text"])
 
-    async def get_steps(self, cleaned_text: str) -> List[str]:
+    async def _clean_page(self, html: str, base_url: Optional[str] = None) -> Dict[str, Any]:
+        """Основной текст страницы (и её ссылки, если указан base_url)."""
+        # Разбор HTML - в пуле процессов, чтобы не останавливать event loop воркера
+        page = await html_cleaner.clean(html, base_url)
+        report = page["report"]
+        print(
+            f"[SiteAnalyzer] Content: html {report['html_chars']} -> text {report['text_chars']}"
+            f" -> main {report['content_chars']} chars (removed blocks: {report['removed_blocks']},"
+            f" duplicate lines: {report['duplicate_lines']})"
+        )
+        return page
+
+    async def _load_page(self, url: str) -> Dict[str, Any]:
+        """
+        Скачать и разобрать страницу: {"etag", "last_modified", "text", "links"}.
+        Разобранная страница хранится в кэше вместе с валидаторами сайта
+        (ETag / Last-Modified). Повторная загрузка - условный запрос: если сайт
+        ответил 304, текст берётся из кэша без скачивания тела и без разбора.
+        """
+        cached = None
+        if PAGE_CACHE_ENABLED and CACHE_AVAILABLE:
+            cached = await cache_service.get_page(url)
+        fetched = await page_fetcher.fetch_page(
+            url,
+            etag=cached.get("etag") if cached else None,
+            last_modified=cached.get("last_modified") if cached else None,
+        )
+        if fetched["not_modified"] and cached:
+            print(f"[SiteAnalyzer] {url}: not modified (304), reusing parsed text")
+            return cached
+        if not fetched["text"]:
+            raise ValueError("Не удалось скачать HTML")
+
+        parsed = await self._clean_page(fetched["text"], base_url=fetched["url"])
+        page = {
+            "etag": fetched["etag"],
+            "last_modified": fetched["last_modified"],
+            "text": parsed["text"],
+            "links": parsed["links"],
+        }
+        # Без валидаторов сайт не ответит 304 - хранить незачем
+        if PAGE_CACHE_ENABLED and CACHE_AVAILABLE and (page["etag"] or page["last_modified"]):
+            await cache_service.set_page(url, page)
+        return page
+
+    async def crawl_site(self, url: str) -> Tuple[str, bool, Optional[str]]:
+        """
+        Режим crawl: текст url и ещё нескольких страниц сайта (из sitemap.xml и ссылок url)
+        одним корпусом в пределах бюджета токенов. Страницы загружаются параллельно
+        (не больше FETCH_PER_HOST_CONCURRENCY одновременно); что не успело за
+        CRAWL_TIME_BUDGET, в анализ не попадает. Бюджет отсчитывается с загрузки
+        исходной страницы: если не успела и она - httpx.TimeoutException.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + site_crawler.time_budget
+        sitemap_task = asyncio.ensure_future(site_crawler.sitemap_urls(url))
+        try:
+            start_page = await asyncio.wait_for(self._load_page(url), timeout=site_crawler.time_budget)
+        except BaseException as exc:
+            sitemap_task.cancel()
+            await asyncio.gather(sitemap_task, return_exceptions=True)
+            if isinstance(exc, asyncio.TimeoutError):
+                raise httpx.TimeoutException(
+                    f"страница не загрузилась за {site_crawler.time_budget:.0f} с (CRAWL_TIME_BUDGET)"
+                ) from exc
+            raise
+        try:
+            sitemap = await asyncio.wait_for(sitemap_task, timeout=max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            # Без sitemap страницы выбираются по ссылкам исходной
+            print("[SiteAnalyzer] Crawl: sitemap did not load in time, using page links only")
+            sitemap = []
+        candidates = site_crawler.rank(url, start_page["links"], sitemap)
+
+        async def load(page_url: str) -> str:
+            page = await self._load_page(page_url)
+            return page["text"]
+
+        texts: Dict[str, str] = {}
+        tasks = {asyncio.ensure_future(load(page_url)): page_url for page_url in candidates}
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=max(deadline - loop.time(), 0))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if task.exception() is None:
+                    texts[tasks[task]] = task.result()
+                else:
+                    print(f"[SiteAnalyzer] Crawl: skipped {tasks[task]}: {task.exception()}")
+            if pending:
+                print(f"[SiteAnalyzer] Crawl: {len(pending)} page(s) did not load in {site_crawler.time_budget:.0f}s")
+
+        pages = [(url, start_page["text"])] + [(page_url, texts[page_url]) for page_url in candidates if page_url in texts]
+        model = self.llm.model_for(intent=self.STAGE_INTENTS["run_step"])
+        corpus, report = site_crawler.merge(pages, model, max(token_budget.budgets.values()))
+        print(
+            f"[SiteAnalyzer] Crawl: {len(report['pages'])} page(s), {report['chars']} chars"
+            f" (candidates: {len(candidates)}, duplicate lines: {report['duplicate_lines']},"
+            f" near-duplicate pages: {report['skipped_duplicate_pages']})"
+        )
+        return self._fit_to_budgets(corpus)
+
+    def _fit_to_budgets(self, text: str) -> Tuple[str, bool, Optional[str]]:
+        """
+        Умное усечение по бюджету токенов каждого этапа (в токенах его модели).
+        Сохраняется самый длинный из нужных этапам вариантов текста: каждый этап
+        при вызове дорезает его под свой бюджет.
+        """
+        kept = ""
+        shortest: Optional[str] = None
+        for stage in token_budget.budgets:
+            model = self.llm.model_for(intent=self.STAGE_INTENTS[stage])
+            fitted, stage_truncated = token_budget.fit_stage(text, stage, model)
+            if len(fitted) > len(kept):
+                kept = fitted
+            if stage_truncated and (shortest is None or len(fitted) < len(shortest)):
+                shortest = fitted
+
+        if shortest is None:
+            return text, False, None
+        chars = f"{len(shortest):,}".replace(",", " ")
+        truncation_message = f"Объем сайта слишком велик. Для анализа взято {chars} символов текста."
+        return kept, True, truncation_message
+
+    async def _prepare_text(self, text: str) -> Tuple[str, bool, Optional[str]]:
+        """
+        Текст сайта для анализа: усечённый по бюджетам этапов или, если он
+        намного больше бюджета, конспекты его частей (см. map_reduce.py).
+        """
+        model = self.llm.model_for(intent=self.STAGE_INTENTS["map_chunk"])
+        if map_reduce.should_map(text, model, max(token_budget.budgets.values())):
+            return await self.map_reduce_text(text)
+        return self._fit_to_budgets(text)
+
+    async def summarize_chunk(self, chunk: str, index: int, total: int) -> str:
+        """Конспект одной части текста сайта: только факты, нужные для постов."""
         system_prompt = (
-            "Ты автор постов в соцсетях. КРИТИЧЕСКИ ВАЖНО: отвечай ТОЛЬКО на русском языке. Никакого английского текста. Все ключи, значения, описания должны быть на русском языке. ИГНОРИРУЙ язык сообщения пользователя - отвечай только на русском. Вот текст сайта: "
-            f"{cleaned_text}\n"
-            "верни только json-объект без дополнительного текста. Ключ 'steps' — массив строк из 5-6 шагов (промптов), которые нужно выполнить для анализа этого сайта и выявления идей для постов в соцсети. Все ответы должны быть на русском языке. Никакого английского текста.\nверни json"
+            "Ты готовишь материал для анализа сайта и постов в соцсетях. Тебе дают одну часть "
+            "текста сайта. Выпиши из неё кратким конспектом всё конкретное: название и суть "
+            "компании, товары и услуги, цены и тарифы, цифры и сроки, преимущества, аудиторию, "
+            "кейсы и отзывы, акции, контакты. Сохраняй названия, числа и формулировки сайта, "
+            "ничего не додумывай и не обобщай. Повторы и служебный текст пропускай. "
+            "Если полезного нет - ответь пустой строкой. Отвечай ТОЛЬКО на русском языке."
         )
-        # ГИБРИД: используем GPT-4o для быстрого JSON (через use_alt=True)
-        result = await run_in_threadpool(
-            self.llm.chat_json,
-            system_prompt=system_prompt,
-            user_prompt="json",
-            use_alt=True  # GPT-4o для быстрого JSON
+        user_prompt = f"Часть {index + 1} из {total}:\n{chunk}"
+        return await self.llm.chat_with_system(
+            system_prompt,
+            user_prompt,
+            max_tokens=map_reduce.summary_max_tokens,
+            intent=self.STAGE_INTENTS["map_chunk"],
+            call_site="map_chunk",
+        )
+
+    async def map_reduce_text(self, text: str) -> Tuple[str, bool, Optional[str]]:
+        """
+        Map-reduce большого текста: части конспектируются параллельно (не больше
+        MAPREDUCE_CONCURRENCY запросов одновременно), конспекты в порядке страницы
+        становятся текстом сайта для get_steps и шагов. Часть, которую не удалось
+        законспектировать, пропускается; если не удалось ни одной - обычное усечение.
+        """
+        model = self.llm.model_for(intent=self.STAGE_INTENTS["map_chunk"])
+        chunks, dropped_chars = map_reduce.split(text, model)
+        semaphore = asyncio.Semaphore(map_reduce.concurrency)
+
+        async def summarize(index: int, chunk: str) -> str:
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(
+                        self.summarize_chunk(chunk, index, len(chunks)),
+                        timeout=map_reduce.chunk_timeout,
+                    )
+                except Exception as exc:
+                    print(f"[SiteAnalyzer] Map-reduce: chunk {index + 1}/{len(chunks)} failed: {exc!r}")
+                    return ""
+
+        print(f"[SiteAnalyzer] Map-reduce: {len(text)} chars -> {len(chunks)} chunk(s)")
+        summaries = await asyncio.gather(*[summarize(i, chunk) for i, chunk in enumerate(chunks)])
+        failed = sum(1 for summary in summaries if not summary.strip())
+        if failed == len(summaries):
+            print("[SiteAnalyzer] Map-reduce: no summaries, falling back to truncation")
+            return self._fit_to_budgets(text)
+
+        merged = map_reduce.merge(summaries)
+        print(
+            f"[SiteAnalyzer] Map-reduce: {len(chunks) - failed}/{len(chunks)} summaries, {len(merged)} chars"
+            f" (dropped tail: {dropped_chars} chars)"
         )
+        cleaned_text, truncated, truncation_message = self._fit_to_budgets(merged)
+        if dropped_chars:
+            chars = f"{len(text) - dropped_chars:,}".replace(",", " ")
+            truncated = True
+            truncation_message = f"Объем сайта слишком велик. Для анализа по частям взято {chars} символов текста."
+        return cleaned_text, truncated, truncation_message
+
+    def _stage_text(self, cleaned_text: str, stage: str) -> str:
+        """Текст сайта в пределах бюджета токенов этапа."""
+        text, _ = token_budget.fit_stage(cleaned_text, stage, self.llm.model_for(intent=self.STAGE_INTENTS[stage]))
+        return text
+
+    def _step_context(self, cleaned_text: str, step_prompt: str) -> str:
+        """
+        Текст сайта для шага: целиком (в бюджете run_step) или только фрагменты,
+        относящиеся к формулировке шага (см. retrieval.py). Фрагменты у каждого шага
+        свои, поэтому кэш контекста провайдера на шагах не работает - режим auto
+        включает отбор только для длинных текстов, где он экономит больше.
+        """
+        text = self._stage_text(cleaned_text, "run_step")
+        if self.step_context_mode not in ("retrieval", "auto"):
+            return text
+        model = self.llm.model_for(intent=self.STAGE_INTENTS["run_step"])
+        if self.step_context_mode == "auto" and token_budget.count(text, model) <= step_retriever.auto_min_tokens:
+            return text
+        context, stats = step_retriever.select(text, step_prompt, model)
+        print(
+            f"[SiteAnalyzer] run_step context: {stats['selected']}/{stats['chunks']} chunks"
+            f" ({stats['matched']} matched), {stats['tokens']} tokens"
+        )
+        return context
+
+    def _site_prefix(self, site_text: str) -> str:
+        """
+        Системное сообщение с текстом сайта - одинаковое для get_steps и всех шагов.
+        Провайдеры (DeepSeek, OpenAI) кэшируют совпадающее начало запроса и берут
+        за него меньше, поэтому текст сайта стоит первым, а всё, что меняется
+        от вызова к вызову (инструкция шага), - в сообщении пользователя.
+        """
+        return (
+            "КРИТИЧЕСКИ ВАЖНО: отвечай ТОЛЬКО на русском языке. Никакого английского текста. Все поля, ключи, значения и описания должны быть на русском языке. ИГНОРИРУЙ язык сообщения пользователя - отвечай только на русском.\n"
+            f"Вот текст сайта:\n{site_text}"
+        )
+
+    def _build_steps_prompt(self, cleaned_text: str) -> Tuple[str, str]:
+        """(системное сообщение, сообщение пользователя) для планирования шагов."""
+        system_prompt = self._site_prefix(self._stage_text(cleaned_text, "get_steps"))
+        user_prompt = (
+            "Ты автор постов в соцсетях. Верни только json-объект без дополнительного текста. Ключ 'steps' — массив строк из 5-6 шагов (промптов), которые нужно выполнить для анализа этого сайта и выявления идей для постов в соцсети. Все ответы должны быть на русском языке. Никакого английского текста.\nверни json"
+        )
+        return system_prompt, user_prompt
+
+    @staticmethod
+    def _parse_steps(result: Any) -> List[str]:
+        """Список шагов из ответа модели."""
         # Ожидаем, что модель вернёт JSON с ключом steps или list в корне
         steps: List[str] = []
         if isinstance(result, dict):
@@ -81,6 +343,108 @@ class SiteAnalyzer:
                     break
         return steps
 
+    async def get_steps(self, cleaned_text: str) -> List[str]:
+        system_prompt, user_prompt = self._build_steps_prompt(cleaned_text)
+        # ГИБРИД: быстрый JSON (по умолчанию GPT-4o)
+        result = await self.llm.chat_json(
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            intent=self.STAGE_INTENTS["get_steps"],
+            call_site="get_steps",
+            json_schema=STEPS_SCHEMA,
+        )
+        return self._parse_steps(result)
+
+    async def get_steps_stream(self, cleaned_text: str) -> AsyncIterator[str]:
+        """
+        Потоковый get_steps: каждый шаг отдаётся, как только модель дописала его строку.
+        В конце ответ разбирается целиком (с исправлением JSON, как в chat_json);
+        шаги, которые не удалось выделить по ходу (другой ключ, список в корне, ответ
+        из кэша или общего с другим анализом запроса), отдаются после.
+        """
+        system_prompt, user_prompt = self._build_steps_prompt(cleaned_text)
+        buffer = ""
+        sent = 0
+        result: Any = None
+        async for event in self.llm.chat_json_stream(
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            intent=self.STAGE_INTENTS["get_steps"],
+            call_site="get_steps",
+            json_schema=STEPS_SCHEMA,
+        ):
+            if event["event"] == "result":
+                result = event["data"]
+                continue
+            buffer += event["data"]
+            steps = extract_string_items(buffer, "steps")
+            while sent < len(steps):
+                yield steps[sent]
+                sent += 1
+
+        for step in self._parse_steps(result)[sent:]:
+            yield step
+
+    async def _planned_steps(self, cleaned_text: str) -> AsyncIterator[str]:
+        """Шаги анализа по мере планирования (STEP_PIPELINE_ENABLED) или все сразу."""
+        if STEP_PIPELINE_ENABLED:
+            async for step in self.get_steps_stream(cleaned_text):
+                yield step
+        else:
+            for step in await self.get_steps(cleaned_text):
+                yield step
+
+    async def _plan_and_run_steps(self, cleaned_text: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Планирование и выполнение шагов внахлёст: run_step_safe каждого шага
+        запускается, как только шаг получен от get_steps, не дожидаясь остальных.
+        События: step_planned {index, step}; steps_planned {steps} - план готов;
+        step_done {index, step, result} - в порядке завершения шагов.
+        Если план оборвался после первых шагов, анализ продолжается с ними.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        steps: List[str] = []
+        tasks: List[asyncio.Task] = []
+
+        async def run_indexed(index: int, step: str) -> None:
+            result = await self.run_step_safe(step, cleaned_text)
+            queue.put_nowait({"event": "step_done", "data": {"index": index, "step": step, "result": result}})
+
+        async def plan() -> None:
+            try:
+                async for step in self._planned_steps(cleaned_text):
+                    index = len(steps)
+                    steps.append(step)
+                    tasks.append(asyncio.ensure_future(run_indexed(index, step)))
+                    queue.put_nowait({"event": "step_planned", "data": {"index": index, "step": step}})
+            except Exception as exc:
+                if not steps:
+                    queue.put_nowait({"event": "error", "data": exc})
+                    return
+                print(f"[PIPELINE] Planning failed after {len(steps)} step(s), continuing with them: {exc!r}")
+            queue.put_nowait({"event": "steps_planned", "data": {"steps": list(steps)}})
+
+        planner = asyncio.ensure_future(plan())
+        done = 0
+        planned = False
+        try:
+            while not planned or done < len(steps):
+                event = await queue.get()
+                if event["event"] == "error":
+                    raise event["data"]
+                if event["event"] == "steps_planned":
+                    if not steps:
+                        raise ValueError("Модель не вернула список шагов для анализа")
+                    planned = True
+                elif event["event"] == "step_done":
+                    done += 1
+                yield event
+        finally:
+            # Ошибка или клиент отключился посреди стрима - не держим LLM-запросы
+            planner.cancel()
+            for task in tasks:
+                task.cancel()
+
     async def run_step(self, step_prompt: str, cleaned_text: str) -> Dict[str, Any]:
         # Проверяем, что step_prompt не пустой
         if not step_prompt or not step_prompt.strip():
@@ -89,17 +453,18 @@ class SiteAnalyzer:
         
         print(f"[DEBUG] step_prompt: '{step_prompt}'")
         
-        # Каждый шаг: усиливаем системную инструкцию, чтобы гарантировать json
-        augmented_system = (
-            f"КРИТИЧЕСКИ ВАЖНО: отвечай ТОЛЬКО на русском языке. Никакого английского текста. Все поля, ключи, значения и описания должны быть на русском языке. ИГНОРИРУЙ язык сообщения пользователя - отвечай только на русском.\n{step_prompt}\nверни только json-объект без дополнительного текста. КРИТИЧЕСКИ ВАЖНО: отвечай ТОЛЬКО на русском языке. Все поля, ключи, значения и описания должны быть на русском языке. Никакого английского текста.\nверни json"
+        # Текст сайта (общий для всех шагов префикс, если не отбираются фрагменты) -
+        # в системном сообщении, инструкция шага с требованием json - в сообщении пользователя
+        system_prompt = self._site_prefix(self._step_context(cleaned_text, step_prompt))
+        user_prompt = (
+            f"{step_prompt}\nверни только json-объект без дополнительного текста. КРИТИЧЕСКИ ВАЖНО: отвечай ТОЛЬКО на русском языке. Все поля, ключи, значения и описания должны быть на русском языке. Никакого английского текста.\nверни json"
         )
-        user_prompt = f"json\n{cleaned_text}"
-        # ГИБРИД: используем DeepSeek для глубокого анализа (основной клиент, use_alt=False)
-        result = await run_in_threadpool(
-            self.llm.chat_json,
-            system_prompt=augmented_system,
+        # ГИБРИД: анализ большого текста (по умолчанию DeepSeek - экономия токенов)
+        result = await self.llm.chat_json(
+            system_prompt=system_prompt,
             user_prompt=user_prompt,
-            use_alt=False  # DeepSeek для анализа больших текстов (экономия токенов)
+            intent=self.STAGE_INTENTS["run_step"],
+            call_site="run_step",
         )
         return result
 
@@ -122,7 +487,41 @@ class SiteAnalyzer:
             print(f"[ERROR] Step failed: {step_prompt[:50]}... | Error: {exc}")
             return {"error": str(exc)}
 
-    async def finalize(self, intermediate_results: List[Dict[str, Any]], cleaned_text: str, style: str = "убедительно-позитивном", occasion: str = "") -> Dict[str, Any]:
+    def _analysis_brief(self, intermediate_results: List[Dict[str, Any]]) -> str:
+        """
+        Сводка результатов анализа для финализации: строится один раз на вызов
+        finalize и одинакова для всех вариантов постов и всех стилей. Вместо repr
+        словарей - шаг и компактный JSON его результата без неудавшихся шагов;
+        каждый шаг укладывается в свою долю FINALIZE_BRIEF_TOKENS.
+        """
+        done = [item for item in intermediate_results if "result" in item]
+        if not done:
+            return "(анализ сайта не дал результатов)"
+        model = self.llm.model_for(intent=self.STAGE_INTENTS["finalize"])
+        share = max(FINALIZE_BRIEF_TOKENS // len(done), 1)
+        parts = []
+        for index, item in enumerate(done, 1):
+            result = json.dumps(item["result"], ensure_ascii=False, separators=(",", ":"), default=str)
+            part, _ = token_budget.fit(f"{index}. {item['step']}\n{result}", model, share)
+            parts.append(part)
+        return "\n\n".join(parts)
+
+    def _build_finalize_prompt(
+        self,
+        brief: str,
+        style: str,
+        occasion: str,
+        variant: Optional[int] = None
+    ) -> Tuple[str, str]:
+        """
+        (системное сообщение, сообщение пользователя) для финализации.
+        brief - сводка анализа (_analysis_brief). Системное сообщение - сводка и общие
+        требования к постам - одинаково для всех стилей и для обоих режимов: это общий
+        префикс, который провайдер берёт из кэша контекста (в режиме parallel три
+        одновременных запроса отличаются только сообщением пользователя).
+        Задача, стиль, инфоповод и акцент варианта - в сообщении пользователя.
+        variant - номер поста в режиме parallel: запрос одного поста со своим акцентом.
+        """
         # Детальные описания стилей для LLM
         style_guidelines = {
             "убедительно-позитивном": "Используй мотивирующие слова, позитивные формулировки, призывы к действию. Подчеркивай преимущества и возможности. Тон: вдохновляющий, оптимистичный, энергичный.",
@@ -147,33 +546,290 @@ class SiteAnalyzer:
                 f"Адаптируй содержание под этот контекст, делай акценты на том, как информация с сайта связана с данным поводом.\n"
             )
         
+        if variant is None:
+            task = "Объедини результаты анализа и создай три варианта постов для соцсети в стиле, указанном ниже. "
+            structure = "\"posts\": [string, string, string]}. "
+            request = f"Создай три варианта постов для соцсети в {style} стиле. "
+            each = "Каждый пост должен явно отражать характерные черты выбранного стиля."
+        else:
+            task = "Объедини результаты анализа и создай один пост для соцсети в стиле и с акцентом, указанными ниже. "
+            structure = "\"posts\": [string]} - ровно один пост. "
+            request = (
+                f"Создай один пост для соцсети в {style} стиле (вариант {variant + 1} из {len(FINALIZE_POST_ANGLES)}). "
+                f"{FINALIZE_POST_ANGLES[variant]} "
+            )
+            each = "Пост должен явно отражать характерные черты выбранного стиля."
+        
         system_prompt = (
-            "Ты талантливый копирайтер. У тебя есть результаты промежуточного анализа сайта: "
-            f"{intermediate_results}. "
-            f"Объедини их и создай три варианта постов для соцсети в {style} стиле. "
-            f"{occasion_instruction}"
-            f"\n\nОСОБЕННОСТИ {style.upper()} СТИЛЯ: {style_instruction}\n\n"
-            "СТРОГО следуй этому стилю! Каждый пост должен явно отражать характерные черты выбранного стиля. "
-            "верни только json-объект без дополнительного текста. Структура: {"
-            "\"posts\": [string, string, string]} . "
+            "Ты талантливый копирайтер. Вот результаты промежуточного анализа сайта:\n"
+            f"{brief}\n\n"
+            "Требования к постам. "
             "КРИТИЧЕСКИ ВАЖНО: Каждая публикация ОБЯЗАТЕЛЬНО должна содержать минимум 400 и максимум 800 знаков (включая пробелы, эмодзи и все символы). "
             "Не делай посты короче 400 символов! Посты короче 400 символов будут отклонены. "
             "Делай посты содержательными, подробными и развернутыми. "
             "Используй эмодзи для повышения вовлеченности. "
             "Добавляй конкретные детали из анализа сайта. "
-            "ОБЯЗАТЕЛЬНО отвечай ТОЛЬКО на русском языке. Никакого английского текста.\njson"
+            "ОБЯЗАТЕЛЬНО отвечай ТОЛЬКО на русском языке. Никакого английского текста. Ответ - json"
         )
+        user_prompt = (
+            f"{task}"
+            "Верни только json-объект без дополнительного текста. Структура: {"
+            f"{structure}\n"
+            f"{request}"
+            f"{occasion_instruction}"
+            f"\n\nОСОБЕННОСТИ {style.upper()} СТИЛЯ: {style_instruction}\n\n"
+            f"СТРОГО следуй этому стилю! {each}\njson"
+        )
+        return system_prompt, user_prompt
+
+    async def finalize(self, intermediate_results: List[Dict[str, Any]], cleaned_text: str, style: str = "убедительно-позитивном", occasion: str = "") -> Dict[str, Any]:
         # ОПТИМИЗАЦИЯ: НЕ передаём cleaned_text - вся информация уже в intermediate_results!
-        user_prompt = "json"
-        # ГИБРИД: используем GPT-4o для финального JSON (через use_alt=True)
-        result = await run_in_threadpool(
-            self.llm.chat_json,
+        brief = self._analysis_brief(intermediate_results)
+        if FINALIZE_MODE == "parallel":
+            return await self._finalize_parallel(brief, style, occasion)
+        return await self._finalize_single(brief, style, occasion)
+
+    async def _finalize_single(self, brief: str, style: str, occasion: str) -> Dict[str, Any]:
+        """Три поста одним запросом (режим single)."""
+        system_prompt, user_prompt = self._build_finalize_prompt(brief, style, occasion)
+        # ГИБРИД: быстрый финальный JSON (по умолчанию GPT-4o)
+        result = await self.llm.chat_json(
             system_prompt=system_prompt,
             user_prompt=user_prompt,
-            use_alt=True  # GPT-4o для быстрого финального JSON
+            max_tokens=FINALIZE_MAX_TOKENS,
+            intent=self.STAGE_INTENTS["finalize"],
+            call_site="finalize",
+            json_schema=POSTS_SCHEMA,
         )
         return result
 
+    @staticmethod
+    def _first_post(result: Any) -> Optional[str]:
+        """Пост из ответа на запрос одного варианта (модель может вернуть и несколько)."""
+        if isinstance(result, dict):
+            posts = result.get("posts")
+            if isinstance(posts, list):
+                for post in posts:
+                    if isinstance(post, str) and post.strip():
+                        return post
+            if isinstance(result.get("post"), str) and result["post"].strip():
+                return result["post"]
+        return None
+
+    async def _complete_posts(
+        self,
+        brief: str,
+        style: str,
+        occasion: str,
+        posts: List[Optional[str]],
+        errors: List[BaseException],
+    ) -> List[str]:
+        """
+        Все посты режима parallel: вариант, который не удалось получить, запрашивается
+        ещё раз, а если и повтор не удался - недостающие посты берутся из обычной
+        финализации одним запросом. Меньше постов, чем вариантов, не возвращаем.
+        """
+        missing = [variant for variant, post in enumerate(posts) if not post]
+        if not missing:
+            return list(posts)
+        print(f"[FINALIZE] {len(missing)} of {len(posts)} post(s) failed, retrying: {errors!r}")
+        retries = await asyncio.gather(
+            *[self.finalize_post(brief, style, occasion, variant) for variant in missing],
+            return_exceptions=True,
+        )
+        for variant, outcome in zip(missing, retries):
+            if isinstance(outcome, asyncio.CancelledError):
+                raise outcome
+            if not isinstance(outcome, BaseException) and outcome:
+                posts[variant] = outcome
+        missing = [variant for variant, post in enumerate(posts) if not post]
+        if missing:
+            print(f"[FINALIZE] {len(missing)} post(s) failed again, falling back to single finalize")
+            fallback = await self._finalize_single(brief, style, occasion)
+            spare = [post for post in (fallback.get("posts") or []) if isinstance(post, str) and post.strip()]
+            # Пост того же номера: у соседних вариантов свои акценты, повторов меньше
+            for variant in missing:
+                if variant < len(spare):
+                    posts[variant] = spare[variant]
+        if not all(posts):
+            raise ValueError("Модель не вернула нужное число постов")
+        return list(posts)
+
+    async def finalize_post(self, brief: str, style: str, occasion: str, variant: int) -> Optional[str]:
+        """Один пост (режим parallel): вариант variant со своим акцентом."""
+        system_prompt, user_prompt = self._build_finalize_prompt(brief, style, occasion, variant)
+        result = await self.llm.chat_json(
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            max_tokens=FINALIZE_POST_MAX_TOKENS,
+            intent=self.STAGE_INTENTS["finalize"],
+            call_site="finalize",
+            json_schema=POSTS_SCHEMA,
+        )
+        return self._first_post(result)
+
+    async def _finalize_parallel(self, brief: str, style: str, occasion: str) -> Dict[str, Any]:
+        """Три поста тремя одновременными запросами с общим началом (сводка анализа)."""
+        outcomes = await asyncio.gather(
+            *[self.finalize_post(brief, style, occasion, variant) for variant in range(len(FINALIZE_POST_ANGLES))],
+            return_exceptions=True,
+        )
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        for error in errors:
+            if isinstance(error, asyncio.CancelledError):
+                raise error
+        posts = [None if isinstance(o, BaseException) else o for o in outcomes]
+        return {"posts": await self._complete_posts(brief, style, occasion, posts, errors)}
+
+    async def finalize_stream(
+        self,
+        intermediate_results: List[Dict[str, Any]],
+        style: str = "убедительно-позитивном",
+        occasion: str = ""
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Потоковая финализация. События:
+        - delta: очередной фрагмент ответа модели (в режиме parallel - с index поста);
+        - post: пост полностью сгенерирован (остальные ещё пишутся);
+        - final: разобранный JSON {"posts": [...]}, как у finalize().
+        """
+        brief = self._analysis_brief(intermediate_results)
+        if FINALIZE_MODE == "parallel":
+            async for event in self._finalize_parallel_stream(brief, style, occasion):
+                yield event
+            return
+        system_prompt, user_prompt = self._build_finalize_prompt(brief, style, occasion)
+        buffer = ""
+        posts_sent = 0
+        final: Any = None
+        async for event in self.llm.chat_json_stream(
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            max_tokens=FINALIZE_MAX_TOKENS,
+            intent=self.STAGE_INTENTS["finalize"],
+            call_site="finalize",
+            json_schema=POSTS_SCHEMA,
+        ):
+            if event["event"] == "result":
+                final = event["data"]
+                continue
+            delta = event["data"]
+            buffer += delta
+            yield {"event": "delta", "data": {"text": delta}}
+            posts = extract_string_items(buffer, "posts")
+            while posts_sent < len(posts):
+                yield {"event": "post", "data": {"index": posts_sent, "text": posts[posts_sent]}}
+                posts_sent += 1
+
+        # Ответ из кэша (или общего запроса) приходит без фрагментов - посты отдаём из него
+        posts = final.get("posts") if isinstance(final, dict) else None
+        if isinstance(posts, list):
+            for index in range(posts_sent, len(posts)):
+                if isinstance(posts[index], str):
+                    yield {"event": "post", "data": {"index": index, "text": posts[index]}}
+        yield {"event": "final", "data": final}
+
+    async def _finalize_parallel_stream(
+        self,
+        brief: str,
+        style: str,
+        occasion: str
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Потоковый режим parallel: фрагменты трёх постов вперемешку, post - по готовности каждого."""
+        queue: asyncio.Queue = asyncio.Queue()
+        total = len(FINALIZE_POST_ANGLES)
+
+        async def stream_post(variant: int) -> None:
+            try:
+                system_prompt, user_prompt = self._build_finalize_prompt(brief, style, occasion, variant)
+                result: Any = None
+                async for event in self.llm.chat_json_stream(
+                    system_prompt=system_prompt,
+                    user_prompt=user_prompt,
+                    max_tokens=FINALIZE_POST_MAX_TOKENS,
+                    intent=self.STAGE_INTENTS["finalize"],
+                    call_site="finalize",
+                    json_schema=POSTS_SCHEMA,
+                ):
+                    if event["event"] == "result":
+                        result = event["data"]
+                    else:
+                        queue.put_nowait(("delta", variant, event["data"]))
+                queue.put_nowait(("post", variant, self._first_post(result)))
+            except Exception as exc:
+                queue.put_nowait(("error", variant, exc))
+
+        tasks = [asyncio.ensure_future(stream_post(variant)) for variant in range(total)]
+        posts: List[Optional[str]] = [None] * total
+        errors: List[BaseException] = []
+        finished = 0
+        try:
+            while finished < total:
+                kind, variant, value = await queue.get()
+                if kind == "delta":
+                    yield {"event": "delta", "data": {"index": variant, "text": value}}
+                    continue
+                finished += 1
+                if kind == "error":
+                    errors.append(value)
+                elif value:
+                    posts[variant] = value
+                    yield {"event": "post", "data": {"index": variant, "text": value}}
+        finally:
+            for task in tasks:
+                task.cancel()
+        missing = [variant for variant, post in enumerate(posts) if not post]
+        completed = await self._complete_posts(brief, style, occasion, posts, errors)
+        for variant in missing:
+            yield {"event": "post", "data": {"index": variant, "text": completed[variant]}}
+        yield {"event": "final", "data": {"posts": completed}}
+
+    @staticmethod
+    def _cache_url(url: str, crawl: bool) -> str:
+        """Ключ кэша текста и шагов: у обхода нескольких страниц свой текст и свои шаги."""
+        return f"{url}#crawl" if crawl else url
+
+    async def _load_cleaned_text(self, url: str, use_cached: bool, crawl: bool = False) -> Tuple[str, bool, Optional[str]]:
+        """Очищенный текст сайта: из кэша (если разрешено) или скачивание и парсинг."""
+        cache_url = self._cache_url(url, crawl)
+        # ВАЖНО: При первом входе (use_cached=False) НЕ используем кэш, даже если он есть
+        cleaned_text = None
+        if use_cached and CACHE_AVAILABLE:
+            # Используем кэш только если явно разрешено
+            cleaned_text = await cache_service.get_cleaned_text(cache_url)
+        
+        if cleaned_text:
+            return cleaned_text, False, None
+
+        if crawl:
+            cleaned_text, truncated, truncation_message = await self.crawl_site(url)
+        else:
+            # Парсим сайт (всегда при первом входе или если кэш пуст);
+            # неизменившаяся с прошлого раза страница не скачивается и не разбирается заново
+            page = await self._load_page(url)
+            cleaned_text, truncated, truncation_message = await self._prepare_text(page["text"])
+        if not cleaned_text.strip():
+            raise ValueError("Не удалось извлечь текст со страницы")
+        
+        # Сохраняем очищенный текст в кэш (если доступен)
+        # Используем only_if_not_exists для защиты от race condition:
+        # если другой пользователь уже сохранил этот URL, не перезаписываем
+        if CACHE_AVAILABLE:
+            await cache_service.set_cleaned_text(cache_url, cleaned_text, only_if_not_exists=True)
+        return cleaned_text, truncated, truncation_message
+
+    def _collect_intermediate(self, steps: List[str], results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сборка промежуточных результатов в порядке шагов."""
+        intermediate = []
+        for step, res in zip(steps, results):
+            if "error" in res:
+                intermediate.append({"step": step, "error": res["error"]})
+                print(f"[PARALLEL] Step failed: {step[:50]}...")
+            else:
+                intermediate.append({"step": step, "result": res})
+                print(f"[PARALLEL] Step completed: {step[:50]}...")
+        return intermediate
+
     async def analyze(
         self, 
         url: str, 
@@ -181,8 +837,27 @@ class SiteAnalyzer:
         occasion: str = "",
         use_cached: bool = False,
         cached_intermediate: Optional[List[Dict[str, Any]]] = None,
-        email: Optional[str] = None  # Email для привязки кэша к сеансу
+        email: Optional[str] = None,  # Email для привязки кэша к сеансу
+        crawl: bool = False  # Анализировать несколько страниц сайта, а не только url
+    ) -> Dict[str, Any]:
+        # Сводка по LLM-вызовам анализа: токены, задержки и стоимость по этапам
+        # Пока у воркера идут анализы, фоновая генерация стилей (style_prefetcher) ждёт
+        with style_prefetcher.foreground(), llm_metrics.collect() as calls:
+            result = await self._analyze(url, style, occasion, use_cached, cached_intermediate, email, crawl)
+        result["llm_usage"] = llm_metrics.summarize(calls)
+        return result
+
+    async def _analyze(
+        self,
+        url: str,
+        style: str,
+        occasion: str,
+        use_cached: bool,
+        cached_intermediate: Optional[List[Dict[str, Any]]],
+        email: Optional[str],
+        crawl: bool = False
     ) -> Dict[str, Any]:
+        cache_url = self._cache_url(url, crawl)
         # ТЕСТОВЫЙ РЕЖИМ: Зашунтирование блоков 14 и 15 для быстрого тестирования логики
         if TEST_MODE:
             print("[TEST_MODE] Пропускаем парсинг (блок 14) и генерацию (блок 15), возвращаем фиктивные данные")
@@ -203,8 +878,12 @@ class SiteAnalyzer:
             intermediate = cached_intermediate
             steps = [item.get("step", "") for item in intermediate]
             
-            # Только финализация с новым стилем и инфоповодом (cleaned_text не используется!)
-            final = await self.finalize(intermediate, cleaned_text, style, occasion)
+            # Только финализация с новым стилем и инфоповодом (cleaned_text не используется!);
+            # если посты этого стиля уже сгенерированы в фоне - отдаём их
+            final = await style_prefetcher.take(email, cache_url, style, occasion, intermediate)
+            prefetched = final is not None
+            if final is None:
+                final = await self.finalize(intermediate, cleaned_text, style, occasion)
             
             result = {
                 "url": url,
@@ -215,66 +894,38 @@ class SiteAnalyzer:
                 "final": final,
                 "truncated": truncated,
                 "truncation_message": truncation_message,
-                "cached": True  # Флаг что использовали кэш
+                "cached": True,  # Флаг что использовали кэш
+                "prefetched": prefetched  # Посты сгенерированы заранее (style_prefetcher)
             }
             
             # Сохраняем результат в кэш (если доступен)
             if CACHE_AVAILABLE:
-                await cache_service.set_analysis_result(url, style, occasion, result)
+                await cache_service.set_analysis_result(cache_url, style, occasion, result)
             return result
         
         # Обычный процесс
-        # ВАЖНО: При первом входе (use_cached=False) НЕ используем кэш, даже если он есть
-        cleaned_text = None
-        if use_cached and CACHE_AVAILABLE:
-            # Используем кэш только если явно разрешено
-            cleaned_text = await cache_service.get_cleaned_text(url)
-        
-        if cleaned_text:
-            truncated = False
-            truncation_message = None
-        else:
-            # Парсим сайт (всегда при первом входе или если кэш пуст)
-            html = await self.fetch_html(url)
-            if not html:
-                raise ValueError("Не удалось скачать HTML")
-
-            cleaned_text, truncated, truncation_message = self.html_to_text(html)
-            if not cleaned_text.strip():
-                raise ValueError("Не удалось извлечь текст со страницы")
-            
-            # Сохраняем очищенный текст в кэш (если доступен)
-            # Используем only_if_not_exists для защиты от race condition:
-            # если другой пользователь уже сохранил этот URL, не перезаписываем
-            if CACHE_AVAILABLE:
-                await cache_service.set_cleaned_text(url, cleaned_text, only_if_not_exists=True)
+        cleaned_text, truncated, truncation_message = await self._load_cleaned_text(url, use_cached, crawl)
 
         # Проверяем кэш промежуточных шагов (только если разрешено использование кэша)
         intermediate = None
         if use_cached and CACHE_AVAILABLE:
-            intermediate = await cache_service.get_intermediate_steps(url)
+            intermediate = await cache_service.get_intermediate_steps(cache_url)
         
         if intermediate:
             steps = [item.get("step", "") for item in intermediate]
         else:
-            steps = await self.get_steps(cleaned_text)
-            if not steps:
-                raise ValueError("Модель не вернула список шагов для анализа")
-
-            # 🚀 ПАРАЛЛЕЛЬНОЕ ВЫПОЛНЕНИЕ ШАГОВ для ускорения в 3-5 раз!
-            print(f"[PARALLEL] Starting {len(steps)} steps in parallel...")
-            tasks = [self.run_step_safe(step, cleaned_text) for step in steps]
-            results = await asyncio.gather(*tasks)
-            
+            # 🚀 ПАРАЛЛЕЛЬНОЕ ВЫПОЛНЕНИЕ ШАГОВ: каждый шаг стартует, как только спланирован
+            print("[PARALLEL] Planning and starting steps...")
+            steps = []
+            results_by_index: Dict[int, Dict[str, Any]] = {}
+            async for event in self._plan_and_run_steps(cleaned_text):
+                if event["event"] == "steps_planned":
+                    steps = event["data"]["steps"]
+                elif event["event"] == "step_done":
+                    results_by_index[event["data"]["index"]] = event["data"]["result"]
+
             # Собираем результаты (все уже Dict, ошибки обработаны в run_step_safe)
-            intermediate = []
-            for step, res in zip(steps, results):
-                if "error" in res:
-                    intermediate.append({"step": step, "error": res["error"]})
-                    print(f"[PARALLEL] Step failed: {step[:50]}...")
-                else:
-                    intermediate.append({"step": step, "result": res})
-                    print(f"[PARALLEL] Step completed: {step[:50]}...")
+            intermediate = self._collect_intermediate(steps, [results_by_index[i] for i in range(len(steps))])
             
             print(f"[PARALLEL] All {len(steps)} steps completed!")
             
@@ -282,9 +933,12 @@ class SiteAnalyzer:
             # Используем only_if_not_exists для защиты от race condition:
             # если другой пользователь уже сохранил этот URL, не перезаписываем
             if CACHE_AVAILABLE:
-                await cache_service.set_intermediate_steps(url, intermediate, only_if_not_exists=True)
+                await cache_service.set_intermediate_steps(cache_url, intermediate, only_if_not_exists=True)
 
-        final = await self.finalize(intermediate, cleaned_text, style, occasion)
+        final = await style_prefetcher.take(email, cache_url, style, occasion, intermediate)
+        prefetched = final is not None
+        if final is None:
+            final = await self.finalize(intermediate, cleaned_text, style, occasion)
 
         result = {
             "url": url,
@@ -295,14 +949,132 @@ class SiteAnalyzer:
             "final": final,
             "truncated": truncated,
             "truncation_message": truncation_message,
-            "cached": False  # Флаг что не использовали кэш
+            "cached": False,  # Флаг что не использовали кэш
+            "prefetched": prefetched
         }
         
         # Сохраняем результат в кэш (если доступен)
         if CACHE_AVAILABLE:
-            await cache_service.set_analysis_result(url, style, occasion, result)
+            await cache_service.set_analysis_result(cache_url, style, occasion, result)
         return result
 
+    async def analyze_stream(
+        self,
+        url: str,
+        style: str = "убедительно-позитивном",
+        occasion: str = "",
+        use_cached: bool = False,
+        cached_intermediate: Optional[List[Dict[str, Any]]] = None,
+        email: Optional[str] = None,
+        crawl: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Тот же анализ, что и analyze(), но с событиями по ходу выполнения:
+        fetched -> step_planned (на каждый шаг, по мере планирования) -> steps_planned
+        -> step_done (на каждый шаг; первые могут прийти до steps_planned) -> delta/post -> result.
+        Последнее событие result содержит тот же словарь, что возвращает analyze().
+        """
+        with style_prefetcher.foreground(), llm_metrics.collect() as calls:
+            async for event in self._analyze_stream(url, style, occasion, use_cached, cached_intermediate, email, crawl):
+                if event["event"] == "result":
+                    event["data"]["llm_usage"] = llm_metrics.summarize(calls)
+                yield event
+
+    async def _analyze_stream(
+        self,
+        url: str,
+        style: str,
+        occasion: str,
+        use_cached: bool,
+        cached_intermediate: Optional[List[Dict[str, Any]]],
+        email: Optional[str],
+        crawl: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        cache_url = self._cache_url(url, crawl)
+        if TEST_MODE:
+            yield {"event": "result", "data": self._get_mock_result(url, style, occasion)}
+            return
+
+        truncated = False
+        truncation_message = None
+        cached = bool(use_cached and cached_intermediate)
+
+        if cached:
+            # Как в analyze(): пропускаем парсинг и анализ, сразу финализация
+            intermediate = cached_intermediate
+            steps = [item.get("step", "") for item in intermediate]
+            yield {"event": "steps_planned", "data": {"steps": steps, "cached": True}}
+        else:
+            cleaned_text, truncated, truncation_message = await self._load_cleaned_text(url, use_cached, crawl)
+            yield {"event": "fetched", "data": {
+                "chars": len(cleaned_text),
+                "truncated": truncated,
+                "truncation_message": truncation_message,
+            }}
+
+            intermediate = None
+            if use_cached and CACHE_AVAILABLE:
+                intermediate = await cache_service.get_intermediate_steps(cache_url)
+
+            if intermediate:
+                steps = [item.get("step", "") for item in intermediate]
+                yield {"event": "steps_planned", "data": {"steps": steps, "cached": True}}
+            else:
+                steps = []
+                results: Dict[int, Dict[str, Any]] = {}
+                # Шаги отдаются в порядке завершения, каждый стартует сразу после планирования
+                pipeline = self._plan_and_run_steps(cleaned_text)
+                try:
+                    async for event in pipeline:
+                        if event["event"] == "step_planned":
+                            yield event
+                        elif event["event"] == "steps_planned":
+                            steps = event["data"]["steps"]
+                            yield {"event": "steps_planned", "data": {"steps": steps, "cached": False}}
+                        elif event["event"] == "step_done":
+                            index, res = event["data"]["index"], event["data"]["result"]
+                            results[index] = res
+                            yield {"event": "step_done", "data": {
+                                "index": index,
+                                "step": event["data"]["step"],
+                                "ok": "error" not in res,
+                            }}
+                finally:
+                    # Клиент отключился посреди стрима - сразу отменяем запущенные шаги
+                    await pipeline.aclose()
+
+                intermediate = self._collect_intermediate(steps, [results[i] for i in range(len(steps))])
+                if CACHE_AVAILABLE:
+                    await cache_service.set_intermediate_steps(cache_url, intermediate, only_if_not_exists=True)
+
+        final = await style_prefetcher.take(email, cache_url, style, occasion, intermediate)
+        prefetched = final is not None
+        if prefetched:
+            for index, post in enumerate(final.get("posts", [])):
+                yield {"event": "post", "data": {"index": index, "text": post}}
+        else:
+            async for event in self.finalize_stream(intermediate, style, occasion):
+                if event["event"] == "final":
+                    final = event["data"]
+                else:
+                    yield event
+
+        result = {
+            "url": url,
+            "style": style,
+            "occasion": occasion,
+            "steps": steps,
+            "intermediate_results": intermediate,
+            "final": final,
+            "truncated": truncated,
+            "truncation_message": truncation_message,
+            "cached": cached,
+            "prefetched": prefetched
+        }
+        if CACHE_AVAILABLE:
+            await cache_service.set_analysis_result(cache_url, style, occasion, result)
+        yield {"event": "result", "data": result}
+
     def _get_mock_result(self, url: str, style: str, occasion: str) -> Dict[str, Any]:
         """
         Возвращает фиктивные данные для тестового режима.
@@ -147,6 +147,47 @@ class CacheService:
             return await self.set_if_not_exists(key, steps, ttl)
         return await self.set(key, steps, ttl)
 
+    async def get_page(self, url: str) -> Optional[Dict[str, Any]]:
+        """
+        Разобранная страница с валидаторами HTTP-кэша:
+        {"etag", "last_modified", "text", "links"}.
+        """
+        key = self._generate_key("page", url)
+        return await self.get(key)
+
+    async def set_page(
+        self,
+        url: str,
+        page: Dict[str, Any],
+        ttl: int = 604800  # 7 дней: актуальность проверяется условным запросом
+    ) -> bool:
+        """Сохранить разобранную страницу и её ETag / Last-Modified."""
+        key = self._generate_key("page", url)
+        return await self.set(key, page, ttl)
+
+    async def get_prefetched(self, email: str, url: str, style: str, occasion: str = "") -> Optional[Dict[str, Any]]:
+        """Заранее сгенерированные посты стиля для сеанса: {"fingerprint", "final"}."""
+        key = self._generate_key("prefetch", email, url, style, occasion)
+        return await self.get(key)
+
+    async def set_prefetched(
+        self,
+        email: str,
+        url: str,
+        style: str,
+        occasion: str,
+        entry: Dict[str, Any],
+        ttl: int  # остаток сеанса (W): после его окончания стиль уже не запросить
+    ) -> bool:
+        """Сохранить заранее сгенерированные посты стиля."""
+        key = self._generate_key("prefetch", email, url, style, occasion)
+        return await self.set(key, entry, ttl)
+
+    async def delete_prefetched(self, email: str, url: str, style: str, occasion: str = "") -> bool:
+        """Удалить заранее сгенерированные посты стиля (выданы клиенту)."""
+        key = self._generate_key("prefetch", email, url, style, occasion)
+        return await self.delete(key)
+
 
 # Глобальный экземпляр кэша
 cache_service = CacheService()
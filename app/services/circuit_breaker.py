@@ -0,0 +1,223 @@
+"""
+Circuit breaker для LLM-провайдеров (primary - DeepSeek, alt - GPT-4o).
+
+closed    - запросы идут как обычно, результаты копятся в скользящем окне;
+open      - доля ошибок или медленных ответов превысила порог: запросы к провайдеру
+            не отправляются (AsyncLLMClient сразу переключается на другого или падает);
+half_open - после паузы пропускается несколько пробных запросов: успех закрывает
+            breaker, ошибка снова открывает.
+"""
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(RuntimeError):
+    """Провайдер временно отключён circuit breaker'ом - запрос не отправлялся."""
+
+
+class CircuitBreaker:
+    """Состояние breaker'а одного провайдера в пределах воркера."""
+
+    def __init__(
+        self,
+        name: str,
+        window: float,
+        min_calls: int,
+        error_rate: float,
+        slow_call: float,
+        slow_rate: float,
+        open_seconds: float,
+        half_open_calls: int,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.opened_at: Optional[float] = None
+        self.open_reason: Optional[str] = None
+        self.times_opened = 0
+        self.rejected = 0
+        # (время, успех, медленный) за последние window секунд
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        self._half_open_since = 0.0
+
+    def _trim(self, now: float) -> None:
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.open_reason = reason
+        self.times_opened += 1
+        self._calls.clear()
+        print(f"[CircuitBreaker] {self.name} OPEN: {reason}")
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос провайдеру сейчас."""
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._half_open_since = now
+            self._probes_started = 0
+            self._probes_succeeded = 0
+            print(f"[CircuitBreaker] {self.name} HALF_OPEN: probing")
+        if self.state == HALF_OPEN:
+            # Пробы, которые так и не завершились (отменены), не держат breaker вечно
+            if now - self._half_open_since >= self.open_seconds:
+                self._half_open_since = now
+                self._probes_started = self._probes_succeeded
+            if self._probes_started >= self.half_open_calls:
+                self.rejected += 1
+                return False
+            self._probes_started += 1
+        return True
+
+    def record_success(self, latency: float) -> None:
+        now = time.monotonic()
+        slow = latency >= self.slow_call
+        if self.state == HALF_OPEN:
+            if slow:
+                self._open(now, f"slow probe ({latency:.1f}s)")
+                return
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.half_open_calls:
+                self.state = CLOSED
+                self.open_reason = None
+                print(f"[CircuitBreaker] {self.name} CLOSED")
+            return
+        if self.state == CLOSED:
+            self._calls.append((now, True, slow))
+            self._evaluate(now)
+
+    def record_cancelled(self, latency: float) -> None:
+        """
+        Вызов отменён до конца ответа (таймаут шага, клиент ушёл). Дольше slow_call -
+        медленный вызов; иначе о провайдере он ничего не говорит и не учитывается.
+        Пробу в half_open такой вызов не засчитывает: breaker закрывают только ответы.
+        """
+        now = time.monotonic()
+        slow = latency >= self.slow_call
+        if self.state == HALF_OPEN:
+            if slow:
+                self._open(now, f"slow probe cancelled ({latency:.1f}s)")
+            else:
+                # Место пробы освобождается для следующего запроса
+                self._probes_started = max(self._probes_started - 1, self._probes_succeeded)
+            return
+        if self.state == CLOSED and slow:
+            self._calls.append((now, True, True))
+            self._evaluate(now)
+
+    def record_failure(self) -> None:
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._open(now, "probe failed")
+            return
+        if self.state == CLOSED:
+            self._calls.append((now, False, False))
+            self._evaluate(now)
+
+    def _evaluate(self, now: float) -> None:
+        self._trim(now)
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        slow = sum(1 for _, _, is_slow in self._calls if is_slow)
+        if failures / total >= self.error_rate:
+            self._open(now, f"error rate {failures}/{total}")
+        elif slow / total >= self.slow_rate:
+            self._open(now, f"slow calls {slow}/{total} (>= {self.slow_call:.0f}s)")
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._trim(now)
+        total = len(self._calls)
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        retry_in = None
+        if self.state == OPEN:
+            retry_in = round(max(0.0, self.open_seconds - (now - self.opened_at)), 1)
+        return {
+            "state": self.state,
+            "open_reason": self.open_reason,
+            "retry_in": retry_in,
+            "window_calls": total,
+            "window_error_rate": round(failures / total, 3) if total else 0.0,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreakerRegistry:
+    """Breaker'ы всех провайдеров воркера."""
+
+    def __init__(self):
+        self.enabled = os.getenv("LLM_BREAKER_ENABLED", "true").lower() == "true"
+        self.window = float(os.getenv("LLM_BREAKER_WINDOW", "60"))
+        self.min_calls = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+        self.error_rate = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+        self.slow_call = float(os.getenv("LLM_BREAKER_SLOW_CALL", "20"))
+        self.slow_rate = float(os.getenv("LLM_BREAKER_SLOW_RATE", "0.8"))
+        self.open_seconds = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+        self.half_open_calls = int(os.getenv("LLM_BREAKER_HALF_OPEN_CALLS", "2"))
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                window=self.window,
+                min_calls=self.min_calls,
+                error_rate=self.error_rate,
+                slow_call=self.slow_call,
+                slow_rate=self.slow_rate,
+                open_seconds=self.open_seconds,
+                half_open_calls=self.half_open_calls,
+            )
+            self._breakers[name] = breaker
+        return breaker
+
+    def allow_request(self, name: str) -> bool:
+        return not self.enabled or self.get(name).allow_request()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: breaker.snapshot() for name, breaker in self._breakers.items()}
+
+    def render_prometheus(self) -> str:
+        """Состояние breaker'ов для /llm/metrics: 0 - closed, 1 - half_open, 2 - open."""
+        lines: List[str] = [
+            "# HELP llm_circuit_state Circuit breaker state (0 closed, 1 half_open, 2 open)",
+            "# TYPE llm_circuit_state gauge",
+        ]
+        for name, breaker in self._breakers.items():
+            lines.append(f'llm_circuit_state{{provider="{name}"}} {_STATE_CODES[breaker.state]}')
+        lines.append("# HELP llm_circuit_rejected_total Calls rejected by an open circuit breaker")
+        lines.append("# TYPE llm_circuit_rejected_total counter")
+        for name, breaker in self._breakers.items():
+            lines.append(f'llm_circuit_rejected_total{{provider="{name}"}} {breaker.rejected}')
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+circuit_breakers = CircuitBreakerRegistry()
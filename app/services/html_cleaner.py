@@ -0,0 +1,379 @@
+"""
+Очистка HTML страницы до текста вне event loop.
+
+Разбор BeautifulSoup тяжёлой страницы занимает сотни миллисекунд CPU; внутри
+async-обработчика он останавливает все запросы воркера (включая /health).
+Поэтому разбор выполняется в небольшом пуле процессов воркера: он не держит
+GIL воркера и на нескольких ядрах идёт параллельно. Зависший разбор
+ограничен таймаутом - его процессы пересоздаются. Таймаут отсчитывается
+с момента, когда процесс пула взял разбор, а не с постановки в очередь:
+ожидание за чужими разборами не делает страницу "слишком сложной".
+
+Из страницы остаётся только основное содержимое: меню, шапка, подвал,
+боковые колонки, cookie-баннеры, блоки из одних ссылок и повторяющиеся
+строки удаляются до усечения по бюджету токенов - текст сайта уходит в LLM
+на каждом этапе анализа, и служебный текст оплачивается многократно.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup, Tag
+
+from app.services.llm_metrics import Counter, Histogram
+
+# Корзины времени разбора страницы (сек)
+PARSE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+# Как часто проверять, взял ли процесс пула разбор из очереди (сек)
+_START_POLL_SECONDS = 0.05
+
+
+# Теги без текста для анализа
+NON_CONTENT_TAGS = ["script", "style", "noscript", "template", "svg", "canvas"]
+
+# Служебные блоки страницы: меню, шапка, подвал, боковые колонки
+BOILERPLATE_TAGS = ["nav", "header", "footer", "aside"]
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search", "dialog", "alertdialog"}
+
+# class/id, которые всегда означают служебный блок
+_BOILERPLATE_ATTR_RE = re.compile(r"cookie|consent|gdpr|popup|modal|breadcrumb", re.IGNORECASE)
+# class/id, которые означают служебный блок, только если он состоит в основном из ссылок
+# ("menu" у ресторана или "header" у первого экрана - это содержимое)
+_NAVIGATION_ATTR_RE = re.compile(r"menu|nav|sidebar|social|share|header|footer", re.IGNORECASE)
+
+# Блок считается навигацией, если больше этой доли его текста - текст ссылок
+LINK_DENSITY_THRESHOLD = 0.5
+# Основное содержимое короче этого - вероятно, извлечение ошиблось, берём весь текст
+MIN_CONTENT_CHARS = 200
+
+# Строка без букв и цифр (разделители "|", "›", "•")
+_NO_WORDS_RE = re.compile(r"^[\W_]+$")
+
+
+def _text_lines(element: Tag) -> List[str]:
+    """Непустые строки текста элемента (без лишних пробелов)."""
+    text = element.get_text(separator="\n")
+    lines = [line.strip() for line in text.splitlines()]
+    return [chunk for line in lines for chunk in line.split("  ") if chunk]
+
+
+def _link_density(element: Tag) -> Tuple[int, float]:
+    """(длина текста, доля текста ссылок) - чем выше доля, тем вероятнее это меню."""
+    text_len = len(element.get_text(" ", strip=True))
+    if not text_len:
+        return 0, 1.0
+    link_len = sum(len(link.get_text(" ", strip=True)) for link in element.find_all("a"))
+    return text_len, min(link_len / text_len, 1.0)
+
+
+def _attr_text(element: Tag) -> str:
+    classes = element.get("class") or []
+    if isinstance(classes, str):
+        classes = [classes]
+    return " ".join(classes) + " " + str(element.get("id") or "")
+
+
+def _is_boilerplate(element: Tag, in_main: bool) -> bool:
+    if element.name in BOILERPLATE_TAGS:
+        # <header>/<footer> внутри <main>/<article> - заголовок и подпись материала
+        return not (in_main and element.name in ("header", "footer"))
+    if str(element.get("role") or "").lower() in BOILERPLATE_ROLES:
+        return True
+    attrs = _attr_text(element)
+    if _BOILERPLATE_ATTR_RE.search(attrs):
+        return True
+    if element.name in ("div", "section", "ul", "ol", "table") and (
+        _NAVIGATION_ATTR_RE.search(attrs) or element.name in ("ul", "ol")
+    ):
+        # Списки и "меню" по названию - только если это в основном ссылки
+        text_len, density = _link_density(element)
+        return density > LINK_DENSITY_THRESHOLD and len(element.find_all("a", limit=3)) >= 3
+    return False
+
+
+def _main_root(soup: BeautifulSoup) -> Optional[Tag]:
+    """Явно размеченное основное содержимое: <main>, role="main" или единственный <article>."""
+    main = soup.find("main") or soup.find(attrs={"role": "main"})
+    if main is None:
+        articles = soup.find_all("article", limit=2)
+        if len(articles) == 1:
+            main = articles[0]
+    if main is not None and len(main.get_text(" ", strip=True)) >= MIN_CONTENT_CHARS:
+        return main
+    return None
+
+
+def _dedupe_lines(lines: List[str]) -> Tuple[List[str], int]:
+    """Без повторов (меню, повторённое в шапке и подвале, одинаковые кнопки) и строк без слов."""
+    seen = set()
+    kept = []
+    for line in lines:
+        if _NO_WORDS_RE.match(line):
+            continue
+        key = " ".join(line.lower().split())
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(line)
+    return kept, len(lines) - len(kept)
+
+
+def _links(soup: BeautifulSoup, base_url: str) -> List[str]:
+    """Абсолютные http(s)-ссылки страницы в порядке появления, без повторов и якорей."""
+    links: List[str] = []
+    seen = set()
+    for anchor in soup.find_all("a", href=True):
+        href = urljoin(base_url, anchor["href"].strip()).split("#", 1)[0]
+        if href.startswith(("http://", "https://")) and href not in seen:
+            seen.add(href)
+            links.append(href)
+    return links
+
+
+def clean_html(html: str, extract_main: bool = True, base_url: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Основной текст страницы без скриптов, служебных блоков и повторов.
+    Функция модуля (не метод): выполняется в дочернем процессе пула.
+    Возвращает {"text": ..., "report": {html_chars, text_chars, content_chars,
+    removed_blocks, duplicate_lines, main_found}} - сколько было и сколько осталось;
+    с base_url - ещё "links": ссылки страницы (до удаления меню - в нём главные разделы).
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(NON_CONTENT_TAGS):
+        tag.decompose()
+    links = _links(soup, base_url) if base_url else []
+    all_lines = _text_lines(soup)
+    text_chars = sum(len(line) + 1 for line in all_lines)
+
+    removed_blocks = 0
+    main_found = False
+    lines = all_lines
+    if extract_main:
+        root = _main_root(soup)
+        main_found = root is not None
+        root = root or soup.body or soup
+        for element in root.find_all(True):
+            if element.decomposed or not _is_boilerplate(element, main_found):
+                continue
+            element.decompose()
+            removed_blocks += 1
+        lines = _text_lines(root)
+        if sum(len(line) for line in lines) < MIN_CONTENT_CHARS:
+            # Извлечение оставило почти пустую страницу (лендинг из одной шапки) - не рискуем
+            lines = all_lines
+
+    lines, duplicate_lines = _dedupe_lines(lines)
+    text = "\n".join(lines)
+    return {
+        "text": text,
+        "links": links,
+        "report": {
+            "html_chars": len(html),
+            "text_chars": text_chars,
+            "content_chars": len(text),
+            "removed_blocks": removed_blocks,
+            "duplicate_lines": duplicate_lines,
+            "main_found": main_found,
+        },
+    }
+
+
+def _noop() -> None:
+    """Пустая задача для запуска процессов пула заранее."""
+
+
+# Состояние процесса пула: его номер и общие с воркером массивы
+# "какой разбор выполняется" / "с какого момента" (по одной ячейке на процесс)
+_worker_slot: Optional[int] = None
+_running_task = None
+_running_since = None
+
+
+def _init_worker(next_slot, running_task, running_since) -> None:
+    """Инициализация процесса пула: занять свою ячейку в общих массивах."""
+    global _worker_slot, _running_task, _running_since
+    with next_slot.get_lock():
+        _worker_slot = next_slot.value
+        next_slot.value += 1
+    _running_task, _running_since = running_task, running_since
+
+
+def _clean_html_task(task_id: int, html: str, extract_main: bool, base_url: Optional[str]) -> Dict[str, Any]:
+    """clean_html в процессе пула с отметкой о начале разбора (от неё считается таймаут)."""
+    tracked = _worker_slot is not None and _worker_slot < len(_running_task)
+    if tracked:
+        # Сначала время, потом номер: воркер, увидевший номер, прочитает уже верное время
+        _running_since[_worker_slot] = time.time()
+        _running_task[_worker_slot] = task_id
+    try:
+        return clean_html(html, extract_main, base_url)
+    finally:
+        if tracked:
+            _running_task[_worker_slot] = 0
+
+
+class HtmlCleanerPool:
+    """Пул процессов для разбора HTML в пределах одного воркера."""
+
+    def __init__(self):
+        # 0 - разбор в потоке воркера (без отдельных процессов)
+        self.processes = int(os.getenv("HTML_PARSE_PROCESSES", "1"))
+        self.timeout = float(os.getenv("HTML_PARSE_TIMEOUT", "15"))
+        # Мелкие страницы дешевле разобрать в потоке, чем передавать в другой процесс
+        self.inline_max_chars = int(os.getenv("HTML_PARSE_INLINE_MAX_CHARS", "20000"))
+        # Оставлять только основное содержимое страницы (без меню, подвала, повторов)
+        self.extract_main = os.getenv("HTML_EXTRACT_MAIN", "true").lower() == "true"
+        self._pid: Optional[int] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Общие с процессами текущего пула массивы (см. _clean_html_task)
+        self._running: Optional[Tuple[Any, Any]] = None
+        self._task_ids = itertools.count(1)
+        self.parse_seconds = Histogram(
+            "html_parse_seconds", "HTML to text parsing time including queueing", PARSE_BUCKETS
+        )
+        self.parses = Counter("html_parse_total", "HTML parses by executor and result")
+        self.chars = Counter("html_text_chars_total", "Page text size before (text) and after (content) extraction")
+
+    def _ensure_process(self) -> None:
+        """Пул родительского процесса (gunicorn preload_app) воркеру не передаём."""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._executor = None
+            self._running = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        self._ensure_process()
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют event loop и соединения воркера
+            context = multiprocessing.get_context("spawn")
+            running_task = context.RawArray("d", self.processes)
+            running_since = context.RawArray("d", self.processes)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(context.Value("i", 0), running_task, running_since),
+            )
+            self._running = (running_task, running_since)
+        return self._executor
+
+    @staticmethod
+    def _started_at(running: Tuple[Any, Any], task_id: int) -> Optional[float]:
+        """Когда процесс пула начал разбор task_id (None - разбор ещё в очереди)."""
+        running_task, running_since = running
+        for slot, current in enumerate(running_task):
+            if current == task_id:
+                return running_since[slot]
+        return None
+
+    async def _wait_parse(self, future: "asyncio.Future", running: Tuple[Any, Any], task_id: int) -> Dict[str, Any]:
+        """
+        Дождаться разбора в процессе пула. HTML_PARSE_TIMEOUT считается с момента,
+        когда процесс взял разбор; пока разбор в очереди, таймаут не идёт.
+        """
+        started_at: Optional[float] = None
+        try:
+            while True:
+                if started_at is None:
+                    started_at = self._started_at(running, task_id)
+                if started_at is None:
+                    wait = _START_POLL_SECONDS
+                else:
+                    wait = started_at + self.timeout - time.time()
+                    if wait <= 0:
+                        raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait({future}, timeout=wait)
+                if done:
+                    return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def _reset_executor(self) -> None:
+        """Остановить пул (в том числе зависший разбор); следующий вызов создаст новый."""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        # ProcessPoolExecutor не умеет прерывать выполняющуюся задачу - завершаем процессы
+        # (ожидающие в очереди разборы получат BrokenProcessPool и повторятся в новом пуле)
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+        self._running = None
+
+    async def start(self) -> None:
+        """Запустить процессы пула заранее, чтобы первый разбор не ждал их старта."""
+        if self.processes <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*[loop.run_in_executor(executor, _noop) for _ in range(self.processes)])
+        print(f"[HtmlCleaner] Started {self.processes} parser process(es)")
+
+    async def clean(self, html: str, base_url: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Текст страницы, отчёт о размерах и ссылки (см. clean_html) без блокировки event loop.
+        Разбор дольше HTML_PARSE_TIMEOUT (без ожидания в очереди пула) - ValueError.
+        """
+        loop = asyncio.get_running_loop()
+        use_processes = self.processes > 0 and len(html) > self.inline_max_chars
+        executor_name = "process" if use_processes else "thread"
+        started = time.perf_counter()
+        while True:
+            executor = self._get_executor() if use_processes else None
+            try:
+                if executor is not None:
+                    running, task_id = self._running, next(self._task_ids)
+                    future = loop.run_in_executor(
+                        executor, _clean_html_task, task_id, html, self.extract_main, base_url
+                    )
+                    page = await self._wait_parse(future, running, task_id)
+                else:
+                    # Поток берёт разбор сразу (очереди нет) - обычного таймаута достаточно
+                    page = await asyncio.wait_for(
+                        asyncio.to_thread(clean_html, html, self.extract_main, base_url), timeout=self.timeout
+                    )
+                break
+            except asyncio.TimeoutError:
+                self.parses.inc(executor=executor_name, result="timeout")
+                print(f"[HtmlCleaner] Parse timed out after {self.timeout:g}s ({len(html)} chars)")
+                # Таймаут наступает только у начатого разбора - завис именно он, пул перезапускаем
+                if executor is not None and executor is self._executor:
+                    self._reset_executor()
+                raise ValueError("Не удалось разобрать страницу: слишком сложный HTML")
+            except BrokenProcessPool:
+                if executor is not self._executor:
+                    # Пул остановлен из-за чужого зависшего разбора - повторяем в новом
+                    continue
+                # Процесс пула упал (например, OOM) - пересоздаём пул для следующих разборов
+                self.parses.inc(executor=executor_name, result="error")
+                self._reset_executor()
+                raise ValueError("Не удалось разобрать страницу")
+        self.parses.inc(executor=executor_name, result="ok")
+        self.parse_seconds.observe(time.perf_counter() - started, executor=executor_name)
+        self.chars.inc(page["report"]["text_chars"], stage="text")
+        self.chars.inc(page["report"]["content_chars"], stage="content")
+        return page
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = self.parse_seconds.render() + self.parses.render() + self.chars.render()
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        """Остановить процессы пула (при остановке приложения)."""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+html_cleaner = HtmlCleanerPool()
@@ -0,0 +1,325 @@
+"""
+Общий HTTP-клиент для загрузки страниц анализируемых сайтов.
+
+Один долгоживущий httpx-клиент на процесс воркера (HTTP/2, keep-alive):
+повторные запросы к тому же сайту идут по уже открытому соединению без
+новых TCP/TLS рукопожатий. Число одновременных запросов к одному хосту
+ограничено, чтобы не перегружать чужой сайт и не исчерпать пул.
+
+Тело ответа читается потоком и декодируется по частям: чтение прекращается
+на FETCH_MAX_BYTES или по истечении FETCH_TOTAL_TIMEOUT, поэтому огромная
+или бесконечная страница не занимает память и воркер. FETCH_TOTAL_TIMEOUT
+отсчитывается с начала вызова и включает ожидание очереди к хосту и заголовков.
+"""
+import asyncio
+import codecs
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (нужен httpx для HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+try:
+    # Автоопределение кодировки, как у httpx (default_encoding по содержимому)
+    import charset_normalizer
+    CHARSET_DETECTION_AVAILABLE = True
+except ImportError:
+    CHARSET_DETECTION_AVAILABLE = False
+
+
+# Типы содержимого, которые имеет смысл разбирать как страницу сайта
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+# sitemap.xml (часто отдаётся как text/xml)
+XML_CONTENT_TYPES = ("application/xml", "text/xml", "text/plain")
+
+# <meta charset="..."> или <meta http-equiv="Content-Type" content="...; charset=...">
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([a-zA-Z0-9_-]+)""", re.IGNORECASE)
+
+# Сколько первых байт смотреть в поиске <meta charset>, если кодировки нет в заголовках
+_SNIFF_BYTES = 2048
+# По скольким байтам угадывать кодировку, если она нигде не указана
+_DETECT_BYTES = 65536
+
+
+def _declared_encoding(header_encoding: Optional[str], head: bytes) -> Optional[str]:
+    """Кодировка страницы из Content-Type или <meta charset>; None, если не указана."""
+    candidates = [header_encoding]
+    match = _META_CHARSET_RE.search(head)
+    if match:
+        candidates.append(match.group(1).decode("ascii"))
+    for encoding in candidates:
+        if not encoding:
+            continue
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            continue
+    return None
+
+
+def _detect_encoding(body: bytes) -> str:
+    """
+    Кодировка страницы, которая её не указывает: utf-8, если тело в ней корректно,
+    иначе - автоопределение по содержимому (windows-1251, koi8-r и т.п.).
+    """
+    try:
+        # final=False: тело, обрезанное по FETCH_MAX_BYTES, может кончаться посреди символа
+        codecs.getincrementaldecoder("utf-8")().decode(body, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if CHARSET_DETECTION_AVAILABLE:
+        match = charset_normalizer.from_bytes(body[:_DETECT_BYTES]).best()
+        if match is not None:
+            try:
+                return codecs.lookup(match.encoding).name
+            except LookupError:
+                pass
+    return "utf-8"
+
+
+class PageFetcher:
+    """Пул соединений к анализируемым сайтам в пределах одного процесса."""
+
+    def __init__(self):
+        self.http2 = os.getenv("FETCH_HTTP2", "true").lower() == "true" and HTTP2_AVAILABLE
+        self.max_connections = int(os.getenv("FETCH_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv("FETCH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("FETCH_KEEPALIVE_EXPIRY", "30"))
+        self.connect_timeout = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = float(os.getenv("FETCH_READ_TIMEOUT", "15"))
+        self.pool_timeout = float(os.getenv("FETCH_POOL_TIMEOUT", "10"))
+        self.per_host_limit = int(os.getenv("FETCH_PER_HOST_CONCURRENCY", "4"))
+        # Больше не читаем: текст для анализа всё равно обрезается по бюджету токенов
+        self.max_bytes = int(os.getenv("FETCH_MAX_BYTES", "2000000"))
+        # Общее время на скачивание страницы (медленная отдача по байту не держит воркер)
+        self.total_timeout = float(os.getenv("FETCH_TOTAL_TIMEOUT", "30"))
+        self._pid: Optional[int] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        # Сколько запросов к хосту держат или ждут его семафор
+        self._host_users: Dict[str, int] = {}
+
+    def _ensure_process(self) -> None:
+        """Соединения родительского процесса (gunicorn preload_app) воркеру не передаём."""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._client = None
+            self._host_semaphores = {}
+            self._host_users = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Общий httpx-клиент воркера (создаётся при первом обращении)."""
+        self._ensure_process()
+        if self._client is None or self._client.is_closed:
+            if os.getenv("FETCH_HTTP2", "true").lower() == "true" and not HTTP2_AVAILABLE:
+                print("[PageFetcher] Warning: h2 not installed, using HTTP/1.1")
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(
+                    connect=self.connect_timeout,
+                    read=self.read_timeout,
+                    write=self.read_timeout,
+                    pool=self.pool_timeout,
+                ),
+            )
+        return self._client
+
+    @asynccontextmanager
+    async def _host_slot(self, url: str, timeout: float) -> AsyncIterator[None]:
+        """
+        Место в лимите одновременных запросов к хосту (FETCH_PER_HOST_CONCURRENCY).
+        Не освободилось за timeout секунд - httpx.TimeoutException.
+        """
+        host = urlsplit(url).netloc.lower()
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            # Не копим семафоры всех когда-либо загруженных сайтов; семафор, который
+            # кто-то держит или ждёт, не удаляем - иначе лимит хоста можно превысить
+            if len(self._host_semaphores) >= 1000:
+                self._host_semaphores = {
+                    name: sem for name, sem in self._host_semaphores.items() if self._host_users.get(name)
+                }
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._host_semaphores[host] = semaphore
+        self._host_users[host] = self._host_users.get(host, 0) + 1
+        try:
+            acquire = asyncio.ensure_future(semaphore.acquire())
+            try:
+                done, _ = await asyncio.wait({acquire}, timeout=timeout)
+            finally:
+                if not acquire.done():
+                    acquire.cancel()
+            if not done:
+                try:
+                    # Место могло освободиться одновременно с отменой - тогда вернуть его
+                    await acquire
+                except asyncio.CancelledError:
+                    pass
+                else:
+                    semaphore.release()
+                raise httpx.TimeoutException(f"Очередь запросов к {host} не подошла за {timeout:.0f} с")
+            try:
+                yield
+            finally:
+                semaphore.release()
+        finally:
+            self._host_users[host] -= 1
+            if not self._host_users[host]:
+                del self._host_users[host]
+
+    async def fetch_page(
+        self,
+        url: str,
+        content_types: Tuple[str, ...] = HTML_CONTENT_TYPES,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Загрузить страницу потоком.
+        Возвращает {url, status, content_type, encoding, text, bytes, truncated, elapsed,
+        etag, last_modified, not_modified}; truncated - чтение остановлено по
+        FETCH_MAX_BYTES или FETCH_TOTAL_TIMEOUT.
+        С etag / last_modified запрос условный: если страница не менялась,
+        сайт отвечает 304 без тела - not_modified=True, text пустой.
+        HTTP-ошибки - httpx.HTTPError (в том числе httpx.TimeoutException, если за
+        FETCH_TOTAL_TIMEOUT не подошла очередь к хосту или не пришли заголовки),
+        другой тип содержимого (не из content_types) - ValueError.
+        """
+        client = self.get_client()
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        started = time.monotonic()
+        # FETCH_TOTAL_TIMEOUT - на всё: очередь к хосту, соединение, заголовки и тело
+        deadline = started + self.total_timeout
+
+        def remaining() -> float:
+            return max(deadline - time.monotonic(), 0.0)
+
+        async with self._host_slot(url, remaining()):
+            request = client.build_request("GET", url, headers=headers)
+            try:
+                resp = await asyncio.wait_for(client.send(request, stream=True), timeout=remaining())
+            except asyncio.TimeoutError as exc:
+                raise httpx.TimeoutException(
+                    f"Сайт не ответил за {self.total_timeout:.0f} с", request=request
+                ) from exc
+            try:
+                validators = {
+                    "etag": resp.headers.get("etag"),
+                    "last_modified": resp.headers.get("last-modified"),
+                }
+                if resp.status_code == 304 and headers:
+                    return {
+                        "url": str(resp.url),
+                        "status": 304,
+                        "content_type": "",
+                        "encoding": None,
+                        "text": "",
+                        "bytes": 0,
+                        "truncated": False,
+                        "elapsed": round(time.monotonic() - started, 3),
+                        **validators,
+                        "not_modified": True,
+                    }
+                resp.raise_for_status()
+                content_type = resp.headers.get("content-type", "").split(";")[0].strip().lower()
+                # Картинки, PDF, архивы не скачиваем вовсе
+                if content_type and content_type not in content_types:
+                    raise ValueError(f"Страница не является HTML (Content-Type: {content_type})")
+
+                head = b""
+                decoder = None
+                encoding = None
+                sniffed = False
+                parts: List[str] = []
+                received = 0
+                truncated = False
+                chunks = resp.aiter_bytes()
+                while True:
+                    try:
+                        # Сайт, отдающий тело по байту или замолчавший, не держит дольше срока
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        truncated = True
+                        break
+                    if received + len(chunk) > self.max_bytes:
+                        chunk = chunk[: self.max_bytes - received]
+                        truncated = True
+                    received += len(chunk)
+                    if decoder is None:
+                        # Кодировку определяем по началу документа, дальше декодируем по частям
+                        head += chunk
+                        if len(head) < _SNIFF_BYTES and not truncated:
+                            continue
+                        if not sniffed:
+                            sniffed = True
+                            encoding = _declared_encoding(resp.charset_encoding, head[:_SNIFF_BYTES])
+                        if encoding is None:
+                            # Кодировка не указана - определим по всему телу (оно ограничено FETCH_MAX_BYTES)
+                            if truncated:
+                                break
+                            continue
+                        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                        chunk, head = head, b""
+                    parts.append(decoder.decode(chunk))
+                    if truncated:
+                        break
+                if decoder is None:
+                    if encoding is None:
+                        encoding = _declared_encoding(resp.charset_encoding, head[:_SNIFF_BYTES]) or _detect_encoding(head)
+                    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                    parts.append(decoder.decode(head))
+                parts.append(decoder.decode(b"", final=True))
+                if truncated:
+                    print(f"[PageFetcher] {url}: stopped after {received} bytes")
+                return {
+                    "url": str(resp.url),
+                    "status": resp.status_code,
+                    "content_type": content_type,
+                    "encoding": encoding,
+                    "text": "".join(parts),
+                    "bytes": received,
+                    "truncated": truncated,
+                    "elapsed": round(time.monotonic() - started, 3),
+                    **validators,
+                    "not_modified": False,
+                }
+            finally:
+                await resp.aclose()
+
+    async def fetch_html(self, url: str) -> str:
+        """Текст страницы (см. fetch_page)."""
+        page = await self.fetch_page(url)
+        return page["text"]
+
+    async def close(self) -> None:
+        """Закрыть соединения (при остановке приложения)."""
+        if self._client is not None and self._pid == os.getpid():
+            await self._client.aclose()
+        self._client = None
+        self._host_semaphores = {}
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+page_fetcher = PageFetcher()
@@ -0,0 +1,119 @@
+"""
+Разбор JSON, который модель ещё не дописала (потоковый ответ).
+Позволяет показывать готовые элементы массива до окончания генерации
+и спасать ответ, оборванный по max_tokens.
+"""
+import json
+from typing import Any, List, Optional
+
+
+_decoder = json.JSONDecoder()
+
+
+def _find_array_start(buffer: str, key: str) -> Optional[int]:
+    """Позиция сразу после '[' массива с ключом key, либо None, если массив ещё не начат."""
+    marker = f'"{key}"'
+    pos = buffer.find(marker)
+    if pos == -1:
+        return None
+    pos += len(marker)
+    # Пропускаем пробелы и двоеточие между ключом и массивом
+    while pos < len(buffer) and buffer[pos] in " \t\r\n:":
+        pos += 1
+    if pos >= len(buffer) or buffer[pos] != "[":
+        return None
+    return pos + 1
+
+
+def extract_string_items(buffer: str, key: str) -> List[str]:
+    """
+    Вернуть полностью завершённые строки массива buffer[key].
+
+    Пример: для '{"posts": ["первый", "вто' вернёт ["первый"].
+    Незаконченная последняя строка не возвращается, поэтому функцию можно
+    вызывать на каждом новом фрагменте потока.
+    """
+    pos = _find_array_start(buffer, key)
+    if pos is None:
+        return []
+
+    items: List[str] = []
+    length = len(buffer)
+    while pos < length:
+        char = buffer[pos]
+        if char in " \t\r\n,":
+            pos += 1
+            continue
+        if char == "]" or char != '"':
+            break
+        try:
+            value, pos = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Строка ещё не дописана
+            break
+        items.append(value)
+    return items
+
+
+def parse_partial_json(text: str) -> Optional[Any]:
+    """
+    Разобрать оборванный JSON: незакрытые объекты и массивы закрываются,
+    недописанный последний элемент отбрасывается.
+
+    Пример: '{"posts": ["первый", "вто' -> {"posts": ["первый"]}.
+    Возвращает None, если спасти нечего.
+    """
+    starts = [pos for pos in (text.find("{"), text.find("[")) if pos != -1]
+    if not starts:
+        return None
+    start = min(starts)
+
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    # Последнее место, где все элементы до него дописаны: (позиция среза, открытые скобки)
+    safe_cut: Optional[tuple] = None
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                # Корневое значение закрыто - дальше мусор после JSON
+                try:
+                    return json.loads(text[start:pos + 1])
+                except json.JSONDecodeError:
+                    return None
+            safe_cut = (pos + 1, list(stack))
+        elif char == ",":
+            safe_cut = (pos, list(stack))
+
+    candidates = []
+    if not in_string:
+        # Текст оборвался после законченного значения, но без закрывающих скобок
+        candidates.append(text[start:].rstrip().rstrip(",") + "".join(reversed(stack)))
+    if safe_cut is not None:
+        cut, open_brackets = safe_cut
+        candidates.append(text[start:cut] + "".join(reversed(open_brackets)))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+__all__ = ["extract_string_items", "parse_partial_json"]
@@ -0,0 +1,160 @@
+"""
+Кэш ответов LLM с адресацией по содержимому запроса.
+
+Ключ - хэш от провайдера, модели, сообщений и параметров генерации,
+поэтому одинаковый детерминированный запрос (temperature=0) второй раз
+не тратит токены. Два уровня: LRU в памяти процесса и Redis с TTL.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import aioredis
+
+
+class LLMResponseCache:
+    """Двухуровневый кэш ответов LLM (память процесса + Redis)."""
+
+    def __init__(self, redis_url: str = None):
+        self.enabled = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+        self.redis_enabled = os.getenv("LLM_CACHE_REDIS", "true").lower() == "true"
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.redis: Optional[aioredis.Redis] = None
+        self._redis_retry_at = 0.0
+        self.max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+        self.ttl = int(os.getenv("LLM_CACHE_TTL", "86400"))  # 24 часа
+        self.max_value_bytes = int(os.getenv("LLM_CACHE_MAX_VALUE_BYTES", "262144"))  # 256 КБ
+        self.redis_max_keys = int(os.getenv("LLM_CACHE_REDIS_MAX_KEYS", "10000"))
+        self.redis_prefix = "llm_cache"
+        # key -> (expires_at, serialized_value)
+        self._lru: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "skipped_too_large": 0,
+            "redis_errors": 0,
+        }
+
+    async def _get_redis(self) -> Optional[aioredis.Redis]:
+        """Подключение к Redis; при недоступности работаем только с памятью."""
+        if not self.redis_enabled:
+            return None
+        if not self.redis:
+            # После неудачного подключения не пытаемся снова на каждом запросе
+            if time.monotonic() < self._redis_retry_at:
+                return None
+            try:
+                self.redis = await aioredis.from_url(self.redis_url, decode_responses=True)
+            except Exception as exc:
+                print(f"[LLMResponseCache] Warning: Redis unavailable: {exc}")
+                self.stats["redis_errors"] += 1
+                self._redis_retry_at = time.monotonic() + 30
+                return None
+        return self.redis
+
+    def make_key(self, provider: str, kwargs: Dict[str, Any]) -> str:
+        """Ключ кэша: провайдер + модель + сообщения + параметры запроса."""
+        key_data = json.dumps(
+            {"provider": provider, "request": kwargs},
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        expires_at, serialized = entry
+        if expires_at < time.monotonic():
+            del self._lru[key]
+            return None
+        self._lru.move_to_end(key)
+        return serialized
+
+    def _memory_set(self, key: str, serialized: str) -> None:
+        self._lru[key] = (time.monotonic() + self.ttl, serialized)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Получить ответ из кэша (сначала память, затем Redis)."""
+        serialized = self._memory_get(key)
+        if serialized is not None:
+            self.stats["memory_hits"] += 1
+            return json.loads(serialized)
+
+        redis = await self._get_redis()
+        if redis:
+            try:
+                serialized = await redis.get(f"{self.redis_prefix}:{key}")
+            except Exception as exc:
+                print(f"[LLMResponseCache] Warning: Redis get failed: {exc}")
+                self.stats["redis_errors"] += 1
+                serialized = None
+            if serialized is not None:
+                try:
+                    value = json.loads(serialized)
+                except json.JSONDecodeError:
+                    value = None
+                if value is not None:
+                    self.stats["redis_hits"] += 1
+                    self._memory_set(key, serialized)
+                    return value
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Any) -> bool:
+        """Сохранить ответ в оба уровня кэша с учётом лимитов размера."""
+        try:
+            serialized = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return False
+        if len(serialized.encode("utf-8")) > self.max_value_bytes:
+            self.stats["skipped_too_large"] += 1
+            return False
+
+        self._memory_set(key, serialized)
+        self.stats["stores"] += 1
+
+        redis = await self._get_redis()
+        if redis:
+            try:
+                index_key = f"{self.redis_prefix}:index"
+                now = time.time()
+                await redis.setex(f"{self.redis_prefix}:{key}", self.ttl, serialized)
+                await redis.zadd(index_key, {key: now})
+                # Индекс хранит время записи: убираем истёкшие по TTL и самые старые сверх лимита
+                await redis.zremrangebyscore(index_key, 0, now - self.ttl)
+                overflow = await redis.zcard(index_key) - self.redis_max_keys
+                if overflow > 0:
+                    evicted = await redis.zpopmin(index_key, overflow)
+                    if evicted:
+                        await redis.delete(*[f"{self.redis_prefix}:{k}" for k, _ in evicted])
+            except Exception as exc:
+                print(f"[LLMResponseCache] Warning: Redis set failed: {exc}")
+                self.stats["redis_errors"] += 1
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий/промахов для мониторинга."""
+        hits = self.stats["memory_hits"] + self.stats["redis_hits"]
+        total = hits + self.stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "memory_entries": len(self._lru),
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр кэша ответов LLM
+llm_cache = LLMResponseCache()
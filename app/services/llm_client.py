@@ -1,23 +1,43 @@
+import asyncio
 import json
 import os
-from typing import Any, Dict, List, Optional
+import random
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+
+from app.services.circuit_breaker import CircuitOpenError, circuit_breakers
+from app.services.json_stream import parse_partial_json
+from app.services.llm_cache import llm_cache
+from app.services.llm_metrics import llm_metrics
+from app.services.llm_pool import llm_pool
+from app.services.llm_routing import RoutingPolicy, get_routing_policy
+from app.services.provider_health import provider_health
+from app.services.rate_limiter import RateLimitTimeout, estimate_tokens, rate_limiter
+from app.services.singleflight import singleflight
 
 
 # Инициализация переменных окружения из .env
 load_dotenv()
 
+# Продолжение ответа, оборванного по max_tokens
+_CONTINUE_PROMPT = (
+    "Ответ оборвался. Продолжи его ровно с места обрыва: без повторов, без пояснений "
+    "и без ```, только недостающий текст."
+)
+# Исправление невалидного JSON (дешевле полной перегенерации: на входе только сам ответ)
+_REPAIR_PROMPT = (
+    "Исправь синтаксис JSON из сообщения пользователя. Сохрани всё содержимое, ничего "
+    "не добавляй и не переводи. Верни только валидный json-объект."
+)
+
 
-class LLMClient:
+class _BaseLLMClient:
     """
-    Клиент для общения с LLM через совместимый с OpenAI API.
-    
-    ГИБРИДНЫЙ РЕЖИМ:
-    - Поддерживает несколько провайдеров одновременно (GPT-4o + DeepSeek)
-    - Можно задать основной и альтернативный клиент для разных задач
-    - Авторизация через заголовок: "Authorization: Bearer <api_key>"
+    Конфигурация провайдеров, сборка сообщений и разбор ответов.
+    Сетевые вызовы реализует AsyncLLMClient.
     """
 
     def __init__(
@@ -49,32 +69,19 @@ class LLMClient:
         self.system_prompt: Optional[str] = system_prompt
         self.max_tokens: int = max_tokens
 
-        # Явно укажем заголовок Authorization
-        default_headers = {"Authorization": f"Bearer {self.api_key}"}
-
-        self.client: OpenAI = OpenAI(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            default_headers=default_headers,
-        )
-
-        # Альтернативный клиент (GPT-4o через ProxyAPI)
-        self.alt_client: Optional[OpenAI] = None
+        # Альтернативный провайдер (GPT-4o через ProxyAPI)
+        self.alt_base_url: Optional[str] = None
+        self.alt_api_key: Optional[str] = None
         self.alt_model: Optional[str] = alt_model
-        
+
         if alt_base_url or os.getenv("OPENAI_BASE_URL"):
             alt_url = alt_base_url or os.getenv("OPENAI_BASE_URL", "").strip()
             alt_key = alt_api_key or os.getenv("OPENAI_API_KEY", "").strip()
-            
+
             if alt_url and alt_key:
-                alt_headers = {"Authorization": f"Bearer {alt_key}"}
-                self.alt_client = OpenAI(
-                    base_url=alt_url,
-                    api_key=alt_key,
-                    default_headers=alt_headers,
-                )
+                self.alt_base_url = alt_url
+                self.alt_api_key = alt_key
                 self.alt_model = alt_model or "gpt-4o"
-                print(f"[LLMClient] Hybrid mode: Primary={self.model}, Alternative={self.alt_model}")
 
     # --- Публичные методы настройки ---
     def set_system_prompt(self, system_prompt: Optional[str]) -> None:
@@ -115,69 +122,423 @@ class LLMClient:
         except Exception:
             pass
 
+    def parse_json_content(self, content: str) -> Dict[str, Any]:
+        """Разбор JSON из ответа модели с несколькими fallback-стратегиями."""
+        # Прямая попытка
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            pass
+
+        # Fallback 1: вырезать блок кода ```json ... ``` или ``` ... ```
+        text = content.strip()
+        fences = ["```json", "```"]
+        for fence in fences:
+            if fence in text:
+                try:
+                    start = text.index(fence) + len(fence)
+                    end = text.index("```", start)
+                    candidate = text[start:end].strip()
+                    return json.loads(candidate)
+                except Exception:
+                    continue
+
+        # Fallback 2: взять подстроку между первой { и последней }
+        if "{" in text and "}" in text:
+            try:
+                start = text.index("{")
+                end = text.rindex("}") + 1
+                candidate = text[start:end]
+                return json.loads(candidate)
+            except Exception:
+                pass
+
+        # Fallback 3: заменить одинарные кавычки на двойные, если это валидно
+        try:
+            normalized = text.replace("'", '"')
+            return json.loads(normalized)
+        except Exception as exc:
+            raise ValueError(
+                "Модель вернула невалидный JSON. Попробуйте уточнить инструкции или увеличить max_tokens."
+            ) from exc
+
+
+class _MeteredStream:
+    """
+    Обёртка над потоковым ответом провайдера для метрик: время до первого
+    фрагмента и usage из последнего чанка (stream_options.include_usage).
+    Исход вызова для circuit breaker'а и здоровья провайдера записывается,
+    когда поток закончился: обрыв посреди ответа - это сбой провайдера.
+    """
+
+    def __init__(self, stream: Any, record: Dict[str, Any], health: Any, breaker: Any) -> None:
+        self._stream = stream
+        self._record = record
+        self._health = health
+        self._breaker = breaker
+        # Для стрима важен первый фрагмент текста, а не заголовки ответа
+        self._record["ttfb"] = None
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[Any]:
+        usage = None
+        status = "aborted"
+        try:
+            async for chunk in self._stream:
+                llm_metrics.mark_first_byte(self._record)
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                yield chunk
+            status = "ok"
+            self._health.record_success()
+        except Exception as exc:
+            status = "error"
+            self._breaker.record_failure()
+            self._health.record_failure(exc)
+            raise
+        finally:
+            latency = time.perf_counter() - self._record["sent_at"]
+            if status == "ok":
+                self._breaker.record_success(latency)
+            elif status == "aborted":
+                # Поток брошен потребителем (таймаут, клиент ушёл) - как отменённый вызов
+                self._breaker.record_cancelled(latency)
+            llm_metrics.finish_call(self._record, status, usage)
+
+
+class AsyncLLMClient(_BaseLLMClient):
+    """
+    Клиент LLM поверх AsyncOpenAI (совместимый с OpenAI API).
+
+    Запросы выполняются прямо в event loop, без run_in_threadpool, поэтому
+    число одновременных анализов не ограничено пулом потоков Starlette.
+    HTTP-соединения берутся из общего пула воркера (llm_pool): все экземпляры
+    клиента используют одни и те же keep-alive соединения к провайдеру.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # Повторы временных ошибок и переключение между провайдерами
+        self.retry_attempts = max(1, int(os.getenv("LLM_RETRY_ATTEMPTS", "3")))
+        self.retry_base_delay = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+        self.retry_max_delay = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+        self.failover_enabled = os.getenv("LLM_FAILOVER_ENABLED", "true").lower() == "true"
+        # Structured output (response_format=json_schema): DeepSeek его не поддерживает
+        self.json_schema_support: Dict[str, bool] = {
+            "primary": os.getenv("LLM_JSON_SCHEMA_PRIMARY", "false").lower() == "true",
+            "alt": os.getenv("LLM_JSON_SCHEMA_ALT", "true").lower() == "true",
+        }
+        # Сколько раз дописывать JSON, оборванный по max_tokens
+        self.json_continue_attempts = int(os.getenv("LLM_JSON_CONTINUE_ATTEMPTS", "2"))
+        # Последняя мера для невалидного JSON - запрос на исправление (вместо полного повтора)
+        self.json_repair_enabled = os.getenv("LLM_JSON_REPAIR", "true").lower() == "true"
+        # Выбор провайдера по намерению вызова (intent), см. llm_routing
+        self.routing_policy: RoutingPolicy = get_routing_policy()
+        if self.alt_base_url:
+            print(f"[AsyncLLMClient] Hybrid mode: Primary={self.model}, Alternative={self.alt_model}")
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        return llm_pool.get_client(self.base_url, self.api_key)
+
+    @property
+    def alt_client(self) -> Optional[AsyncOpenAI]:
+        # Альтернативный клиент (GPT-4o через ProxyAPI)
+        if not self.alt_base_url:
+            return None
+        return llm_pool.get_client(self.alt_base_url, self.alt_api_key)
+
+    async def warmup(self) -> None:
+        """Прогреть соединения ко всем настроенным провайдерам."""
+        providers = [(self.base_url, self.api_key)]
+        if self.alt_base_url:
+            providers.append((self.alt_base_url, self.alt_api_key))
+        await llm_pool.warmup(providers)
+
+    # --- Выбор провайдера ---
+    def _provider_for(self, use_alt: bool) -> str:
+        """Имя провайдера: "alt" (GPT-4o) или "primary" (DeepSeek)."""
+        return "alt" if use_alt and self.alt_base_url else "primary"
+
+    def _provider_client(self, provider: str) -> AsyncOpenAI:
+        return self.alt_client if provider == "alt" else self.client
+
+    def _provider_model(self, provider: str, model: Optional[str]) -> str:
+        return model or (self.alt_model if provider == "alt" else self.model)
+
+    def _available_providers(self) -> List[str]:
+        return ["primary", "alt"] if self.alt_base_url else ["primary"]
+
+    def set_routing_policy(self, policy: RoutingPolicy) -> None:
+        """Подменить политику маршрутизации (например, своей реализацией RoutingPolicy)."""
+        self.routing_policy = policy
+
+    def _route(self, intent: str, call_site: str, messages: List[Dict[str, str]]) -> str:
+        """Провайдер для вызова с намерением intent (fast_json, long_context)."""
+        input_tokens = estimate_tokens({"messages": messages})
+        return self.routing_policy.choose(intent, call_site, input_tokens, self._available_providers())
+
+    def model_for(self, use_alt: bool = False, intent: Optional[str] = None) -> str:
+        """
+        Модель, которая скорее всего обработает запрос (для подсчёта токенов):
+        для intent - модель предпочтительного провайдера намерения.
+        """
+        if intent:
+            provider = self.routing_policy.preferred(intent, self._available_providers())[0]
+        else:
+            provider = self._provider_for(use_alt)
+        return self._provider_model(provider, None)
+
+    def routing_snapshot(self) -> Dict[str, Any]:
+        """Текущая политика маршрутизации и статистика провайдеров по этапам."""
+        return self.routing_policy.snapshot(["get_steps", "run_step", "finalize"], self._available_providers())
+
+    def _provider_kwargs(self, provider: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Параметры вызова для конкретного провайдера.
+        Явно заданная модель относится к запрошенному провайдеру; при переключении
+        на другого провайдера используется его модель по умолчанию.
+        """
+        model = request["model"] if provider == request["provider"] else None
+        kwargs = {
+            "model": self._provider_model(provider, model),
+            "messages": request["messages"],
+            "max_tokens": request["max_tokens"],
+            "temperature": request["temperature"],
+        }
+        if request.get("json_schema") and self.json_schema_support.get(provider):
+            kwargs["response_format"] = {"type": "json_schema", "json_schema": request["json_schema"]}
+        elif request.get("response_format_json"):
+            kwargs["response_format"] = {"type": "json_object"}
+        return kwargs
+
+    def _build_request(
+        self,
+        use_alt: bool,
+        system_prompt: Optional[str],
+        user_prompt: str,
+        model: Optional[str],
+        max_tokens: Optional[int],
+        temperature: float,
+        response_format_json: bool = False,
+        call_site: str = "api",
+        json_schema: Optional[Dict[str, Any]] = None,
+        intent: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Описание запроса, не зависящее от провайдера.
+        С intent провайдера выбирает политика маршрутизации, иначе - use_alt.
+        """
+        messages = self._build_messages(system_prompt, user_prompt)
+        provider = self._route(intent, call_site, messages) if intent else self._provider_for(use_alt)
+        return {
+            "provider": provider,
+            "call_site": call_site,
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens if max_tokens is not None else self.max_tokens,
+            "temperature": temperature,
+            "response_format_json": response_format_json,
+            "json_schema": json_schema,
+        }
+
+    def _continuation_request(self, request: Dict[str, Any], content: str) -> Dict[str, Any]:
+        """
+        Запрос на продолжение ответа, оборванного по max_tokens: модель получает
+        свой недописанный ответ и дописывает хвост. response_format не передаётся,
+        иначе модель начала бы новый JSON-объект вместо продолжения.
+        """
+        messages = request["messages"] + [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": _CONTINUE_PROMPT},
+        ]
+        return dict(
+            request,
+            messages=messages,
+            response_format_json=False,
+            json_schema=None,
+            call_site=f"{request['call_site']}:continue",
+        )
+
+    async def _parse_json_or_repair(self, request: Dict[str, Any], content: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Разбор JSON-ответа без полной перегенерации:
+        обычный разбор -> спасение оборванного JSON -> запрос на исправление.
+        Возвращает (результат, разобран ли ответ сразу): спасённый или исправленный
+        ответ может быть неполным, и в кэш его не кладём.
+        """
+        try:
+            return self.parse_json_content(content), True
+        except ValueError as exc:
+            parse_error = exc
+
+        partial = parse_partial_json(content)
+        if isinstance(partial, dict):
+            print(f"[AsyncLLMClient] {request['call_site']}: recovered truncated JSON")
+            return partial, False
+        if not self.json_repair_enabled:
+            raise parse_error
+
+        print(f"[AsyncLLMClient] {request['call_site']}: invalid JSON, requesting repair")
+        repair_request = self._build_request(
+            request["provider"] == "alt",
+            _REPAIR_PROMPT,
+            content,
+            None,
+            request["max_tokens"],
+            0.0,
+            response_format_json=True,
+            call_site=f"{request['call_site']}:repair",
+            json_schema=request.get("json_schema"),
+        )
+        completion = await self._create(repair_request)
+        return self.parse_json_content(self._extract_text(completion)), False
+
+    def _failover_order(self, provider: str) -> List[str]:
+        """
+        Порядок провайдеров для запроса. Обычно - запрошенный, затем другой.
+        Если запрошенный провайдер нездоров, а другой здоров - начинаем с другого;
+        когда запрошенный восстановится, порядок вернётся к обычному.
+        """
+        other = "primary" if provider == "alt" else "alt"
+        if not self.failover_enabled or (other == "alt" and not self.alt_base_url):
+            return [provider]
+        if not provider_health.get(provider).healthy and provider_health.get(other).healthy:
+            return [other, provider]
+        return [provider, other]
+
+    def _is_retryable(self, exc: BaseException) -> bool:
+        """Временные ошибки: таймауты, обрывы соединения, 408/409/429 и 5xx."""
+        if isinstance(exc, (APIConnectionError, RateLimitTimeout)):
+            return True
+        if isinstance(exc, APIStatusError):
+            return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+        return False
+
+    def _backoff_delay(self, attempt: int, exc: BaseException) -> float:
+        """Экспоненциальная задержка с полным jitter; учитываем Retry-After провайдера."""
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+        if isinstance(exc, APIStatusError):
+            retry_after = exc.response.headers.get("retry-after")
+            try:
+                delay = max(delay, min(self.retry_max_delay, float(retry_after)))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    async def _create(self, request: Dict[str, Any], stream: bool = False) -> Any:
+        """
+        Единая точка вызова провайдера: все chat*-методы идут через неё.
+        - перед запросом занимаем место в глобальном ограничителе RPM/TPM;
+        - временные ошибки повторяем с экспоненциальной задержкой (LLM_RETRY_ATTEMPTS);
+        - исчерпав попытки, переключаемся на другого провайдера (DeepSeek <-> GPT-4o);
+        - провайдер с открытым circuit breaker'ом пропускается без запроса, а если
+          открыты все - сразу бросаем CircuitOpenError, не дожидаясь таймаутов;
+        - каждая попытка записывается в llm_metrics (очередь, TTFB, задержка, токены).
+        Для стрима повторяется только установка соединения, но не обрыв посреди ответа.
+        """
+        last_exc: Optional[BaseException] = None
+        for provider in self._failover_order(request["provider"]):
+            kwargs = self._provider_kwargs(provider, request)
+            health = provider_health.get(provider)
+            breaker = circuit_breakers.get(provider)
+            for attempt in range(self.retry_attempts):
+                if not circuit_breakers.allow_request(provider):
+                    last_exc = CircuitOpenError(
+                        f"Провайдер '{provider}' временно отключён (circuit breaker open)"
+                    )
+                    break
+                record = llm_metrics.start_call(provider, kwargs["model"], request["call_site"])
+                try:
+                    await rate_limiter.acquire(provider, estimate_tokens(kwargs))
+                    client = self._provider_client(provider)
+                    llm_metrics.mark_sent(record)
+                    if stream:
+                        completion = await client.chat.completions.create(
+                            stream=True, stream_options={"include_usage": True}, **kwargs
+                        )
+                        # Успех или сбой запишет _MeteredStream, когда поток закончится
+                        return _MeteredStream(completion, record, health, breaker)
+                    completion = await client.chat.completions.create(**kwargs)
+                    health.record_success()
+                    breaker.record_success(time.perf_counter() - record["sent_at"])
+                    llm_metrics.finish_call(record, "ok", getattr(completion, "usage", None))
+                    return completion
+                except asyncio.CancelledError:
+                    # Вызов отменён по таймауту шага или ушёл клиент: долгий - медленный ответ
+                    if "sent_at" in record:
+                        breaker.record_cancelled(time.perf_counter() - record["sent_at"])
+                    llm_metrics.finish_call(record, "cancelled")
+                    raise
+                except Exception as exc:
+                    if not isinstance(exc, RateLimitTimeout):
+                        # Ответ с ошибкой клиента (400 и т.п.) - провайдер доступен
+                        if self._is_retryable(exc):
+                            breaker.record_failure()
+                        elif "sent_at" in record:
+                            breaker.record_success(time.perf_counter() - record["sent_at"])
+                    llm_metrics.finish_call(record, "error")
+                    if not self._is_retryable(exc):
+                        raise
+                    last_exc = exc
+                    health.record_failure(exc)
+                    # Очередь к провайдеру переполнена - повтор к нему же не поможет
+                    if isinstance(exc, RateLimitTimeout) or attempt + 1 >= self.retry_attempts:
+                        break
+                    delay = self._backoff_delay(attempt, exc)
+                    print(f"[AsyncLLMClient] {provider} attempt {attempt + 1} failed: {exc!r}; retry in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+            print(f"[AsyncLLMClient] {provider} failed after retries: {last_exc!r}")
+        raise last_exc
+
     # --- Основной функционал ---
-    def chat(
+    async def chat(
         self,
         prompt: str,
         *,
         model: Optional[str] = None,
         max_tokens: Optional[int] = None,
         temperature: float = 0.0,
-        use_alt: bool = False,  # Новый параметр для выбора клиента
+        use_alt: bool = False,
+        call_site: str = "api",
+        intent: Optional[str] = None,
     ) -> str:
         """Простой запрос. Возвращает текстовый ответ."""
-        # Выбор клиента и модели
-        if use_alt and self.alt_client:
-            client = self.alt_client
-            effective_model = model or self.alt_model
-        else:
-            client = self.client
-            effective_model = model or self.model
-            
-        effective_max_tokens = max_tokens if max_tokens is not None else self.max_tokens
-
-        messages = self._build_messages(self.system_prompt, prompt)
-
-        completion = client.chat.completions.create(
-            model=effective_model,
-            messages=messages,
-            max_tokens=effective_max_tokens,
+        return await self.chat_with_system(
+            self.system_prompt,
+            prompt,
+            model=model,
+            max_tokens=max_tokens,
             temperature=temperature,
+            use_alt=use_alt,
+            call_site=call_site,
+            intent=intent,
         )
-        return self._extract_text(completion)
 
-    def chat_with_system(
+    async def chat_with_system(
         self,
-        system_prompt: str,
+        system_prompt: Optional[str],
         user_prompt: str,
         *,
         model: Optional[str] = None,
         max_tokens: Optional[int] = None,
         temperature: float = 0.0,
-        use_alt: bool = False,  # Новый параметр для выбора клиента
+        use_alt: bool = False,
+        call_site: str = "api",
+        intent: Optional[str] = None,
     ) -> str:
         """Запрос с явным системным промптом. Возвращает текстовый ответ."""
-        # Выбор клиента и модели
-        if use_alt and self.alt_client:
-            client = self.alt_client
-            effective_model = model or self.alt_model
-        else:
-            client = self.client
-            effective_model = model or self.model
-            
-        effective_max_tokens = max_tokens if max_tokens is not None else self.max_tokens
-
-        messages = self._build_messages(system_prompt, user_prompt)
-
-        completion = client.chat.completions.create(
-            model=effective_model,
-            messages=messages,
-            max_tokens=effective_max_tokens,
-            temperature=temperature,
+        request = self._build_request(
+            use_alt, system_prompt, user_prompt, model, max_tokens, temperature,
+            call_site=call_site, intent=intent,
         )
+
+        completion = await self._create(request)
         return self._extract_text(completion)
 
-    def chat_json(
+    async def chat_json(
         self,
         system_prompt: str,
         user_prompt: str,
@@ -186,92 +547,211 @@ class LLMClient:
         max_tokens: Optional[int] = None,
         temperature: float = 0.0,
         response_format_json: bool = True,
-        use_alt: bool = False,  # Новый параметр для выбора клиента
+        use_alt: bool = False,
+        cache: Optional[bool] = None,
+        call_site: str = "api",
+        json_schema: Optional[Dict[str, Any]] = None,
+        intent: Optional[str] = None,
     ) -> Dict[str, Any]:
         """
         Запрос, ожидающий структурированный JSON-ответ.
         Возвращает распарсенный словарь Python.
-        """
-        # Выбор клиента и модели
-        if use_alt and self.alt_client:
-            client = self.alt_client
-            effective_model = model or self.alt_model
-        else:
-            client = self.client
-            effective_model = model or self.model
-            
-        effective_max_tokens = max_tokens if max_tokens is not None else self.max_tokens
 
-        messages = self._build_messages(system_prompt, user_prompt)
+        cache: использовать кэш ответов (llm_cache). По умолчанию кэш включается
+        переменной LLM_CACHE_ENABLED и только для детерминированных запросов
+        (temperature=0).
+        call_site: метка места вызова для метрик (get_steps, run_step, finalize, api).
+        json_schema: схема ответа (см. llm_schemas); провайдеру с поддержкой structured
+        output передаётся как response_format=json_schema, остальным - json_object.
+        intent: намерение вызова (fast_json, long_context) - провайдера выберет
+        политика маршрутизации; без intent провайдер задаёт use_alt.
+
+        Ответ, оборванный по max_tokens, дописывается продолжением; невалидный JSON
+        спасается разбором оборванного текста или запросом на исправление.
+        """
+        request = self._build_request(
+            use_alt, system_prompt, user_prompt, model, max_tokens, temperature, response_format_json,
+            call_site=call_site, json_schema=json_schema, intent=intent,
+        )
         # Логируем состав сообщений для диагностики
-        self._debug_log_messages(messages)
-        # Упрощенная логика без множественных retry
-        kwargs = {
-            "model": effective_model,
-            "messages": messages,
-            "max_tokens": effective_max_tokens,
-            "temperature": temperature,
-        }
-        if response_format_json:
-            kwargs["response_format"] = {"type": "json_object"}
-        
-        completion = client.chat.completions.create(**kwargs)
+        self._debug_log_messages(request["messages"])
+
+        use_cache, request_key = self._json_request_key(request, temperature, cache)
+        if use_cache:
+            cached = await llm_cache.get(request_key)
+            if cached is not None:
+                return cached
+
+        async def call_upstream() -> Dict[str, Any]:
+            result, clean = await self._chat_json_upstream(request)
+            if use_cache and clean:
+                await llm_cache.set(request_key, result)
+            return result
+
+        if request_key and singleflight.enabled:
+            # Такой же запрос уже выполняется (двойной клик, один URL у нескольких
+            # пользователей) - ждём его результат вместо второго вызова провайдера
+            return await singleflight.do(request_key, call_upstream)
+        return await call_upstream()
+
+    def _json_request_key(
+        self, request: Dict[str, Any], temperature: float, cache: Optional[bool]
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        (использовать ли кэш ответов, ключ запроса для кэша и singleflight).
+        Ключ не зависит от того, потоковый ли вызов: chat_json и chat_json_stream
+        с одинаковыми сообщениями и параметрами делят кэш и общий вызов провайдера.
+        """
+        use_cache = (llm_cache.enabled and temperature == 0.0) if cache is None else cache
+        if not (use_cache or singleflight.enabled):
+            return use_cache, None
+        provider = request["provider"]
+        request_key = llm_cache.make_key(
+            str(self._provider_client(provider).base_url),
+            self._provider_kwargs(provider, request),
+        )
+        return use_cache, request_key
 
+    async def _chat_json_upstream(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """
+        Вызов провайдера для chat_json: с дописыванием оборванного ответа и разбором JSON.
+        Возвращает (результат, можно ли его кэшировать): только ответ без продолжений,
+        разобранный с первого раза.
+        """
+        completion = await self._create(request)
         content = self._extract_text(completion)
-        # Прямая попытка
+        attempts = 0
+        while completion.choices[0].finish_reason == "length" and attempts < self.json_continue_attempts:
+            attempts += 1
+            print(f"[AsyncLLMClient] {request['call_site']}: response hit max_tokens, continuing ({attempts})")
+            completion = await self._create(self._continuation_request(request, content))
+            content += self._extract_text(completion)
+        result, clean = await self._parse_json_or_repair(request, content)
+        return result, clean and attempts == 0
+
+    async def chat_json_stream(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        model: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: float = 0.0,
+        response_format_json: bool = True,
+        use_alt: bool = False,
+        cache: Optional[bool] = None,
+        call_site: str = "api",
+        json_schema: Optional[Dict[str, Any]] = None,
+        intent: Optional[str] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Потоковый вариант chat_json. События:
+        - delta: очередной фрагмент текста JSON по мере генерации (продолжение
+          ответа, оборванного по max_tokens, дописывается в тот же поток);
+        - result: разобранный ответ (с исправлением JSON, как в chat_json) - последнее событие.
+        Кэш ответов и singleflight - те же, что у chat_json, с тем же ключом: при
+        попадании в кэш или если такой же запрос уже выполняется, delta-событий
+        нет - сразу result.
+        """
+        request = self._build_request(
+            use_alt, system_prompt, user_prompt, model, max_tokens, temperature, response_format_json,
+            call_site=call_site, json_schema=json_schema, intent=intent,
+        )
+        self._debug_log_messages(request["messages"])
+
+        use_cache, request_key = self._json_request_key(request, temperature, cache)
+        if use_cache:
+            cached = await llm_cache.get(request_key)
+            if cached is not None:
+                yield {"event": "result", "data": cached}
+                return
+
+        deltas: asyncio.Queue = asyncio.Queue()
+
+        async def call_upstream() -> Dict[str, Any]:
+            result, clean = await self._chat_json_stream_upstream(request, deltas)
+            if use_cache and clean:
+                await llm_cache.set(request_key, result)
+            return result
+
+        if request_key and singleflight.enabled:
+            # Фрагменты получает только лидер; остальные дожидаются его результата
+            flight = asyncio.ensure_future(singleflight.do(request_key, call_upstream))
+        else:
+            flight = asyncio.ensure_future(call_upstream())
+        flight.add_done_callback(lambda _: deltas.put_nowait(None))
         try:
-            return json.loads(content)
-        except json.JSONDecodeError:
-            pass
-
-        # Fallback 1: вырезать блок кода ```json ... ``` или ``` ... ```
-        text = content.strip()
-        fences = ["```json", "```"]
-        for fence in fences:
-            if fence in text:
-                try:
-                    start = text.index(fence) + len(fence)
-                    end = text.index("```", start)
-                    candidate = text[start:end].strip()
-                    return json.loads(candidate)
-                except Exception:
+            while True:
+                delta = await deltas.get()
+                if delta is None:
+                    break
+                yield {"event": "delta", "data": delta}
+            result = flight.result()
+        finally:
+            flight.cancel()
+        yield {"event": "result", "data": result}
+
+    async def _chat_json_stream_upstream(
+        self, request: Dict[str, Any], deltas: asyncio.Queue
+    ) -> Tuple[Dict[str, Any], bool]:
+        """
+        Потоковый вызов провайдера: фрагменты кладутся в deltas, собранный текст
+        разбирается в конце. Возвращает (результат, можно ли его кэшировать), как
+        _chat_json_upstream.
+        """
+        content = ""
+        current = request
+        continued = False
+        for attempt in range(self.json_continue_attempts + 1):
+            finish_reason = None
+            stream = await self._create(current, stream=True)
+            async for chunk in stream:
+                if not chunk.choices:
                     continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                delta = choice.delta.content
+                if delta:
+                    content += delta
+                    deltas.put_nowait(delta)
+            if finish_reason != "length" or attempt >= self.json_continue_attempts:
+                break
+            print(f"[AsyncLLMClient] {request['call_site']}: stream hit max_tokens, continuing ({attempt + 1})")
+            continued = True
+            current = self._continuation_request(request, content)
+        result, clean = await self._parse_json_or_repair(request, content)
+        return result, clean and not continued
 
-        # Fallback 2: взять подстроку между первой { и последней }
-        if "{" in text and "}" in text:
-            try:
-                start = text.index("{")
-                end = text.rindex("}") + 1
-                candidate = text[start:end]
-                return json.loads(candidate)
-            except Exception:
-                pass
 
-        # Fallback 3: заменить одинарные кавычки на двойные, если это валидно
-        try:
-            normalized = text.replace("'", '"')
-            return json.loads(normalized)
-        except Exception as exc:
-            raise ValueError(
-                "Модель вернула невалидный JSON. Попробуйте уточнить инструкции или увеличить max_tokens."
-            ) from exc
+_shared_llm_client: Optional[AsyncLLMClient] = None
+
+
+def get_shared_llm_client() -> AsyncLLMClient:
+    """
+    Общий AsyncLLMClient процесса (конфигурация из .env).
+    Используется роутерами и обработчиком фоновых задач.
+    """
+    global _shared_llm_client
+    if _shared_llm_client is None:
+        _shared_llm_client = AsyncLLMClient()
+    return _shared_llm_client
 
 
-__all__ = ["LLMClient"]
+__all__ = ["AsyncLLMClient", "get_shared_llm_client"]
 
 
 if __name__ == "__main__":
     # Простейшие тестовые запуски методов
-    try:
-        client = LLMClient()
+    async def _demo() -> None:
+        client = AsyncLLMClient()
         client.set_system_prompt("Ты — краткий и полезный помощник.")
         client.set_max_tokens(300)
 
-        print("[chat] ->", client.chat("What is JSON in one sentence?"))
+        print("[chat] ->", await client.chat("What is JSON in one sentence?"))
 
         print(
             "[chat_with_system] ->",
-            client.chat_with_system(
+            await client.chat_with_system(
                 "Answer in one sentence.",
                 "What is async in Python?",
             ),
@@ -279,12 +759,13 @@ if __name__ == "__main__":
 
         print(
             "[chat_json] ->",
-            client.chat_json(
+            await client.chat_json(
                 "Response must be valid JSON with fields: title (str) and bullets (list[str]).",
                 "Create a brief summary about Python exceptions (3-4 points).",
             ),
         )
+
+    try:
+        asyncio.run(_demo())
     except Exception as e:
         print("Test run error:", e)
-
-
@@ -0,0 +1,279 @@
+"""
+Метрики вызовов LLM: задержки, токены и стоимость.
+
+На каждый вызов провайдера создаётся запись: провайдер, модель, место вызова
+(get_steps / run_step / finalize / api), ожидание в очереди ограничителя,
+время до первого байта ответа, полная задержка и токены из completion.usage.
+Записи попадают в гистограммы/счётчики процесса (экспорт в формате Prometheus)
+и в сводку текущего анализа (см. collect()).
+"""
+import contextvars
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# Текущий вызов провайдера (для замера времени до первого байта в httpx-хуке)
+_current_call: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    "llm_current_call", default=None
+)
+# Записи вызовов текущего анализа (None - сбор не ведётся)
+_collected_calls: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "llm_collected_calls", default=None
+)
+
+
+def _cached_tokens(usage: Any) -> int:
+    """
+    Входные токены, взятые из кэша контекста провайдера:
+    DeepSeek - usage.prompt_cache_hit_tokens, OpenAI - usage.prompt_tokens_details.cached_tokens.
+    """
+    cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+    return cached or 0
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами и метками."""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # labels -> [counts по корзинам..., sum, count]
+        self._series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = [0.0] * (len(self.buckets) + 2)
+            self._series[key] = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            labels = ",".join(f'{k}="{v}"' for k, v in key)
+            sep = "," if labels else ""
+            for i, bound in enumerate(self.buckets):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {series[i]:g}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]:g}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]:g}")
+        return lines
+
+
+class Counter:
+    """Счётчик с метками."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            labels = ",".join(f'{k}="{v}"' for k, v in key)
+            lines.append(f"{self.name}{{{labels}}} {value:g}")
+        return lines
+
+
+class LLMMetrics:
+    """Метрики LLM-вызовов одного процесса воркера."""
+
+    def __init__(self):
+        # Цены за 1 млн токенов (USD): вход / выход / вход из кэша контекста провайдера
+        self.prices: Dict[str, Tuple[float, float, float]] = {
+            "primary": (
+                float(os.getenv("LLM_PRICE_PRIMARY_INPUT", "0.27")),
+                float(os.getenv("LLM_PRICE_PRIMARY_OUTPUT", "1.10")),
+                float(os.getenv("LLM_PRICE_PRIMARY_CACHED", "0.07")),
+            ),
+            "alt": (
+                float(os.getenv("LLM_PRICE_ALT_INPUT", "2.50")),
+                float(os.getenv("LLM_PRICE_ALT_OUTPUT", "10.00")),
+                float(os.getenv("LLM_PRICE_ALT_CACHED", "1.25")),
+            ),
+        }
+        self.requests = Counter("llm_requests_total", "LLM calls by provider, model, call site and status")
+        self.tokens = Counter("llm_tokens_total", "LLM tokens by provider, model, call site and kind")
+        self.cost = Counter("llm_cost_usd_total", "Estimated LLM cost in USD")
+        self.queue_wait = Histogram("llm_queue_wait_seconds", "Time spent waiting for the rate limiter")
+        self.ttfb = Histogram("llm_ttfb_seconds", "Time to first byte of the provider response")
+        self.latency = Histogram("llm_latency_seconds", "Total LLM call latency")
+        # Последние вызовы по (провайдер, этап): (время, задержка, успех) - для маршрутизации
+        self._recent: Dict[Tuple[str, str], Deque[Tuple[float, float, bool]]] = {}
+
+    # --- Жизненный цикл записи о вызове ---
+    def start_call(self, provider: str, model: str, call_site: str) -> Dict[str, Any]:
+        record = {
+            "provider": provider,
+            "model": model,
+            "call_site": call_site,
+            "started_at": time.perf_counter(),
+            "queue_wait": 0.0,
+            "ttfb": None,
+        }
+        return record
+
+    def mark_sent(self, record: Dict[str, Any]) -> None:
+        """Запрос уходит провайдеру: всё до этого момента - ожидание в очереди."""
+        now = time.perf_counter()
+        record["queue_wait"] = now - record["started_at"]
+        record["sent_at"] = now
+        _current_call.set(record)
+
+    def mark_first_byte(self, record: Dict[str, Any]) -> None:
+        if record.get("ttfb") is None and "sent_at" in record:
+            record["ttfb"] = time.perf_counter() - record["sent_at"]
+
+    def finish_call(self, record: Dict[str, Any], status: str, usage: Any = None) -> Dict[str, Any]:
+        """Завершить запись: посчитать задержку, токены, стоимость и выгрузить в метрики."""
+        if _current_call.get() is record:
+            _current_call.set(None)
+        record.pop("sent_at", None)
+        started_at = record.pop("started_at")
+        record["latency"] = time.perf_counter() - started_at
+        record["status"] = status
+        record["prompt_tokens"] = getattr(usage, "prompt_tokens", 0) or 0
+        record["completion_tokens"] = getattr(usage, "completion_tokens", 0) or 0
+        record["cached_tokens"] = _cached_tokens(usage)
+        price_in, price_out, price_cached = self.prices.get(record["provider"], (0.0, 0.0, 0.0))
+        record["cost_usd"] = (
+            (record["prompt_tokens"] - record["cached_tokens"]) * price_in
+            + record["cached_tokens"] * price_cached
+            + record["completion_tokens"] * price_out
+        ) / 1_000_000
+
+        labels = {"provider": record["provider"], "call_site": record["call_site"]}
+        self.requests.inc(model=record["model"], status=status, **labels)
+        self.queue_wait.observe(record["queue_wait"], **labels)
+        self.latency.observe(record["latency"], **labels)
+        if record["ttfb"] is not None:
+            self.ttfb.observe(record["ttfb"], **labels)
+        if record["prompt_tokens"]:
+            self.tokens.inc(record["prompt_tokens"], model=record["model"], kind="prompt", **labels)
+        if record["completion_tokens"]:
+            self.tokens.inc(record["completion_tokens"], model=record["model"], kind="completion", **labels)
+        if record["cached_tokens"]:
+            self.tokens.inc(record["cached_tokens"], model=record["model"], kind="cached", **labels)
+        if record["cost_usd"]:
+            self.cost.inc(record["cost_usd"], **labels)
+
+        # Оборванный клиентом стрим ничего не говорит о провайдере
+        if status != "aborted":
+            stage = record["call_site"].split(":")[0]
+            recent = self._recent.setdefault((record["provider"], stage), deque(maxlen=1000))
+            recent.append((time.monotonic(), record["latency"], status == "ok"))
+
+        calls = _collected_calls.get()
+        if calls is not None:
+            calls.append(record)
+        return record
+
+    def recent_stats(self, provider: str, stage: str, window: float) -> Dict[str, Any]:
+        """Число вызовов, p95 задержки и доля ошибок провайдера на этапе за последние window секунд."""
+        since = time.monotonic() - window
+        samples = [(latency, ok) for ts, latency, ok in self._recent.get((provider, stage), ()) if ts >= since]
+        if not samples:
+            return {"count": 0, "p95": 0.0, "error_rate": 0.0}
+        latencies = sorted(latency for latency, _ in samples)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        errors = sum(1 for _, ok in samples if not ok)
+        return {"count": len(samples), "p95": round(p95, 3), "error_rate": round(errors / len(samples), 3)}
+
+    async def on_response(self, response: httpx.Response) -> None:
+        """httpx event hook: заголовки ответа получены - это время до первого байта."""
+        record = _current_call.get()
+        if record is not None:
+            self.mark_first_byte(record)
+
+    # --- Сводка по анализу ---
+    @contextmanager
+    def collect(self) -> Iterator[List[Dict[str, Any]]]:
+        """Собрать записи всех LLM-вызовов внутри блока (включая дочерние задачи asyncio)."""
+        calls: List[Dict[str, Any]] = []
+        token = _collected_calls.set(calls)
+        try:
+            yield calls
+        finally:
+            try:
+                _collected_calls.reset(token)
+            except ValueError:
+                # Асинхронный генератор закрыт в другом контексте - сбрасывать нечего
+                pass
+
+    def summarize(self, calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Сводка по местам вызова: число вызовов, токены, задержки, стоимость."""
+        by_site: Dict[str, Dict[str, Any]] = {}
+        for call in calls:
+            site = by_site.setdefault(call["call_site"], {
+                "calls": 0,
+                "errors": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "cost_usd": 0.0,
+                "latency_max": 0.0,
+                "latency_sum": 0.0,
+                "queue_wait_sum": 0.0,
+                "providers": [],
+            })
+            site["calls"] += 1
+            if call["status"] != "ok":
+                site["errors"] += 1
+            site["prompt_tokens"] += call["prompt_tokens"]
+            site["completion_tokens"] += call["completion_tokens"]
+            site["cached_tokens"] += call["cached_tokens"]
+            site["cost_usd"] += call["cost_usd"]
+            site["latency_max"] = max(site["latency_max"], call["latency"])
+            site["latency_sum"] += call["latency"]
+            site["queue_wait_sum"] += call["queue_wait"]
+            if call["provider"] not in site["providers"]:
+                site["providers"].append(call["provider"])
+
+        for site in by_site.values():
+            for key in ("cost_usd", "latency_max", "latency_sum", "queue_wait_sum"):
+                site[key] = round(site[key], 6 if key == "cost_usd" else 3)
+
+        prompt_tokens = sum(c["prompt_tokens"] for c in calls)
+        cached_tokens = sum(c["cached_tokens"] for c in calls)
+        return {
+            "calls": len(calls),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": sum(c["completion_tokens"] for c in calls),
+            "cached_tokens": cached_tokens,
+            # Доля входных токенов, взятых из кэша контекста провайдера
+            "cache_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+            "cost_usd": round(sum(c["cost_usd"] for c in calls), 6),
+            "by_call_site": by_site,
+        }
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        for metric in (self.requests, self.tokens, self.cost, self.queue_wait, self.ttfb, self.latency):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный экземпляр метрик (по одному на процесс воркера)
+llm_metrics = LLMMetrics()
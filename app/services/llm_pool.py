@@ -0,0 +1,113 @@
+"""
+Общий пул HTTP-соединений к LLM-провайдерам.
+
+Один keep-alive httpx-клиент на провайдера в каждом процессе воркера:
+его используют и роутеры, и обработчик фоновых задач, поэтому TCP/TLS
+рукопожатия не повторяются на каждый запрос или задачу.
+"""
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.services.llm_metrics import llm_metrics
+
+
+class LLMConnectionPool:
+    """Пул соединений к LLM-провайдерам в пределах одного процесса."""
+
+    def __init__(self):
+        self.max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+        self.max_keepalive_connections = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+        self.request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+        self.connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+        self.warmup_connections = int(os.getenv("LLM_WARMUP_CONNECTIONS", "2"))
+        self._pid: Optional[int] = None
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+        self._clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+
+    def _ensure_process(self) -> None:
+        """
+        gunicorn запускается с preload_app=True: приложение импортируется до fork.
+        Соединения родительского процесса воркеру не передаём - создаём свои.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._http_clients = {}
+            self._clients = {}
+
+    def get_http_client(self, base_url: str) -> httpx.AsyncClient:
+        """Общий httpx-клиент для провайдера с указанным base_url."""
+        self._ensure_process()
+        http_client = self._http_clients.get(base_url)
+        if http_client is None or http_client.is_closed:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+            http_client = httpx.AsyncClient(
+                limits=limits,
+                timeout=httpx.Timeout(self.request_timeout, connect=self.connect_timeout),
+                # Время до первого байта ответа провайдера для метрик
+                event_hooks={"response": [llm_metrics.on_response]},
+            )
+            self._http_clients[base_url] = http_client
+        return http_client
+
+    def get_client(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        """AsyncOpenAI поверх общего httpx-клиента провайдера."""
+        self._ensure_process()
+        key = (base_url, api_key)
+        client = self._clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                default_headers={"Authorization": f"Bearer {api_key}"},
+                http_client=self.get_http_client(base_url),
+                # Повторы выполняет AsyncLLMClient (с переключением провайдера)
+                max_retries=0,
+            )
+            self._clients[key] = client
+        return client
+
+    async def warmup(self, providers: List[Tuple[str, str]]) -> None:
+        """
+        Заранее открыть соединения (TCP + TLS) к провайдерам.
+        Для каждого провайдера выполняется LLM_WARMUP_CONNECTIONS параллельных
+        лёгких запросов GET /models; код ответа не важен, важно само соединение.
+        """
+        async def touch(base_url: str, api_key: str) -> None:
+            http_client = self.get_http_client(base_url)
+            try:
+                await http_client.get(
+                    f"{base_url.rstrip('/')}/models",
+                    headers={"Authorization": f"Bearer {api_key}"},
+                )
+            except httpx.HTTPError as exc:
+                print(f"[LLMConnectionPool] Warm-up failed for {base_url}: {exc}")
+
+        tasks = [
+            touch(base_url, api_key)
+            for base_url, api_key in providers
+            for _ in range(self.warmup_connections)
+        ]
+        if tasks:
+            await asyncio.gather(*tasks)
+            print(f"[LLMConnectionPool] Warmed up {len(providers)} provider(s)")
+
+    async def close(self) -> None:
+        """Закрыть все соединения (при остановке приложения)."""
+        for http_client in self._http_clients.values():
+            await http_client.aclose()
+        self._http_clients = {}
+        self._clients = {}
+
+
+# Глобальный экземпляр пула (по одному на процесс воркера)
+llm_pool = LLMConnectionPool()
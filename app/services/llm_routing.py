@@ -0,0 +1,125 @@
+"""
+Маршрутизация LLM-вызовов между провайдерами (primary - DeepSeek, alt - GPT-4o).
+
+Вызывающий код сообщает намерение (intent), а не провайдера:
+- fast_json    - короткий структурированный ответ (планирование шагов, посты);
+- long_context - анализ большого текста сайта.
+Политика выбирает провайдера с учётом размера входа, контекстного окна
+и живой статистики провайдера на этом этапе (p95 задержки, доля ошибок)
+относительно целевой задержки этапа.
+"""
+import os
+from typing import Any, Dict, List, Optional, Type
+
+from app.services.llm_metrics import llm_metrics
+
+
+# Порядок предпочтения провайдеров для намерения (без учёта статистики)
+INTENT_PREFERENCES: Dict[str, List[str]] = {
+    "fast_json": ["alt", "primary"],      # GPT-4o быстрее отдаёт короткий JSON
+    "long_context": ["primary", "alt"],   # DeepSeek дешевле на больших входах
+    "default": ["primary", "alt"],
+}
+
+
+class RoutingPolicy:
+    """Базовая политика: порядок предпочтения намерения без учёта статистики."""
+
+    name = "static"
+
+    def preferred(self, intent: str, available: List[str]) -> List[str]:
+        order = INTENT_PREFERENCES.get(intent, INTENT_PREFERENCES["default"])
+        return [provider for provider in order if provider in available]
+
+    def choose(self, intent: str, stage: str, input_tokens: int, available: List[str]) -> str:
+        """Провайдер для вызова. available - настроенные провайдеры."""
+        return self.preferred(intent, available)[0]
+
+    def snapshot(self, stages: List[str], available: List[str]) -> Dict[str, Any]:
+        return {"policy": self.name}
+
+
+class SLORoutingPolicy(RoutingPolicy):
+    """
+    Предпочтительный провайдер, пока он укладывается в целевую задержку этапа
+    (p95 за окно) и допустимую долю ошибок; иначе - следующий по предпочтению.
+    Если не укладывается никто - провайдер с лучшей статистикой.
+    Статистика старше окна забывается, поэтому отвергнутый провайдер снова
+    получает запросы и может вернуть себе трафик.
+    """
+
+    name = "slo"
+
+    def __init__(self):
+        self.window = float(os.getenv("LLM_ROUTING_WINDOW", "300"))
+        self.min_samples = int(os.getenv("LLM_ROUTING_MIN_SAMPLES", "5"))
+        self.max_error_rate = float(os.getenv("LLM_ROUTING_MAX_ERROR_RATE", "0.2"))
+        # Целевая p95 задержка вызова на этапе (сек)
+        self.targets: Dict[str, float] = {
+            "get_steps": float(os.getenv("LLM_SLO_GET_STEPS", "10")),
+            "run_step": float(os.getenv("LLM_SLO_RUN_STEP", "30")),
+            "finalize": float(os.getenv("LLM_SLO_FINALIZE", "25")),
+        }
+        self.default_target = float(os.getenv("LLM_SLO_DEFAULT", "30"))
+        # Контекстное окно провайдера (токенов): больший вход туда не отправляем
+        self.context_limits: Dict[str, int] = {
+            "primary": int(os.getenv("LLM_CONTEXT_PRIMARY", "64000")),
+            "alt": int(os.getenv("LLM_CONTEXT_ALT", "128000")),
+        }
+        self._last_choice: Dict[str, str] = {}
+
+    def choose(self, intent: str, stage: str, input_tokens: int, available: List[str]) -> str:
+        preferred = self.preferred(intent, available)
+        candidates = [p for p in preferred if input_tokens <= self.context_limits.get(p, input_tokens)]
+        if not candidates:
+            candidates = preferred
+        target = self.targets.get(stage, self.default_target)
+
+        choice: Optional[str] = None
+        reason = ""
+        fallback = []
+        for provider in candidates:
+            stats = llm_metrics.recent_stats(provider, stage, self.window)
+            if stats["count"] < self.min_samples:
+                choice, reason = provider, "мало статистики"
+                break
+            if stats["p95"] <= target and stats["error_rate"] <= self.max_error_rate:
+                choice, reason = provider, f"p95 {stats['p95']:.1f}s"
+                break
+            fallback.append((stats["error_rate"] > self.max_error_rate, stats["p95"], provider))
+        if choice is None:
+            choice = min(fallback)[2]
+            reason = "все вне цели, лучший по статистике"
+
+        if self._last_choice.get(stage) != choice:
+            if stage in self._last_choice:
+                print(f"[LLMRouting] {stage}: {self._last_choice[stage]} -> {choice} ({reason}, цель {target:.0f}s)")
+            self._last_choice[stage] = choice
+        return choice
+
+    def snapshot(self, stages: List[str], available: List[str]) -> Dict[str, Any]:
+        return {
+            "policy": self.name,
+            "targets": self.targets,
+            "last_choice": dict(self._last_choice),
+            "stats": {
+                stage: {provider: llm_metrics.recent_stats(provider, stage, self.window) for provider in available}
+                for stage in stages
+            },
+        }
+
+
+ROUTING_POLICIES: Dict[str, Type[RoutingPolicy]] = {
+    "static": RoutingPolicy,
+    "slo": SLORoutingPolicy,
+}
+
+
+def get_routing_policy(name: Optional[str] = None) -> RoutingPolicy:
+    """Политика по имени (по умолчанию LLM_ROUTING_POLICY, "slo")."""
+    name = name or os.getenv("LLM_ROUTING_POLICY", "slo")
+    policy_cls = ROUTING_POLICIES.get(name)
+    if policy_cls is None:
+        print(f"[LLMRouting] Warning: unknown policy '{name}', using static")
+        policy_cls = RoutingPolicy
+    return policy_cls()
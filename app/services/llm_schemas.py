@@ -0,0 +1,29 @@
+"""
+JSON-схемы ответов LLM для режима structured output (response_format=json_schema).
+Провайдер, который его поддерживает, не может вернуть ответ другой структуры;
+для остальных схема не передаётся и работает обычный json_object.
+"""
+from typing import Any, Dict
+
+
+def _string_list_schema(name: str, key: str) -> Dict[str, Any]:
+    """Схема объекта с одним ключом key - массивом строк."""
+    return {
+        "name": name,
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                key: {"type": "array", "items": {"type": "string"}},
+            },
+            "required": [key],
+            "additionalProperties": False,
+        },
+    }
+
+
+# get_steps: {"steps": ["шаг 1", ...]}
+STEPS_SCHEMA = _string_list_schema("analysis_steps", "steps")
+
+# finalize: {"posts": ["пост 1", "пост 2", "пост 3"]}
+POSTS_SCHEMA = _string_list_schema("social_posts", "posts")
@@ -0,0 +1,67 @@
+"""
+Анализ больших сайтов по частям (map-reduce).
+
+Каталоги и документация не помещаются в бюджет токенов этапов, и при
+обычном усечении всё после начала страницы в анализ не попадает. Вместо
+этого полный текст делится на части, каждая часть параллельно сжимается
+в конспект фактов (map), а get_steps и шаги анализа работают с
+объединёнными конспектами (reduce). Режим включается сам, когда текст
+заметно больше бюджета: немного превышающий бюджет текст дешевле и
+быстрее обрезать, чем делать лишний круг запросов к LLM.
+"""
+import os
+from typing import List, Tuple
+
+from app.services.retrieval import chunk_text
+from app.services.token_budget import token_budget
+
+
+class MapReducePlanner:
+    """Решение о режиме map-reduce, деление текста на части и сборка конспектов."""
+
+    def __init__(self):
+        # auto - по размеру текста, always - для любого текста, off - только усечение
+        self.mode = os.getenv("MAPREDUCE_MODE", "auto").lower()
+        # auto: части, если текст больше бюджета этапов хотя бы во столько раз
+        self.min_ratio = float(os.getenv("MAPREDUCE_MIN_RATIO", "1.5"))
+        # Размер части (токенов модели конспектов)
+        self.chunk_tokens = int(os.getenv("MAPREDUCE_CHUNK_TOKENS", "6000"))
+        # Больше частей не обрабатываем: хвост такого текста отбрасывается, как при усечении
+        self.max_chunks = int(os.getenv("MAPREDUCE_MAX_CHUNKS", "12"))
+        # Одновременных запросов конспектов в рамках одного анализа
+        self.concurrency = int(os.getenv("MAPREDUCE_CONCURRENCY", "4"))
+        self.summary_max_tokens = int(os.getenv("MAPREDUCE_SUMMARY_MAX_TOKENS", "600"))
+        self.chunk_timeout = float(os.getenv("MAPREDUCE_CHUNK_TIMEOUT", "60"))
+
+    def should_map(self, text: str, model: str, budget: int) -> bool:
+        """Нужен ли map-reduce для текста при бюджете этапов budget (токенов model)."""
+        if self.mode == "always":
+            return bool(text.strip())
+        if self.mode != "auto":
+            return False
+        threshold = int(budget * self.min_ratio)
+        # Дальше порога не считаем: достаточно знать, что текст его превышает
+        return token_budget.count(text[: threshold * 10], model) > threshold
+
+    def split(self, text: str, model: str) -> Tuple[List[str], int]:
+        """
+        Части текста по целым строкам примерно по chunk_tokens токенов.
+        Возвращает (части, сколько символов хвоста не вошло из-за MAPREDUCE_MAX_CHUNKS).
+        """
+        # Символов на токен - по началу текста (у кириллицы и латиницы он разный)
+        sample = text[:20000]
+        chars_per_token = len(sample) / max(token_budget.count(sample, model), 1)
+        chunks = chunk_text(text, max(int(self.chunk_tokens * chars_per_token), 1000))
+        kept = chunks[: self.max_chunks]
+        dropped = max(len(text) - sum(len(chunk) + 1 for chunk in kept), 0) if len(chunks) > len(kept) else 0
+        return kept, dropped
+
+    @staticmethod
+    def merge(summaries: List[str]) -> str:
+        """Конспекты частей одним текстом в порядке страницы (пустые пропускаются)."""
+        parts = [summary.strip() for summary in summaries if summary and summary.strip()]
+        return "\n\n".join(f"[Часть {i} из {len(parts)}]\n{part}" for i, part in enumerate(parts, 1))
+
+
+# Глобальный экземпляр
+map_reduce = MapReducePlanner()
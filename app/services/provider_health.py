@@ -0,0 +1,76 @@
+"""
+Учёт состояния LLM-провайдеров (primary - DeepSeek, alt - GPT-4o) в пределах воркера.
+По нему AsyncLLMClient решает, с какого провайдера начинать и куда переключаться.
+"""
+import os
+import time
+from typing import Any, Dict, Optional
+
+
+class ProviderHealth:
+    """Счётчики успехов/ошибок одного провайдера."""
+
+    def __init__(self, name: str, unhealthy_after: int, recheck_after: float):
+        self.name = name
+        self.unhealthy_after = unhealthy_after
+        self.recheck_after = recheck_after
+        self.consecutive_failures = 0
+        self.total_successes = 0
+        self.total_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[float] = None
+        self.last_success_at: Optional[float] = None
+
+    @property
+    def healthy(self) -> bool:
+        if self.consecutive_failures < self.unhealthy_after:
+            return True
+        # Спустя recheck_after секунд снова пробуем провайдера первым (возврат после сбоя)
+        return self.last_error_at is not None and time.time() - self.last_error_at >= self.recheck_after
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.total_successes += 1
+        self.last_success_at = time.time()
+
+    def record_failure(self, exc: BaseException) -> None:
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        self.last_error = f"{type(exc).__name__}: {exc}"[:300]
+        self.last_error_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "total_successes": self.total_successes,
+            "total_failures": self.total_failures,
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+            "last_success_at": self.last_success_at,
+        }
+
+
+class ProviderHealthRegistry:
+    """Состояние всех провайдеров воркера."""
+
+    def __init__(self):
+        # После скольких ошибок подряд провайдер считается нездоровым
+        self.unhealthy_after = int(os.getenv("LLM_UNHEALTHY_AFTER", "3"))
+        # Через сколько секунд после последней ошибки снова считать провайдера кандидатом №1
+        self.recheck_after = float(os.getenv("LLM_UNHEALTHY_RECHECK", "30"))
+        self._providers: Dict[str, ProviderHealth] = {}
+
+    def get(self, name: str) -> ProviderHealth:
+        health = self._providers.get(name)
+        if health is None:
+            health = ProviderHealth(name, self.unhealthy_after, self.recheck_after)
+            self._providers[name] = health
+        return health
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: health.snapshot() for name, health in self._providers.items()}
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+provider_health = ProviderHealthRegistry()
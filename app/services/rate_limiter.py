@@ -0,0 +1,171 @@
+"""
+Глобальный ограничитель запросов к LLM-провайдерам (RPM/TPM).
+
+Token bucket хранится в Redis и общий для всех воркеров gunicorn, поэтому
+суммарная нагрузка на провайдера не зависит от числа воркеров.
+Каждый вызов резервирует 1 запрос и оценку токенов; если в ведре не хватает,
+вызывающий получает время ожидания и встаёт в очередь - запросы уходят
+равномерно, а не пачкой, которая упирается в 429 у провайдера.
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import aioredis
+
+
+# Атомарное резервирование в обоих ведрах (запросы и токены).
+# Баланс может уйти в минус: это и есть очередь - следующий вызывающий ждёт дольше.
+# Возвращает время ожидания в мс; -1, если ожидание превысило бы max_wait.
+_ACQUIRE_SCRIPT = """
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local req_capacity = tonumber(ARGV[3])
+local tok_capacity = tonumber(ARGV[4])
+local cost = tonumber(ARGV[5])
+local max_wait = tonumber(ARGV[6])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local data = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts')
+local req = tonumber(data[1]) or req_capacity
+local tok = tonumber(data[2]) or tok_capacity
+local ts = tonumber(data[3]) or now
+local elapsed = math.max(0, now - ts)
+local wait = 0
+if rpm > 0 then
+  req = math.min(req_capacity, req + elapsed * rpm / 60000)
+  if req < 1 then wait = math.max(wait, (1 - req) * 60000 / rpm) end
+end
+if tpm > 0 then
+  tok = math.min(tok_capacity, tok + elapsed * tpm / 60000)
+  if tok < cost then wait = math.max(wait, (cost - tok) * 60000 / tpm) end
+end
+if wait > max_wait then
+  redis.call('HSET', KEYS[1], 'req', req, 'tok', tok, 'ts', now)
+  return -1
+end
+if rpm > 0 then req = req - 1 end
+if tpm > 0 then tok = tok - cost end
+redis.call('HSET', KEYS[1], 'req', req, 'tok', tok, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 300000)
+return math.ceil(wait)
+"""
+
+
+class RateLimitTimeout(RuntimeError):
+    """Провайдер перегружен: ожидание в очереди превысило LLM_RATE_MAX_WAIT."""
+
+
+class LLMRateLimiter:
+    """Token bucket RPM/TPM на провайдера (primary - DeepSeek, alt - GPT-4o)."""
+
+    def __init__(self, redis_url: str = None):
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.redis: Optional[aioredis.Redis] = None
+        self._redis_retry_at = 0.0
+        # Размер "пачки" в секундах: сколько запросов можно отправить сразу без ожидания
+        self.burst_seconds = float(os.getenv("LLM_RATE_BURST_SECONDS", "5"))
+        self.max_wait = float(os.getenv("LLM_RATE_MAX_WAIT", "30"))
+        # 0 - без ограничения
+        self.limits: Dict[str, Tuple[int, int]] = {
+            "primary": (int(os.getenv("LLM_RPM_PRIMARY", "0")), int(os.getenv("LLM_TPM_PRIMARY", "0"))),
+            "alt": (int(os.getenv("LLM_RPM_ALT", "0")), int(os.getenv("LLM_TPM_ALT", "0"))),
+        }
+        # Локальные ведра на случай недоступности Redis: provider -> [req, tok, ts]
+        self._local: Dict[str, list] = {}
+        self._local_lock = asyncio.Lock()
+
+    async def _get_redis(self) -> Optional[aioredis.Redis]:
+        if not self.redis:
+            if time.monotonic() < self._redis_retry_at:
+                return None
+            try:
+                self.redis = await aioredis.from_url(self.redis_url, decode_responses=True)
+            except Exception as exc:
+                print(f"[LLMRateLimiter] Warning: Redis unavailable, using local buckets: {exc}")
+                self._redis_retry_at = time.monotonic() + 30
+                return None
+        return self.redis
+
+    def _capacities(self, rpm: int, tpm: int) -> Tuple[float, float]:
+        req_capacity = max(1.0, rpm * self.burst_seconds / 60)
+        tok_capacity = max(1.0, tpm * self.burst_seconds / 60)
+        return req_capacity, tok_capacity
+
+    async def _reserve_redis(self, redis: aioredis.Redis, provider: str, cost: int) -> float:
+        rpm, tpm = self.limits[provider]
+        req_capacity, tok_capacity = self._capacities(rpm, tpm)
+        wait_ms = await redis.eval(
+            _ACQUIRE_SCRIPT,
+            1,
+            f"llm_rate:{provider}",
+            rpm, tpm, req_capacity, tok_capacity, cost, self.max_wait * 1000,
+        )
+        return float(wait_ms) / 1000
+
+    async def _reserve_local(self, provider: str, cost: int) -> float:
+        """Тот же алгоритм в памяти процесса (только если Redis недоступен)."""
+        rpm, tpm = self.limits[provider]
+        req_capacity, tok_capacity = self._capacities(rpm, tpm)
+        async with self._local_lock:
+            now = time.monotonic()
+            req, tok, ts = self._local.get(provider, [req_capacity, tok_capacity, now])
+            elapsed = max(0.0, now - ts)
+            wait = 0.0
+            if rpm > 0:
+                req = min(req_capacity, req + elapsed * rpm / 60)
+                if req < 1:
+                    wait = max(wait, (1 - req) * 60 / rpm)
+            if tpm > 0:
+                tok = min(tok_capacity, tok + elapsed * tpm / 60)
+                if tok < cost:
+                    wait = max(wait, (cost - tok) * 60 / tpm)
+            if wait > self.max_wait:
+                self._local[provider] = [req, tok, now]
+                return -1.0
+            if rpm > 0:
+                req -= 1
+            if tpm > 0:
+                tok -= cost
+            self._local[provider] = [req, tok, now]
+            return wait
+
+    async def acquire(self, provider: str, tokens: int) -> float:
+        """
+        Дождаться своей очереди к провайдеру. Возвращает время ожидания (сек).
+        Бросает RateLimitTimeout, если ждать пришлось бы дольше LLM_RATE_MAX_WAIT.
+        """
+        rpm, tpm = self.limits.get(provider, (0, 0))
+        if rpm <= 0 and tpm <= 0:
+            return 0.0
+        # Запрос крупнее ведра всё равно должен пройти - ограничиваем оценку ёмкостью
+        cost = min(tokens, int(self._capacities(rpm, tpm)[1])) if tpm > 0 else 0
+
+        wait = None
+        redis = await self._get_redis()
+        if redis:
+            try:
+                wait = await self._reserve_redis(redis, provider, cost)
+            except Exception as exc:
+                print(f"[LLMRateLimiter] Warning: Redis error, using local bucket: {exc}")
+        if wait is None:
+            wait = await self._reserve_local(provider, cost)
+
+        if wait < 0:
+            raise RateLimitTimeout(
+                f"Провайдер '{provider}' перегружен: очередь длиннее {self.max_wait:.0f} сек"
+            )
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def estimate_tokens(kwargs: Dict) -> int:
+    """Грубая оценка токенов запроса: ~3 символа на токен во входе плюс max_tokens ответа."""
+    chars = sum(len(m.get("content") or "") for m in kwargs.get("messages", []))
+    return chars // 3 + int(kwargs.get("max_tokens") or 0)
+
+
+# Глобальный экземпляр ограничителя
+rate_limiter = LLMRateLimiter()
@@ -0,0 +1,179 @@
+"""
+Выбор фрагментов текста сайта для шага анализа (BM25, без внешних сервисов).
+
+Каждый шаг анализа спрашивает о своём (услуги, аудитория, цифры и факты),
+а без отбора получает весь текст сайта. Текст делится на фрагменты по
+строкам и индексируется один раз на страницу; шаг получает только самые
+близкие к его формулировке фрагменты в пределах бюджета токенов, в исходном
+порядке и всегда вместе с началом страницы (название и суть компании).
+Остаток бюджета добирается фрагментами по порядку страницы, поэтому шаг с
+общей формулировкой получает не меньше контекста, чем нужно для ответа.
+"""
+import hashlib
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from app.services.token_budget import token_budget
+
+
+_WORD_RE = re.compile(r"[a-zа-яё0-9]+", re.IGNORECASE)
+
+# Частые слова формулировок шагов, которые ничего не говорят о нужном фрагменте
+_STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "о", "об", "от", "до", "из", "к", "у", "за", "для", "или",
+    "а", "но", "не", "что", "как", "это", "его", "её", "их", "все", "всех", "так", "же", "ли", "бы",
+    "то", "при", "под", "над", "без", "который", "которые", "которая", "сайт", "сайта", "сайте",
+    "текст", "текста", "определите", "определи", "найдите", "найди", "изучите", "изучи", "выявите",
+    "выяви", "опишите", "опиши", "составьте", "составь", "предложите", "предложи", "проанализируй",
+    "проанализируйте", "основные", "основных", "the", "and", "of", "to", "a", "in",
+}
+
+# Длина основы слова: русские окончания отбрасываются грубо, но без словарей
+_STEM_LENGTH = 6
+
+# Шаг ищет цифры (цены, сроки, статистику): в тексте их нет в виде слов запроса,
+# поэтому такие шаги дополнительно получают фрагменты, где много чисел
+_NUMERIC_QUERY_STEMS = {"цифры", "цифр", "числа", "числов", "статис", "цены", "цена", "стоимо", "тарифы", "факты"}
+_NUMBER_RE = re.compile(r"\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Основы слов текста (нижний регистр, без стоп-слов, обрезка окончаний)."""
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [word[:_STEM_LENGTH] for word in words if word not in _STOP_WORDS and len(word) > 1]
+
+
+def chunk_text(text: str, max_chars: int) -> List[str]:
+    """Фрагменты по целым строкам не длиннее max_chars (длинная строка режется по словам)."""
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in text.split("\n"):
+        while len(line) > max_chars:
+            cut = line.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:cut])
+            line = line[cut:].lstrip()
+        if current and size + len(line) + 1 > max_chars:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        if line:
+            current.append(line)
+            size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class BM25Index:
+    """BM25 по фрагментам одного текста."""
+
+    def __init__(self, chunks: List[str], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._term_freqs = [Counter(tokenize(chunk)) for chunk in chunks]
+        self._numbers = [len(_NUMBER_RE.findall(chunk)) for chunk in chunks]
+        self._lengths = [sum(freqs.values()) for freqs in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        doc_freqs: Counter = Counter()
+        for freqs in self._term_freqs:
+            doc_freqs.update(freqs.keys())
+        total = len(chunks)
+        self._idf: Dict[str, float] = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()
+        }
+
+    def scores(self, query: str) -> List[float]:
+        terms = set(tokenize(query))
+        numeric = bool(terms & _NUMERIC_QUERY_STEMS)
+        max_numbers = max(self._numbers, default=0) or 1
+        result = []
+        for freqs, length, numbers in zip(self._term_freqs, self._lengths, self._numbers):
+            # Вес чисел сопоставим с одним совпавшим редким словом
+            score = 2.0 * numbers / max_numbers if numeric else 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length) if self._avg_length else self.k1
+            for term in terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            result.append(score)
+        return result
+
+
+class StepRetriever:
+    """Индексы текстов сайтов воркера и отбор фрагментов под шаг анализа."""
+
+    def __init__(self):
+        self.chunk_chars = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "800"))
+        # Бюджет фрагментов для одного шага (токенов модели шага)
+        self.max_tokens = int(os.getenv("RETRIEVAL_MAX_TOKENS", "4000"))
+        self.top_k = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+        # STEP_CONTEXT_MODE=auto: отбирать фрагменты, только если текст шага длиннее этого
+        # (короче - общий текст шагов из кэша контекста провайдера дешевле)
+        self.auto_min_tokens = int(os.getenv("RETRIEVAL_AUTO_MIN_TOKENS", "12000"))
+        # Сколько индексов держать (одна страница - один индекс на все её шаги)
+        self.max_indexes = int(os.getenv("RETRIEVAL_MAX_INDEXES", "32"))
+        self._indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+
+    def index(self, text: str) -> BM25Index:
+        """Индекс текста (строится один раз, шаги того же анализа берут готовый)."""
+        key = hashlib.md5(text.encode("utf-8")).hexdigest()
+        index = self._indexes.get(key)
+        if index is None:
+            index = BM25Index(chunk_text(text, self.chunk_chars))
+            self._indexes[key] = index
+            if len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(key)
+        return index
+
+    def select(self, text: str, query: str, model: str, max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        Фрагменты text, относящиеся к query, в пределах max_tokens (по умолчанию
+        RETRIEVAL_MAX_TOKENS). Возвращает (текст, {"chunks", "selected", "matched", "tokens"});
+        matched - сколько из выбранных найдено по запросу (включая начало страницы).
+        """
+        max_tokens = max_tokens or self.max_tokens
+        index = self.index(text)
+        if not index.chunks:
+            return "", {"chunks": 0, "selected": 0, "matched": 0, "tokens": 0}
+        scores = index.scores(query)
+        ranked = sorted(
+            (i for i in range(len(index.chunks)) if scores[i] > 0),
+            key=lambda i: -scores[i],
+        )[: self.top_k]
+        # Начало страницы (кто это и чем занимается) нужно любому шагу;
+        # после найденных - остальные фрагменты по порядку, пока есть бюджет
+        candidates = [0] + [i for i in ranked if i != 0]
+        chosen = set(candidates)
+        candidates += [i for i in range(len(index.chunks)) if i not in chosen]
+
+        found = set(ranked) | {0}
+        selected: List[int] = []
+        used = 0
+        matched = 0
+        for i in candidates:
+            if max_tokens - used < 50:
+                break
+            tokens = token_budget.count(index.chunks[i], model)
+            if used + tokens > max_tokens:
+                continue
+            selected.append(i)
+            used += tokens
+            if i in found:
+                matched += 1
+        selected.sort()
+        context = "\n...\n".join(index.chunks[i] for i in selected)
+        return context, {"chunks": len(index.chunks), "selected": len(selected), "matched": matched, "tokens": used}
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+step_retriever = StepRetriever()
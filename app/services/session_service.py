@@ -48,6 +48,14 @@ class SessionService:
         # Проверяем, не истекло ли время (W в минутах)
         return time_diff < timedelta(minutes=W)
 
+    def remaining_seconds(self, session: ClientSession) -> int:
+        """Сколько секунд осталось до окончания сеанса (Tb + W - Tt), не меньше 0."""
+        if not session or not session.dt:
+            return 0
+        W = session.duration_minutes if session.duration_minutes is not None else self.default_duration_minutes
+        remaining = session.dt + timedelta(minutes=W) - datetime.now()
+        return max(int(remaining.total_seconds()), 0)
+
     def get_available_styles(self, session: ClientSession) -> Dict[str, int]:
         """Получить доступные стили (где значение = 1)."""
         return {
@@ -0,0 +1,182 @@
+"""
+Объединение одинаковых одновременных LLM-запросов (singleflight).
+
+Если такой же запрос уже выполняется, новый вызывающий не идёт к провайдеру,
+а ждёт результат первого. В пределах воркера - через общий asyncio.Task;
+между воркерами (LLM_SINGLEFLIGHT_REDIS=true) - через блокировку в Redis:
+лидер выполняет запрос и кладёт результат в Redis, остальные его дожидаются.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aioredis
+
+
+class SingleFlight:
+    """Один вызов на ключ: остальные одновременные вызовы получают его результат."""
+
+    def __init__(self, redis_url: str = None):
+        self.enabled = os.getenv("LLM_SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+        self.redis_enabled = os.getenv("LLM_SINGLEFLIGHT_REDIS", "false").lower() == "true"
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.redis: Optional[aioredis.Redis] = None
+        self._redis_retry_at = 0.0
+        # Сколько держать блокировку лидера и результат для остальных воркеров (сек)
+        self.lock_ttl = float(os.getenv("LLM_SINGLEFLIGHT_LOCK_TTL", "120"))
+        self.result_ttl = int(os.getenv("LLM_SINGLEFLIGHT_RESULT_TTL", "30"))
+        self.poll_interval = float(os.getenv("LLM_SINGLEFLIGHT_POLL", "0.2"))
+        self.redis_prefix = "llm_sf"
+        self._flights: Dict[str, asyncio.Task] = {}
+        # Сколько вызывающих ждут каждый общий вызов
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.stats: Dict[str, int] = {
+            "calls": 0,
+            "leaders": 0,
+            "coalesced_local": 0,
+            "coalesced_redis": 0,
+            "redis_fallbacks": 0,
+            "redis_errors": 0,
+        }
+
+    async def _get_redis(self) -> Optional[aioredis.Redis]:
+        if not self.redis_enabled:
+            return None
+        if not self.redis:
+            if time.monotonic() < self._redis_retry_at:
+                return None
+            try:
+                self.redis = await aioredis.from_url(self.redis_url, decode_responses=True)
+            except Exception as exc:
+                print(f"[SingleFlight] Warning: Redis unavailable, coalescing within worker only: {exc}")
+                self.stats["redis_errors"] += 1
+                self._redis_retry_at = time.monotonic() + 30
+                return None
+        return self.redis
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполнить fn() один раз на ключ. Результат (или исключение) получают все,
+        кто пришёл с тем же ключом, пока вызов выполнялся.
+        Отмена одного ожидающего общий вызов не отменяет; когда отменены все
+        (таймаут шага, клиент отключился), отменяется и fn().
+        """
+        if not self.enabled:
+            return await fn()
+        self.stats["calls"] += 1
+        task = self._flights.get(key)
+        if task is not None:
+            self.stats["coalesced_local"] += 1
+        else:
+            task = asyncio.ensure_future(self._lead(key, fn))
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: отмена одного ожидающего не отменяет вызов для остальных
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Результат больше никому не нужен - не держим запрос к провайдеру
+                    task.cancel()
+                    if self._flights.get(key) is task:
+                        del self._flights[key]
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Ошибку получают ожидающие; если все они ушли - не шумим "exception never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _lead(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Вызов лидера воркера; при включённом Redis - ещё и координация между воркерами."""
+        redis = await self._get_redis()
+        if redis is None:
+            self.stats["leaders"] += 1
+            return await fn()
+
+        lock_key = f"{self.redis_prefix}:lock:{key}"
+        result_key = f"{self.redis_prefix}:result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+        except Exception as exc:
+            print(f"[SingleFlight] Warning: Redis lock failed: {exc}")
+            self.stats["redis_errors"] += 1
+            acquired = True
+            redis = None
+
+        if acquired:
+            self.stats["leaders"] += 1
+            try:
+                result = await fn()
+            except BaseException:
+                if redis is not None:
+                    await self._release(redis, lock_key, token)
+                raise
+            if redis is not None:
+                try:
+                    await redis.setex(result_key, self.result_ttl, json.dumps(result, ensure_ascii=False))
+                except Exception as exc:
+                    print(f"[SingleFlight] Warning: Redis result store failed: {exc}")
+                    self.stats["redis_errors"] += 1
+                await self._release(redis, lock_key, token)
+            return result
+
+        # Запрос выполняет другой воркер - ждём его результат
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                serialized = await redis.get(result_key)
+                if serialized is not None:
+                    self.stats["coalesced_redis"] += 1
+                    return json.loads(serialized)
+                if not await redis.exists(lock_key):
+                    break
+            except Exception as exc:
+                print(f"[SingleFlight] Warning: Redis poll failed: {exc}")
+                self.stats["redis_errors"] += 1
+                break
+        # Лидер упал или Redis недоступен - выполняем запрос сами
+        self.stats["redis_fallbacks"] += 1
+        self.stats["leaders"] += 1
+        return await fn()
+
+    async def _release(self, redis: aioredis.Redis, lock_key: str, token: str) -> None:
+        """Снять свою блокировку (чужую, перехваченную после TTL, не трогаем)."""
+        try:
+            if await redis.get(lock_key) == token:
+                await redis.delete(lock_key)
+        except Exception as exc:
+            print(f"[SingleFlight] Warning: Redis unlock failed: {exc}")
+            self.stats["redis_errors"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "redis": self.redis_enabled,
+            "in_flight": len(self._flights),
+            **self.stats,
+        }
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP llm_singleflight_total Identical in-flight LLM requests: leaders and coalesced followers",
+            "# TYPE llm_singleflight_total counter",
+        ]
+        for kind in ("leaders", "coalesced_local", "coalesced_redis", "redis_fallbacks"):
+            lines.append(f'llm_singleflight_total{{kind="{kind}"}} {self.stats[kind]}')
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+singleflight = SingleFlight()
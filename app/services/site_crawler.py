@@ -0,0 +1,188 @@
+"""
+Обход нескольких страниц сайта (режим crawl).
+
+Главная страница часто содержит мало текста о компании, поэтому в режиме
+crawl к ней добавляются ещё несколько страниц того же сайта. Кандидаты - из
+sitemap.xml и ссылок главной страницы; разделы "о компании", "услуги",
+"каталог", "цены" и близкие к корню страницы идут первыми. Общие для страниц
+строки (контакты, слоганы) остаются один раз, а бюджет токенов делится между
+страницами, чтобы длинная страница не вытеснила остальные.
+"""
+import asyncio
+import os
+import re
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from app.services.http_fetch import XML_CONTENT_TYPES, page_fetcher
+from app.services.token_budget import token_budget
+
+
+# Файлы, а не страницы
+_SKIP_EXTENSIONS = (
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg", ".ico", ".pdf", ".doc", ".docx",
+    ".xls", ".xlsx", ".zip", ".rar", ".mp3", ".mp4", ".avi", ".css", ".js", ".xml", ".json",
+)
+# Страницы без текста о компании: вход, корзина, поиск, теги, пагинация, юридические документы
+_SKIP_PATH_RE = re.compile(
+    r"login|signin|signup|register|auth|account|cabinet|lk/|cart|basket|korzina|checkout|"
+    r"search|poisk|/tag/|/tags/|/page/\d|privacy|policy|politika|terms|soglasie|agreement|"
+    r"wp-admin|wp-login|/feed|/rss|/amp/",
+    re.IGNORECASE,
+)
+# Разделы, где обычно описаны компания, её продукты и преимущества
+_PRIORITY_PATH_RE = re.compile(
+    r"about|o-nas|o_nas|onas|o-kompanii|company|kompaniya|services|uslugi|service|products|"
+    r"produkt|produkciya|catalog|katalog|price|prays|ceny|tseny|portfolio|proekty|projects|"
+    r"advantages|preimushchestva|dostavka|delivery|otzyvy|reviews|kontakty|contacts",
+    re.IGNORECASE,
+)
+_LOC_RE = re.compile(r"<loc>\s*([^<\s]+)\s*</loc>", re.IGNORECASE)
+
+
+def normalize_url(url: str) -> str:
+    """URL без якоря, с хостом в нижнем регистре и без завершающего "/" (кроме корня)."""
+    parts = urlsplit(url.strip())
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ""))
+
+
+def _site_host(url: str) -> str:
+    host = urlsplit(url).netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def parse_sitemap(xml: str) -> Tuple[List[str], List[str]]:
+    """(адреса страниц, адреса вложенных sitemap) из sitemap.xml или индекса sitemap."""
+    locs = [loc.replace("&amp;", "&") for loc in _LOC_RE.findall(xml)]
+    if "<sitemapindex" in xml[:2000].lower():
+        return [], locs
+    return locs, []
+
+
+class SiteCrawler:
+    """Выбор страниц для обхода и сборка их текста в один корпус."""
+
+    def __init__(self):
+        # Сколько страниц анализировать вместе с исходной
+        self.max_pages = int(os.getenv("CRAWL_MAX_PAGES", "5"))
+        # Общее время на обход (сек): что не успело загрузиться - не ждём
+        self.time_budget = float(os.getenv("CRAWL_TIME_BUDGET", "20"))
+        self.sitemap_timeout = float(os.getenv("CRAWL_SITEMAP_TIMEOUT", "5"))
+        self.sitemap_max_urls = int(os.getenv("CRAWL_SITEMAP_MAX_URLS", "500"))
+        # Страница, у которой новых строк меньше этой доли, - почти копия уже взятых
+        self.min_new_share = float(os.getenv("CRAWL_MIN_NEW_SHARE", "0.2"))
+
+    async def sitemap_urls(self, start_url: str) -> List[str]:
+        """Адреса страниц из /sitemap.xml сайта (с одним уровнем индекса sitemap)."""
+        parts = urlsplit(start_url)
+        queue = [urlunsplit((parts.scheme, parts.netloc, "/sitemap.xml", "", ""))]
+        urls: List[str] = []
+        fetched = 0
+        while queue and fetched < 3 and len(urls) < self.sitemap_max_urls:
+            sitemap_url = queue.pop(0)
+            fetched += 1
+            try:
+                page = await asyncio.wait_for(
+                    page_fetcher.fetch_page(sitemap_url, content_types=XML_CONTENT_TYPES),
+                    timeout=self.sitemap_timeout,
+                )
+            except Exception as exc:
+                print(f"[SiteCrawler] No sitemap at {sitemap_url}: {type(exc).__name__}")
+                continue
+            pages, nested = parse_sitemap(page["text"])
+            urls.extend(pages)
+            queue.extend(nested)
+        return urls[: self.sitemap_max_urls]
+
+    def rank(self, start_url: str, links: List[str], sitemap: List[str]) -> List[str]:
+        """
+        Лучшие страницы того же сайта для анализа (без исходной).
+        Выше - разделы о компании и услугах, ссылки с исходной страницы
+        (в её меню главные разделы) и страницы ближе к корню.
+        """
+        site = _site_host(start_url)
+        start = urlsplit(normalize_url(start_url)).path
+        # Ключ страницы - путь: http/https и www/без www - одна и та же страница
+        scores: Dict[str, float] = {}
+        order: Dict[str, int] = {}
+        urls_by_path: Dict[str, str] = {}
+        for source_bonus, urls in ((2.0, links), (1.0, sitemap)):
+            source_seen = set()
+            for url in urls:
+                if _site_host(url) != site:
+                    continue
+                parts = urlsplit(normalize_url(url))
+                path = parts.path
+                if parts.query or path.lower().endswith(_SKIP_EXTENSIONS) or _SKIP_PATH_RE.search(path):
+                    continue
+                if path == start or path in source_seen:
+                    continue
+                source_seen.add(path)
+                if path in scores:
+                    # Страница есть и в ссылках, и в sitemap - небольшой бонус за второй источник
+                    scores[path] += 0.5
+                    continue
+                depth = len([segment for segment in path.split("/") if segment])
+                priority = 3.0 if _PRIORITY_PATH_RE.search(path) else 0.0
+                scores[path] = source_bonus + priority - 0.5 * depth
+                order[path] = len(order)
+                urls_by_path[path] = normalize_url(url)
+        ranked = sorted(scores, key=lambda path: (-scores[path], order[path]))
+        return [urls_by_path[path] for path in ranked[: max(self.max_pages - 1, 0)]]
+
+    def merge(self, pages: List[Tuple[str, str]], model: str, max_tokens: int) -> Tuple[str, Dict[str, Any]]:
+        """
+        Один корпус из текстов страниц [(url, текст)], исходная страница первой.
+        Повторяющиеся между страницами строки остаются один раз, почти повторяющие
+        уже взятое страницы пропускаются. Если корпус не помещается в max_tokens,
+        каждая страница урезается до своей доли бюджета (короткие отдают
+        неиспользованное длинным).
+        """
+        seen = set()
+        kept: List[Tuple[str, str]] = []
+        duplicate_lines = 0
+        skipped_pages = 0
+        for url, text in pages:
+            lines = [line for line in text.split("\n") if line.strip()]
+            new_lines = []
+            for line in lines:
+                key = " ".join(line.lower().split())
+                if key in seen:
+                    continue
+                seen.add(key)
+                new_lines.append(line)
+            duplicate_lines += len(lines) - len(new_lines)
+            if kept and len(new_lines) < len(lines) * self.min_new_share:
+                skipped_pages += 1
+                continue
+            if new_lines:
+                kept.append((url, "\n".join(new_lines)))
+
+        sections = [(url, f"[Страница: {urlsplit(url).path or '/'}]\n{text}") for url, text in kept]
+        # Дальше max_tokens*10 символов не считаем: такая страница заведомо не помещается
+        sizes = [token_budget.count(section[: max_tokens * 10], model) for _, section in sections]
+        if sum(sizes) > max_tokens:
+            # Водоразлив: короткие страницы целиком, остальное поровну между длинными
+            shares = [0] * len(sections)
+            remaining = max_tokens
+            for left, index in enumerate(sorted(range(len(sections)), key=lambda i: sizes[i])):
+                shares[index] = min(sizes[index], remaining // (len(sections) - left))
+                remaining -= shares[index]
+            sections = [
+                (url, token_budget.fit(section, model, share)[0] if share < size else section)
+                for (url, section), size, share in zip(sections, sizes, shares)
+            ]
+
+        corpus = "\n\n".join(section for _, section in sections)
+        report = {
+            "pages": [url for url, _ in sections],
+            "skipped_duplicate_pages": skipped_pages,
+            "duplicate_lines": duplicate_lines,
+            "chars": len(corpus),
+        }
+        return corpus, report
+
+
+# Глобальный экземпляр
+site_crawler = SiteCrawler()
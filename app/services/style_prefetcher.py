@@ -0,0 +1,268 @@
+"""
+Заблаговременная генерация постов в ещё не использованных стилях сеанса.
+
+После первого стиля клиент обычно в течение нескольких минут пробует ещё
+несколько, и каждый раз ждёт полную финализацию. Пока у воркера есть
+свободная мощность (мало своих анализов, провайдеры исправны), посты для
+оставшихся стилей генерируются в фоне из тех же промежуточных результатов
+и хранятся в Redis до конца сеанса (W). Запрос такого стиля получает
+готовые посты сразу.
+
+Стиль списывается (mark_style_as_used) только при выдаче: сгенерированный
+заранее, но не запрошенный стиль остаётся у клиента. Готовые посты удаляются
+(consume) тоже только после выдачи: если запрос оборвался раньше, повтор
+получит их снова. Стиль, который запросил клиент, фоновая генерация уже
+не берёт - его получает или генерирует сам запрос.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from app.services.circuit_breaker import CLOSED, circuit_breakers
+from app.services.llm_metrics import Counter
+from app.services.provider_health import provider_health
+try:
+    from app.services.cache import cache_service
+    CACHE_AVAILABLE = True
+except ImportError:
+    CACHE_AVAILABLE = False
+
+
+def intermediate_fingerprint(intermediate: List[Dict[str, Any]]) -> str:
+    """Отпечаток промежуточных результатов: готовые посты отдаются только для тех же результатов."""
+    data = json.dumps(intermediate, ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+class StylePrefetcher:
+    """Фоновая финализация оставшихся стилей сеанса в пределах одного воркера."""
+
+    def __init__(self):
+        self.enabled = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"
+        # Свободная мощность: фоновая генерация идёт, только пока у воркера не больше стольких анализов
+        self.max_active = int(os.getenv("PREFETCH_MAX_ACTIVE_ANALYSES", "1"))
+        # Одновременных фоновых финализаций на воркер
+        self.concurrency = int(os.getenv("PREFETCH_CONCURRENCY", "1"))
+        # Сколько оставшихся стилей сеанса генерировать заранее
+        self.max_styles = int(os.getenv("PREFETCH_MAX_STYLES", "8"))
+        # Сколько ждать свободной мощности перед очередным стилем (сек); дольше - генерация прекращается
+        self.idle_wait = float(os.getenv("PREFETCH_IDLE_WAIT", "120"))
+        # Меньше этого до конца сеанса (сек) - не генерируем: клиент не успеет запросить
+        self.min_ttl = int(os.getenv("PREFETCH_MIN_TTL", "60"))
+        self.outcomes = Counter("style_prefetch_total", "Background style pre-generation by outcome")
+        self.active = 0
+        self._pid: Optional[int] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Сеанс (email, сайт, инфоповод) -> фоновая задача и стили, которые ей осталось сгенерировать
+        self._jobs: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[str, List[str]] = {}
+        # Стили сеанса, запрошенные клиентом, пока фоновая задача работает: их она пропускает
+        self._claimed: Dict[str, Set[str]] = {}
+        # Стиль, который генерируется прямо сейчас: запрос этого стиля дожидается его
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def _ensure_process(self) -> None:
+        """Задачи родительского процесса (gunicorn preload_app) воркеру не передаём."""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._jobs = {}
+            self._pending = {}
+            self._claimed = {}
+            self._inflight = {}
+
+    @staticmethod
+    def _key(*parts: str) -> str:
+        return hashlib.md5("_".join(parts).encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def foreground(self) -> Iterator[None]:
+        """Учёт анализа, который ждёт клиент: пока их много, фоновая генерация стоит."""
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    def has_capacity(self) -> bool:
+        """Есть ли у воркера свободная мощность: мало анализов, все провайдеры исправны."""
+        if self.active > self.max_active:
+            return False
+        if any(circuit["state"] != CLOSED for circuit in circuit_breakers.snapshot().values()):
+            return False
+        return all(health["healthy"] for health in provider_health.snapshot().values())
+
+    async def _wait_for_capacity(self) -> bool:
+        deadline = time.monotonic() + self.idle_wait
+        while not self.has_capacity():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.5)
+        return True
+
+    def schedule(
+        self,
+        analyzer: Any,
+        email: str,
+        url: str,
+        occasion: str,
+        intermediate: List[Dict[str, Any]],
+        styles: List[str],
+        ttl: int,
+    ) -> None:
+        """
+        Запланировать фоновую финализацию styles (оставшиеся стили сеанса) на ttl секунд
+        (остаток W). Повторный вызов для того же сеанса только обновляет список стилей.
+        Вызывать вне llm_metrics.collect(), иначе фоновые вызовы попадут в сводку анализа.
+        """
+        if not (self.enabled and CACHE_AVAILABLE and email and intermediate) or ttl < self.min_ttl:
+            return
+        self._ensure_process()
+        occasion = occasion or ""
+        job_key = self._key(email, url, occasion, intermediate_fingerprint(intermediate))
+        claimed = self._claimed.get(job_key, set())
+        self._pending[job_key] = [style for style in styles if style not in claimed][: self.max_styles]
+        if job_key in self._jobs:
+            return
+        deadline = time.time() + ttl
+        self._jobs[job_key] = asyncio.ensure_future(
+            self._run(job_key, analyzer, email, url, occasion, intermediate, deadline)
+        )
+
+    async def _run(
+        self,
+        job_key: str,
+        analyzer: Any,
+        email: str,
+        url: str,
+        occasion: str,
+        intermediate: List[Dict[str, Any]],
+        deadline: float,
+    ) -> None:
+        fingerprint = intermediate_fingerprint(intermediate)
+        try:
+            while self._pending.get(job_key):
+                style = self._pending[job_key].pop(0)
+                async with self._semaphore:
+                    if not await self._wait_for_capacity():
+                        self.outcomes.inc(outcome="skipped_busy")
+                        print(f"[StylePrefetcher] No spare capacity for {self.idle_wait:g}s, stopping")
+                        return
+                    ttl = int(deadline - time.time())
+                    if ttl < self.min_ttl:
+                        return
+                    if style in self._claimed.get(job_key, ()):
+                        # Пока ждали мощности, стиль запросил клиент
+                        continue
+                    if await cache_service.get_prefetched(email, url, style, occasion):
+                        continue
+                    style_key = self._key(email, url, style, occasion)
+                    task = asyncio.ensure_future(
+                        self._generate(analyzer, email, url, style, occasion, intermediate, fingerprint, ttl)
+                    )
+                    self._inflight[style_key] = task
+                    try:
+                        await task
+                    finally:
+                        self._inflight.pop(style_key, None)
+        finally:
+            self._jobs.pop(job_key, None)
+            self._pending.pop(job_key, None)
+            self._claimed.pop(job_key, None)
+
+    async def _generate(
+        self,
+        analyzer: Any,
+        email: str,
+        url: str,
+        style: str,
+        occasion: str,
+        intermediate: List[Dict[str, Any]],
+        fingerprint: str,
+        ttl: int,
+    ) -> None:
+        started = time.monotonic()
+        try:
+            final = await analyzer.finalize(intermediate, "", style, occasion)
+            await cache_service.set_prefetched(
+                email, url, style, occasion, {"fingerprint": fingerprint, "final": final}, ttl
+            )
+        except Exception as exc:
+            self.outcomes.inc(outcome="failed")
+            print(f"[StylePrefetcher] {style}: failed: {exc!r}")
+            return
+        self.outcomes.inc(outcome="generated")
+        print(f"[StylePrefetcher] {style}: ready in {time.monotonic() - started:.1f}s (ttl {ttl}s)")
+
+    async def take(
+        self,
+        email: Optional[str],
+        url: str,
+        style: str,
+        occasion: str,
+        intermediate: List[Dict[str, Any]],
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Готовый результат финализации стиля для этих промежуточных результатов или None.
+        Если стиль генерируется прямо сейчас, дождаться его дешевле, чем начинать
+        генерацию заново. Результат не удаляется - после выдачи клиенту вызвать consume.
+        Стиль в любом случае снимается с фоновой генерации: дальше его получает
+        или генерирует сам запрос.
+        """
+        if not (self.enabled and CACHE_AVAILABLE and email and intermediate):
+            return None
+        self._ensure_process()
+        occasion = occasion or ""
+        fingerprint = intermediate_fingerprint(intermediate)
+        self._claim(self._key(email, url, occasion, fingerprint), style)
+        inflight = self._inflight.get(self._key(email, url, style, occasion))
+        if inflight is not None:
+            await asyncio.wait([inflight])
+        entry = await cache_service.get_prefetched(email, url, style, occasion)
+        if not entry:
+            return None
+        if entry.get("fingerprint") != fingerprint:
+            # Анализ сайта с тех пор выполнен заново - посты по старым результатам не отдаём
+            await cache_service.delete_prefetched(email, url, style, occasion)
+            self.outcomes.inc(outcome="stale")
+            return None
+        print(f"[StylePrefetcher] {style}: using pre-generated posts")
+        return entry["final"]
+
+    def _claim(self, job_key: str, style: str) -> None:
+        """Снять стиль, запрошенный клиентом, с фоновой генерации сеанса."""
+        if job_key not in self._jobs:
+            return
+        self._claimed.setdefault(job_key, set()).add(style)
+        pending = self._pending.get(job_key)
+        if pending and style in pending:
+            pending.remove(style)
+
+    async def consume(self, email: Optional[str], url: str, style: str, occasion: str) -> None:
+        """Удалить готовые посты стиля после выдачи клиенту (стиль уже списан)."""
+        if not (self.enabled and CACHE_AVAILABLE and email):
+            return
+        await cache_service.delete_prefetched(email, url, style, occasion or "")
+        self.outcomes.inc(outcome="delivered")
+        print(f"[StylePrefetcher] {style}: delivered pre-generated posts")
+
+    def render_prometheus(self) -> str:
+        return "\n".join(self.outcomes.render()) + "\n"
+
+    async def close(self) -> None:
+        """Остановить фоновую генерацию (при остановке приложения)."""
+        if self._pid != os.getpid():
+            return
+        jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+
+# Глобальный экземпляр (по одному на процесс воркера)
+style_prefetcher = StylePrefetcher()
@@ -191,11 +191,10 @@ async def execute_task(task_id: str, task_data: Dict[str, Any]):
         
         if task_type == "analyze_site":
             from app.services.analyzer import SiteAnalyzer
-            from app.services.llm_client import LLMClient
+            from app.services.llm_client import get_shared_llm_client
             
-            # Создаем анализатор
-            llm_client = LLMClient()
-            analyzer = SiteAnalyzer(llm_client)
+            # Создаем анализатор на общем клиенте (общий пул соединений воркера)
+            analyzer = SiteAnalyzer(get_shared_llm_client())
             
             # Выполняем анализ
             result = await analyzer.analyze(
@@ -203,7 +202,8 @@ async def execute_task(task_id: str, task_data: Dict[str, Any]):
                 style=payload.get("style", "убедительно-позитивном"),
                 occasion=payload.get("occasion", ""),
                 use_cached=payload.get("use_cached", False),
-                cached_intermediate=payload.get("cached_intermediate")
+                cached_intermediate=payload.get("cached_intermediate"),
+                crawl=payload.get("crawl", False)
             )
             
             # Сохраняем результат
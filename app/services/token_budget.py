@@ -0,0 +1,101 @@
+"""
+Бюджет токенов для текста сайта.
+
+Текст измеряется в токенах модели того этапа, который его получит
+(get_steps - GPT-4o, run_step - DeepSeek), и укладывается в бюджет этапа
+вместо фиксированной обрезки по символам. Если установлен tiktoken и его
+словарь доступен, токены считаются точно; иначе - оценкой по символам.
+"""
+import os
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    tiktoken = None
+    TIKTOKEN_AVAILABLE = False
+
+
+# Оценка без токенизатора (с запасом): латиница ~3.5 символа на токен, кириллица и прочее ~2.5
+_ASCII_CHARS_PER_TOKEN = 3.5
+_OTHER_CHARS_PER_TOKEN = 2.5
+
+
+class TokenBudget:
+    """Подсчёт токенов и подгонка текста под бюджет этапа анализа."""
+
+    def __init__(self):
+        # Бюджет текста сайта (в токенах) для каждого этапа
+        self.budgets: Dict[str, int] = {
+            "get_steps": int(os.getenv("LLM_TEXT_BUDGET_GET_STEPS", "16000")),
+            "run_step": int(os.getenv("LLM_TEXT_BUDGET_RUN_STEP", "16000")),
+        }
+        # model -> кодировка tiktoken (None - модель неизвестна, считаем оценкой)
+        self._encodings: Dict[str, Any] = {}
+
+    def _encoding(self, model: str) -> Optional[Any]:
+        if not TIKTOKEN_AVAILABLE:
+            return None
+        if model not in self._encodings:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Модель tiktoken не знает (например, deepseek-chat) - считаем оценкой
+                encoding = None
+            except Exception as exc:
+                # Словарь скачивается при первом обращении; без сети работаем по оценке
+                print(f"[TokenBudget] Warning: tiktoken encoding for {model} unavailable: {exc}")
+                encoding = None
+            self._encodings[model] = encoding
+        return self._encodings[model]
+
+    def preload(self, models) -> None:
+        """Загрузить словари tiktoken заранее (при старте воркера, а не на первом запросе)."""
+        for model in models:
+            if model:
+                self._encoding(model)
+
+    def count(self, text: str, model: str) -> int:
+        """Число токенов текста для модели (точно через tiktoken или оценка)."""
+        encoding = self._encoding(model)
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        ascii_chars = sum(1 for ch in text if ch.isascii())
+        other_chars = len(text) - ascii_chars
+        return int(ascii_chars / _ASCII_CHARS_PER_TOKEN + other_chars / _OTHER_CHARS_PER_TOKEN) + 1
+
+    def fit(self, text: str, model: str, max_tokens: int) -> Tuple[str, bool]:
+        """
+        Уложить текст в max_tokens токенов модели.
+        Возвращает (текст, был_ли_обрезан); обрезанный текст заканчивается на "...".
+        """
+        # Больше ~10 символов на токен почти не бывает - хвост длиннее не токенизируем
+        text_cap = max_tokens * 10
+        tokens = self.count(text[:text_cap], model)
+        if tokens <= max_tokens and len(text) <= text_cap:
+            return text, False
+        text = text[:text_cap]
+
+        encoding = self._encoding(model)
+        if encoding is not None:
+            cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+        else:
+            # Пропорциональная оценка и доводка, пока оценка не уложится в бюджет
+            cut = text[:int(len(text) * max_tokens / tokens)]
+            while cut and self.count(cut, model) > max_tokens:
+                cut = cut[:int(len(cut) * 0.95)]
+
+        # Не рвём строку посередине, если до её начала недалеко
+        newline = cut.rfind("\n")
+        if newline > len(cut) * 0.9:
+            cut = cut[:newline]
+        return cut + "...", True
+
+    def fit_stage(self, text: str, stage: str, model: str) -> Tuple[str, bool]:
+        """Текст сайта в пределах бюджета этапа (get_steps / run_step)."""
+        return self.fit(text, model, self.budgets[stage])
+
+
+# Глобальный экземпляр
+token_budget = TokenBudget()
@@ -0,0 +1,73 @@
+"""
+Тесты объединения одинаковых LLM-запросов (singleflight).
+Запуск: python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+from app.services.singleflight import SingleFlight
+
+
+def _singleflight() -> SingleFlight:
+    flight = SingleFlight()
+    flight.enabled = True
+    flight.redis_enabled = False
+    return flight
+
+
+def _slow_call(started: asyncio.Event, cancelled: list):
+    async def fn():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return {"ok": True}
+    return fn
+
+
+def test_cancelling_only_waiter_cancels_call():
+    async def scenario():
+        flight = _singleflight()
+        started, cancelled = asyncio.Event(), []
+        waiter = asyncio.ensure_future(flight.do("key", _slow_call(started, cancelled)))
+        await started.wait()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+        return cancelled, flight
+
+    cancelled, flight = asyncio.run(scenario())
+    assert cancelled == [True]
+    assert flight._flights == {}
+    assert flight._waiters == {}
+
+
+def test_call_survives_while_another_waiter_remains():
+    async def scenario():
+        flight = _singleflight()
+        started, cancelled = asyncio.Event(), []
+        release = asyncio.Event()
+
+        async def fn():
+            started.set()
+            await release.wait()
+            return {"ok": True}
+
+        first = asyncio.ensure_future(flight.do("key", fn))
+        second = asyncio.ensure_future(flight.do("key", _slow_call(started, cancelled)))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second, cancelled, flight
+
+    result, cancelled, flight = asyncio.run(scenario())
+    assert result == {"ok": True}
+    assert cancelled == []
+    assert flight.stats["leaders"] == 1
+    assert flight.stats["coalesced_local"] == 1
+    assert flight._waiters == {}